@@ -0,0 +1,37 @@
+"""Bytes per flat kept in CianBot.flatlist: FlatListItem vs FlatRecord.
+
+    python benchmarks/bench_flat_memory.py [--offers 5000]"""
+import argparse
+import tracemalloc
+
+import cian_parser
+from bench_get_flatlist import make_page
+
+
+def measure(build, html):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    flats = build(html)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size / len(flats)
+
+
+def main():
+    parser = argparse.ArgumentParser('bench_flat_memory')
+    parser.add_argument('--offers', type=int, default=5000)
+    args = parser.parse_args()
+
+    html = make_page(args.offers)
+    items = measure(cian_parser.get_flatlist, html)
+    records = measure(
+        lambda html: [
+            cian_parser.FlatRecord.from_item(f)
+            for f in cian_parser.get_flatlist(html)
+        ], html)
+    print(f'{args.offers} offers: FlatListItem {items:.0f} bytes/flat, '
+          f'FlatRecord {records:.0f} bytes/flat, x{items / records:.1f}')
+
+
+if __name__ == '__main__':
+    main()
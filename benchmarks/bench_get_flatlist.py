@@ -0,0 +1,91 @@
+"""Compare the fast `offers` extractor against the pyjsparser AST path.
+
+    python benchmarks/bench_get_flatlist.py saved-page.html [...]
+
+Without arguments a synthetic search page is generated."""
+import argparse
+import json
+import random
+import time
+
+import cian_parser
+
+
+def make_offer(i, rnd):
+    rooms = rnd.randint(1, 4)
+    return {
+        'id': 200000000 + i,
+        'fullUrl': f'https://www.cian.ru/rent/flat/{200000000 + i}/',
+        'bargainTerms': {
+            'priceRur': rnd.randrange(25000, 120000, 500),
+            'deposit': rnd.randrange(0, 100000, 5000),
+            'clientFee': rnd.choice([0, 50, 100]),
+            'agentBonus': None,
+            'paymentPeriod': 'monthly',
+        },
+        'geo': {
+            'undergrounds': [{
+                'name': rnd.choice(['Сухаревская', 'Трубная', 'Выхино']),
+                'time': rnd.randint(3, 20),
+            }],
+            'userInput': f'Москва, улица Номер {i}, {rnd.randint(1, 99)}',
+        },
+        'roomsCount': rooms,
+        'bedroomsCount': None,
+        'description': 'Сдается квартира. ' * rnd.randint(5, 40),
+        'photos': [{
+            'fullUrl': f'https://cdn-p.cian.site/images/{i}-{j}-1.jpg'
+        } for j in range(rnd.randint(0, 12))],
+        'phones': [{'countryCode': '7', 'number': '9990000000'}],
+    }
+
+
+def make_page(n_offers, seed=0):
+    rnd = random.Random(seed)
+    return page_html([make_offer(i, rnd) for i in range(n_offers)])
+
+
+def page_html(offers):
+    """A search results page listing `offers`"""
+    state = {'results': {'offers': offers}}
+    return ('<html><head><script>window.ga=function(){};</script></head>'
+            '<body><div id="frontend-serp"></div><script>'
+            'window._cianConfig["frontend-serp"]=[{"key":"initialState",'
+            f'"value":{json.dumps(state, ensure_ascii=False)}}}];'
+            '</script></body></html>')
+
+
+def bench(html, fast, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        flats = cian_parser.get_flatlist(html, fast=fast)
+        best = min(best, time.perf_counter() - t)
+    return best, flats
+
+
+def main():
+    parser = argparse.ArgumentParser('bench_get_flatlist')
+    parser.add_argument('pages', nargs='*')
+    parser.add_argument('--offers', type=int, default=28)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = []
+        for path in args.pages:
+            with open(path, 'r') as f:
+                pages.append((path, f.read()))
+    else:
+        pages = [(f'synthetic[{args.offers}]', make_page(args.offers))]
+
+    for name, html in pages:
+        t_slow, slow = bench(html, False, args.repeat)
+        t_fast, fast = bench(html, True, args.repeat)
+        assert fast == slow, f'{name}: fast path disagrees with the AST path'
+        print(f'{name}: {len(fast)} offers, ast {t_slow * 1000:.1f}ms, '
+              f'fast {t_fast * 1000:.1f}ms, x{t_slow / t_fast:.1f}')
+
+
+if __name__ == '__main__':
+    main()
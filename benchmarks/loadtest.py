@@ -0,0 +1,420 @@
+"""End-to-end load test: fake cian.ru and Telegram Bot API around a CianBot.
+
+    python benchmarks/loadtest.py [--chats 2000] [--urls 200] [--churn 120] \\
+        [--duration 60] [--drain 120] [--output results.json]
+
+The cian stand-in serves a search page per observed url, newest offers
+first, publishing --churn new offers a minute spread over the urls, each
+response delayed by --cian-latency. Photos are served by it as well.
+The Telegram stand-in answers sendMessage/sendPhoto/sendMediaGroup after
+--tg-latency, enforcing a global and a per-chat rate limit with 429s the
+way Telegram does, and records when each chat got each offer.
+
+A CianBot with every chat subscribed to everything polls the urls through
+its scheduler and delivers through its Sender. Once --duration
+is over, publishing stops and every url is polled one last time before
+the outbox drains. The report, a JSON object, has the latency from
+publishing an offer to a chat receiving it, message throughput, the
+outbox backlog over time and request counts. Offers the bot never
+fetched are counted as unpolled, apart from the undelivered
+notifications of those it did."""
+import argparse
+import collections
+import http.server
+import json
+import os.path as osp
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bot  # noqa: E402
+import cian_filters  # noqa: E402
+import cian_logging  # noqa: E402
+import cian_scheduler  # noqa: E402
+import cian_sender  # noqa: E402
+import telegram  # noqa: E402
+from bench_get_flatlist import make_offer, page_html  # noqa: E402
+from cian_parser import aio  # noqa: E402
+from telegram.utils.request import Request  # noqa: E402
+
+OFFERS_PER_PAGE = 28
+OFFER_ID = re.compile(r'/rent/flat/(\d+)/')
+CHAT_ID = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+PHOTO = b'\xff\xd8\xff\xe0' + bytes(4 * 1024)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeCian:
+    """Search pages that gain `churn` offers a minute between them"""
+
+    def __init__(self, n_urls, churn, latency, seed=0):
+        self.rnd = random.Random(seed)
+        self.churn = churn
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.searches = [
+            collections.deque(maxlen=OFFERS_PER_PAGE * 4)
+            for _ in range(n_urls)
+        ]
+        self.published = dict()  # offer id -> time.monotonic()
+        self.next_id = 0
+        self.requests = 0
+        self.running = False
+        fake = self
+
+        class CianHandler(Handler):
+            def do_GET(self):
+                fake.handle(self)
+
+        self.server = Server(CianHandler)
+
+    def url(self, search):
+        return f'{self.server.base_url}/cat.php?deal_type=rent&search={search}'
+
+    def publish(self, n):
+        now = time.monotonic()
+        with self.lock:
+            for _ in range(n):
+                i = self.next_id
+                self.next_id += 1
+                offer = make_offer(i, self.rnd)
+                offer['photos'] = [{
+                    'fullUrl': f'{self.server.base_url}/photo/{i}-{j}.jpg'
+                } for j in range(self.rnd.randint(0, 3))]
+                self.rnd.choice(self.searches).appendleft(offer)
+                self.published[offer['id']] = now
+
+    def run(self):
+        owed = 0.0
+        while self.running:
+            owed += self.churn / 60 / 10
+            self.publish(int(owed))
+            owed -= int(owed)
+            time.sleep(0.1)
+
+    def handle(self, request):
+        time.sleep(self.latency)
+        u = urlparse(request.path)
+        if u.path.startswith('/photo/'):
+            return request.reply(200, PHOTO, 'image/jpeg')
+        query = parse_qs(u.query)
+        search = int(query['search'][0])
+        page = int(query.get('p', ['1'])[0])
+        with self.lock:
+            self.requests += 1
+            offers = list(self.searches[search])
+        offers = offers[(page - 1) * OFFERS_PER_PAGE:page * OFFERS_PER_PAGE]
+        request.reply(200,
+                      page_html(offers).encode('utf8'),
+                      'text/html; charset=utf-8')
+
+    def start(self, prefill):
+        self.publish(prefill)
+        self.server.start()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.server.stop()
+
+
+class FakeTelegram:
+    """Bot API methods the bot uses, with Telegram's rate limits"""
+
+    def __init__(self, latency, rate, chat_rate, published):
+        self.latency = latency
+        self.published = published
+        self.lock = threading.Lock()
+        self.bucket = cian_sender.TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = dict()
+        self.calls = collections.Counter()
+        self.rejected = 0
+        self.received = dict()  # (chat_id, offer id) -> latency
+        self.message_id = 0
+        fake = self
+
+        class TelegramHandler(Handler):
+            def do_POST(self):
+                fake.handle(self)
+
+        self.server = Server(TelegramHandler)
+
+    def admit(self, chat_id, now):
+        if chat_id not in self.chat_buckets:
+            # Short bursts are fine, as long as they're few
+            self.chat_buckets[chat_id] = cian_sender.TokenBucket(
+                self.chat_rate, capacity=3)
+        chat = self.chat_buckets[chat_id]
+        if self.bucket.delay(now) > 0 or chat.delay(now) > 0:
+            return False
+        self.bucket.take(now)
+        chat.take(now)
+        return True
+
+    def handle(self, request):
+        time.sleep(self.latency)
+        method = request.path.rsplit('/', 1)[-1]
+        body = request.rfile.read(int(request.headers['Content-Length']))
+        if request.headers['Content-Type'].startswith('application/json'):
+            data = json.loads(body)
+        else:
+            data = dict(chat_id=int(CHAT_ID.search(body).group(1)))
+        chat_id = int(data['chat_id'])
+        now = time.monotonic()
+        with self.lock:
+            self.calls[method] += 1
+            admitted = self.admit(chat_id, now)
+            if not admitted:
+                self.rejected += 1
+        if not admitted:
+            return request.reply(
+                429,
+                json.dumps(
+                    dict(ok=False,
+                         error_code=429,
+                         description='Too Many Requests: retry after 1',
+                         parameters=dict(retry_after=1))).encode(),
+                'application/json')
+        with self.lock:
+            text = data.get('text') or data.get('caption') or ''
+            m = OFFER_ID.search(text)
+            if m is not None and int(m.group(1)) in self.published:
+                self.received.setdefault(
+                    (chat_id, int(m.group(1))),
+                    now - self.published[int(m.group(1))])
+            self.message_id += 1
+            message_id = self.message_id
+        if method == 'sendMediaGroup':
+            result = [
+                self.message(chat_id, message_id, photo=True)
+                for _ in range(2)
+            ]
+        else:
+            result = self.message(chat_id, message_id, method == 'sendPhoto')
+        request.reply(200,
+                      json.dumps(dict(ok=True, result=result)).encode(),
+                      'application/json')
+
+    @staticmethod
+    def message(chat_id, message_id, photo=False):
+        msg = dict(message_id=message_id,
+                   date=int(time.time()),
+                   chat=dict(id=chat_id,
+                             type='private' if chat_id > 0 else 'group'))
+        if photo:
+            msg['photo'] = [
+                dict(file_id=f'file{message_id}',
+                     file_unique_id=f'u{message_id}',
+                     width=1,
+                     height=1)
+            ]
+        return msg
+
+    def start(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    if not values:
+        return dict()
+    values = sorted(values)
+    result = {
+        f'p{p}': values[min(len(values) - 1, len(values) * p // 100)]
+        for p in ps
+    }
+    result['max'] = values[-1]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser('loadtest')
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--urls', type=int, default=200)
+    parser.add_argument('--churn',
+                        type=float,
+                        default=120,
+                        help='new offers a minute over all urls')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--drain',
+                        type=float,
+                        default=120,
+                        help='seconds to wait for the outbox to empty')
+    parser.add_argument('--cian-latency', type=float, default=0.05)
+    parser.add_argument('--tg-latency', type=float, default=0.02)
+    parser.add_argument('--tg-rate', type=float, default=30)
+    parser.add_argument('--tg-chat-rate', type=float, default=1)
+    parser.add_argument('--poll-seconds', type=float, default=5)
+    parser.add_argument('--send-workers', type=int, default=8)
+    parser.add_argument('--fetch-concurrency', type=int, default=16)
+    parser.add_argument('--state-dir',
+                        help='keep state in SQLite there, in memory if unset')
+    parser.add_argument('--output')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    log_listener = cian_logging.setup(stdout_level=args.log_level)
+
+    cian = FakeCian(args.urls, args.churn, args.cian_latency)
+    tg = FakeTelegram(args.tg_latency, args.tg_rate, args.tg_chat_rate,
+                      cian.published)
+    # Offers that are there before the bot starts aren't news
+    cian.start(prefill=args.urls * 5)
+    tg.start()
+
+    options = dict(
+        send_workers=args.send_workers,
+        photo_dir=tempfile.mkdtemp(prefix='loadtest-photos-'),
+        scheduler=cian_scheduler.PollScheduler(
+            min_interval=args.poll_seconds,
+            max_interval=args.poll_seconds * 4),
+        fetch_options=(aio.FetchOptions(concurrency=args.fetch_concurrency,
+                                        rps=1000)
+                       if args.fetch_concurrency > 0 else None))
+    if args.state_dir:
+        state = bot.CianBot.from_directory(args.state_dir, **options)
+    else:
+        state = bot.CianBot(**options)
+    state.filter_engine.default = cian_filters.ChatFilter(
+        max_price_per_room=None, metros=(), metro_blacklist=())
+    for search in range(args.urls):
+        state.add_observed_url(cian.url(search))
+    # Everything published so far is known before any chat joins
+    state.fetch_cian(None, state.scheduler.claim(list(state.polls)))
+    for chat_id in range(1, args.chats + 1):
+        state.add_chat(chat_id)
+    started = time.monotonic()
+    first_id = cian.next_id + 200000000
+    state.start_sending(
+        telegram.Bot('123:loadtest',
+                     base_url=f'{tg.server.base_url}/bot',
+                     request=Request(con_pool_size=args.send_workers + 4)))
+
+    backlog = []
+    running = threading.Event()
+    running.set()
+
+    def poll():
+        while running.is_set():
+            state.fetch_cian(None)
+            time.sleep(0.2)
+
+    poller = threading.Thread(target=poll, daemon=True)
+    poller.start()
+    deadline = started + args.duration
+    while time.monotonic() < deadline:
+        backlog.append((round(time.monotonic() - started, 1),
+                        state.sender.depth))
+        state.apply_send_outcomes(None)  # a JobQueue job in the bot
+        time.sleep(1)
+    cian.running = False
+    cian.thread.join()
+    running.clear()
+    poller.join()
+    # Offers published since a url's last poll would never be fetched and
+    # count as lost; one more poll of every url takes them in
+    state.fetch_cian(None, state.scheduler.claim(list(state.polls)))
+    drained = time.monotonic() + args.drain
+    while time.monotonic() < drained:
+        backlog.append((round(time.monotonic() - started, 1),
+                        state.sender.depth))
+        state.apply_send_outcomes(None)
+        if state.sender.depth == 0:
+            break
+        time.sleep(1)
+    elapsed = time.monotonic() - started
+    state.sender.stop()
+    state.apply_send_outcomes(None)
+    cian.stop()
+    tg.stop()
+
+    latencies = [
+        latency for (chat_id, offer_id), latency in tg.received.items()
+        if offer_id >= first_id
+    ]
+    n_published = cian.next_id + 200000000 - first_id
+    # Not on the first page of their search by the final poll, or missed
+    n_polled = sum(i in state.flatlist
+                   for i in range(first_id, first_id + n_published))
+    report = dict(
+        args=vars(args),
+        published=n_published,
+        polled=n_polled,
+        unpolled=n_published - n_polled,
+        expected_notifications=n_polled * args.chats,
+        notifications=len(latencies),
+        undelivered=n_polled * args.chats - len(latencies),
+        latency=percentiles(latencies),
+        elapsed=elapsed,
+        throughput=dict(
+            notifications_per_s=len(latencies) / elapsed,
+            api_calls_per_s=sum(tg.calls.values()) / elapsed,
+        ),
+        backlog=dict(max=max(b for _, b in backlog),
+                     final=state.sender.depth,
+                     samples=backlog),
+        telegram=dict(calls=dict(tg.calls), rejected_429=tg.rejected),
+        sender=dict(sent=state.sender.stats.sent,
+                    failed=state.sender.stats.failed,
+                    retry_after=state.sender.stats.retry_after,
+                    dropped=state.sender.stats.dropped,
+                    latency_avg=state.sender.stats.latency_avg),
+        cian_requests=cian.requests,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    state.photos.close()
+    state.store.close()
+    log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
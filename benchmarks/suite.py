@@ -0,0 +1,242 @@
+"""Offline benchmarks of parsing, filtering and fan-out, as JSON.
+
+    python benchmarks/suite.py [--offers 2000] [--chats 1000] \\
+        [--output results.json] [--compare previous.json]
+
+Runs on the pages checked in under benchmarks/fixtures/ and on search
+pages scaled up to --offers offers. Every page is synthetic, fixtures
+included: they are make_page and make_detail_page output, frozen so that
+runs compare, and they only follow the markup get_flatlist and get_flats
+expect. Numbers on real cian pages, with more fields per offer, differ.
+Every result is a flat "name": number entry, so two runs can be compared
+with --compare. Regenerate the fixtures with --write-fixtures."""
+import argparse
+import json
+import os.path as osp
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = osp.dirname(osp.dirname(osp.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cian_changes  # noqa: E402
+import cian_filters  # noqa: E402
+import cian_market  # noqa: E402
+import cian_parser  # noqa: E402
+from bench_flat_memory import measure  # noqa: E402
+from bench_get_flatlist import make_offer, make_page  # noqa: E402
+
+FIXTURES = osp.join(osp.dirname(osp.abspath(__file__)), 'fixtures')
+SEARCH_FIXTURE = osp.join(FIXTURES, 'search.html')
+DETAIL_FIXTURE = osp.join(FIXTURES, 'detail.html')
+
+
+def make_detail_page(seed=0):
+    """An offer card page, the way get_flats expects it"""
+    offer = make_offer(0, random.Random(seed))
+    state = {'offerData': {'offer': offer, 'offerId': offer['id']}}
+    return ('<html><head></head><body><script>'
+            'window._cianConfig["frontend-offer-card"]=[{"key":"defaultState",'
+            f'"value":{json.dumps(state, ensure_ascii=False)}}}];'
+            '</script></body></html>')
+
+
+def write_fixtures():
+    with open(SEARCH_FIXTURE, 'w') as f:
+        f.write(make_page(28))
+    with open(DETAIL_FIXTURE, 'w') as f:
+        f.write(make_detail_page())
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def best_of(repeat, run):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - t)
+    return best
+
+
+def bench_parse(results, name, html, repeat, slow=True):
+    n = len(cian_parser.get_flatlist(html))
+    t = best_of(repeat, lambda: cian_parser.get_flatlist(html))
+    results[f'parse.{name}.fast.offers_per_s'] = n / t
+    if slow:
+        t = best_of(max(1, repeat // 5),
+                    lambda: cian_parser.get_flatlist(html, fast=False))
+        results[f'parse.{name}.ast.offers_per_s'] = n / t
+
+
+def bench_detail(results, html, repeat):
+    import pyjsparser
+    script = next(s for s in cian_parser.SCRIPT_PATTERN.findall(html)
+                  if '"offerId"' in s)
+    t = best_of(repeat, lambda: pyjsparser.parse(script))
+    results['detail.pyjsparser.pages_per_s'] = 1 / t
+    js = pyjsparser.parse(script)
+    n_nodes = sum(1 for _ in cian_parser.js_traverse(js))
+    t = best_of(repeat, lambda: sum(1 for _ in cian_parser.js_traverse(js)))
+    results['detail.js_traverse.nodes_per_s'] = n_nodes / t
+    offer_data = next(
+        r['value'] for t, r in cian_parser.js_traverse(js)
+        if t == 'Property' and r['key'].get('value') == 'offerData')
+    t = best_of(repeat,
+                lambda: cian_parser.js_parse_object_expression(offer_data))
+    results['detail.js_parse_object_expression.per_s'] = 1 / t
+
+
+def bench_memory(results, html):
+    tracemalloc.start()
+    items = cian_parser.get_flatlist(html)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    results['memory.flatlistitem.peak_bytes'] = peak / len(items)
+    del items
+    # As bench_flat_memory: what's kept once the items are gone, so that
+    # strings a record shares with its item count against the record
+    results['memory.flatlistitem.kept_bytes'] = measure(
+        cian_parser.get_flatlist, html)
+    results['memory.flatrecord.kept_bytes'] = measure(
+        lambda html: [
+            cian_parser.FlatRecord.from_item(f)
+            for f in cian_parser.get_flatlist(html)
+        ], html)
+
+
+def random_filters(n, seed=0):
+    rnd = random.Random(seed)
+    return [
+        cian_filters.ChatFilter(
+            max_price_per_room=rnd.choice([None, 25000, 35000, 50000]),
+            metros=rnd.sample(cian_filters.METRO, rnd.randint(0, 6)))
+        for _ in range(n)
+    ]
+
+
+def bench_filters(results, flats, n_filters, repeat):
+    engine = cian_filters.FilterEngine()
+    for chat_id, f in enumerate(random_filters(n_filters)):
+        engine.set(chat_id, f)
+    chats = list(range(n_filters))
+    t = best_of(repeat, lambda: list(engine.route(flats, chats)))
+    results['filter.route.evaluations_per_s'] = len(flats) * n_filters / t
+
+
+def bench_fanout(results, n_offers, n_chats, repeat):
+    import bot
+    state = bot.CianBot()
+    state.photos.prefetch = lambda urls: None  # no network here
+    state.filter_engine.default = cian_filters.ChatFilter(
+        max_price_per_room=None, metros=(), metro_blacklist=())
+    for chat_id in range(1, n_chats + 1):
+        state.add_chat(chat_id)
+    best = float('inf')
+    for run in range(repeat):
+        rnd = random.Random(run)
+        offset = run * n_offers
+        items = [
+            cian_parser.ParsedFlat.from_item(
+                cian_parser.offer_to_flatlistitem(
+                    make_offer(offset + i, rnd)), cian_changes.offer_hash)
+            for i in range(n_offers)
+        ]
+        t = time.perf_counter()
+        state.handle_new_flats(items)
+        best = min(best, time.perf_counter() - t)
+    results['fanout.handle_new_flats.flats_per_s'] = n_offers / best
+    results['fanout.handle_new_flats.targets_per_s'] = (n_offers * n_chats /
+                                                         best)
+
+
+def bench_market(results, n_flats, repeat):
+    market = cian_market.snapshot()
+    if not isinstance(market, cian_market.MarketSnapshot):
+        return
+    rnd = random.Random(0)
+    now = time.time()
+    flats = [
+        cian_parser.FlatRecord.from_item(
+            cian_parser.offer_to_flatlistitem(make_offer(i, rnd)))
+        for i in range(min(n_flats, 5000))
+    ]
+    t = time.perf_counter()
+    for i in range(n_flats):
+        flat = flats[i % len(flats)]
+        market.reserve(1)
+        market.append(i, flat.price, flat.rooms, flat.deposit, flat.fee,
+                      flat.payment_period,
+                      flat.metros[0] if flat.metros else None,
+                      now - rnd.random() * 90 * 24 * 60 * 60)
+    results['market.add.flats_per_s'] = n_flats / (time.perf_counter() - t)
+    t = best_of(repeat, market.summary)
+    results['market.summary.flats_per_s'] = n_flats / t
+    t = best_of(repeat, lambda: market.summary(7))
+    results['market.summary_7d.per_s'] = 1 / t
+
+
+def compare(results, previous):
+    for name in sorted(results):
+        if name in previous and previous[name]:
+            ratio = results[name] / previous[name]
+            print(f'{name}: {previous[name]:.4g} -> {results[name]:.4g} '
+                  f'(x{ratio:.2f})',
+                  file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser('bench_suite')
+    parser.add_argument('--offers', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--filters', type=int, default=50)
+    parser.add_argument('--market-flats', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--write-fixtures', action='store_true')
+    args = parser.parse_args()
+
+    if args.write_fixtures:
+        write_fixtures()
+        return
+
+    results = dict()
+    synthetic = make_page(args.offers)
+    bench_parse(results, 'fixture', read(SEARCH_FIXTURE), args.repeat)
+    bench_parse(results, f'synthetic{args.offers}', synthetic, args.repeat,
+                slow=args.offers <= 5000)
+    bench_detail(results, read(DETAIL_FIXTURE), args.repeat)
+    bench_memory(results, synthetic)
+    flats = [
+        cian_parser.FlatRecord.from_item(f)
+        for f in cian_parser.get_flatlist(synthetic)
+    ]
+    bench_filters(results, flats, args.filters, args.repeat)
+    bench_fanout(results, 28, args.chats, args.repeat)
+    bench_market(results, args.market_flats, args.repeat)
+
+    report = dict(meta=dict(python=platform.python_version(),
+                            platform=platform.platform(),
+                            time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            args=vars(args)),
+                  results=results)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
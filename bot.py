@@ -1,160 +1,672 @@
 import argparse
+import array
 import collections
-import copy
+import collections.abc
+import concurrent.futures
 import datetime
-import hashlib
+import functools
 import io
 import itertools
 import json
 import logging
+import multiprocessing
 import os
 import os.path as osp
-from contextlib import ExitStack
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from urllib.parse import urlparse
 
 import attr
-import requests
 
+import cian_changes
+import cian_dedup
+import cian_details
+import cian_filters
+import cian_logging
+import cian_market
+import cian_metrics
 import cian_parser
-from cian_parser import get_flats
+import cian_photos
+import cian_queue
+import cian_retention
+import cian_scheduler
+import cian_sender
+import cian_store
+from cian_parser import aio, get_flats, queries
 from telegram import InputFile, InputMediaPhoto
 from telegram.ext import CommandHandler, Updater
 
+STARTED_AT = time.monotonic()
+
 logger = logging.getLogger('cian_bot')
-logger.setLevel(logging.DEBUG)
-log_to_file = logging.FileHandler('cian_bot.log')
-log_to_file.setLevel(logging.DEBUG)
-logger.addHandler(log_to_file)
-log_to_stdout = logging.StreamHandler()
-log_to_stdout.setLevel(logging.INFO)
-logger.addHandler(log_to_stdout)
 
 SAVE_FILE = 'save.json'
 N_PHOTOS_MAX = 4
+# all: one process; fetcher and notifier: see cian_queue
+ROLES = ('all', 'fetcher', 'notifier')
+# Queued events handled at once
+EVENT_BATCH = 500
+# Seconds between looking for due urls and commands in the fetcher
+FETCHER_TICK = 5
 
-METRO = [
-    'Достоевская',
-    'Проспект Мира',
-    'Сухаревская',
-    'Цветной бульвар',
-    'Трубная',
-    'Чеховская',
-    'Пушкинская',
-    'Кузнецкий мост',
-    'Лубянка',
-    'Чистые пруды',
-    'Красные Ворота',
-    'Тургеневская',
-    'Сретенский бульвар',
-    'Китай-город',
-    'Китай Город',
-    'Чкаловская',
-    'Маяковская',
-    'Белорусская',
-    'Менделеевская',
-    'Новослободская',
-]
-METRO = [m.lower() for m in METRO]
-METRO_BLACKLIST = [
-    'Электрозаводская', 'Солнцево', 'Косино', 'Новогиреево', 'Выхино'
-]
-METRO_BLACKLIST = [m.lower() for m in METRO_BLACKLIST]
-
-
-def filter_price_per_person(flat):
-    ppp = flat.price / flat.rooms
-    if ppp > 35000:
-        logger.debug(
-            f'Flat {flat.id} failed price test: price={flat.price}, rooms={flat.rooms}'
-        )
-    return ppp <= 35000
-
-
-def filter_metro(flat):
-    ok = any(m.lower() in METRO
-             for m in flat.metros) and not any(m.lower() in METRO_BLACKLIST
-                                               for m in flat.metros)
-    if not ok:
-        logger.debug(
-            f'Flat {flat.id} failed metro test. Metros: {flat.metros}')
-    return ok
-
-
-def filter_monthly(flat):
-    try:
-        return flat.json['bargainTerms']['paymentPeriod'] == 'monthly'
-    except:
-        return True
-
-
-def fetch_file(url):
-    # aye, it doesnt depend on basedir, i know
-    for i in range(5):
-        try:
-            if not osp.exists('photos'):
-                os.mkdir('photos')
-            filename = hashlib.sha256(url.encode('utf8')).hexdigest()
-            filename = osp.join('photos', filename)
-            if not osp.exists(filename):
-                res = requests.get(url)
-                with open(filename, 'wb') as out:
-                    for chunk in res.iter_content(chunk_size=1024):
-                        out.write(chunk)
-            return filename
-        except Exception as e:
-            logger.error(f'fetch_file: url={url} e={e}')
+METRICS = cian_metrics.REGISTRY
+FETCH_SECONDS = METRICS.histogram('cian_fetch_seconds',
+                                  'HTTP time per search page')
+FETCH_PAGES = METRICS.counter('cian_fetch_pages_total',
+                              'Search pages fetched, by status and outcome')
+PARSE_SECONDS = METRICS.histogram(
+    'cian_parse_seconds',
+    'Time to parse a page, including the wait for a parse_pool worker')
+PAGE_OFFERS = METRICS.histogram('cian_page_offers',
+                                'Offers per parsed page',
+                                buckets=(0, 1, 5, 10, 20, 28, 50, 100))
+HANDLE_SECONDS = METRICS.histogram('cian_handle_new_flats_seconds',
+                                   'Time handle_new_flats takes per batch')
+FLATS = METRICS.counter('cian_flats_total', 'Flats crawled, by outcome')
+SCHEDULED = METRICS.counter('cian_scheduled_total',
+                            'Messages scheduled, by kind')
+TARGETS = METRICS.counter('cian_scheduled_targets_total',
+                          'Chats messages are scheduled to, by kind')
 
 
 @attr.s
 class CianStateSerializable:
-    """CianStateSerializable:
-    TODO: just add in fucking mongo you lazy hog, it'll be more usable and reusable"""
+    """The state.json we used to dump everything into before cian_store;
+    only read now, to migrate old state dirs"""
     flatlist = attr.ib(type=dict)
     flat_details = attr.ib(type=dict)
     viewed = attr.ib(type=dict)
     observed_urls = attr.ib(type=list)
     scheduled_messages = attr.ib(type=list)
+    fetch_cache = attr.ib(type=dict, factory=dict)
+
+
+@attr.s
+class FetchCacheEntry:
+    """What we saw last time at some url, plus hit/miss counts"""
+    etag = attr.ib(default=None)
+    last_modified = attr.ib(default=None)
+    digest = attr.ib(default=None)
+    hits = attr.ib(type=int, default=0)
+    misses = attr.ib(type=int, default=0)
+    ids = attr.ib(factory=list)  # of the flats on the page
+
+    def conditional_headers(self):
+        headers = dict()
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+@attr.s(slots=True)
+class OutboxEntry:
+    """A message rendered once per flat, shared by every chat it goes to;
+    never mutated after scheduling"""
+    msg = attr.ib(type=dict)
+    chat_ids = attr.ib(converter=lambda ids: array.array('q', ids))
+    outbox_id = attr.ib(default=None)
+
+
+class LazyFlatList(collections.abc.MutableMapping):
+    """flat_id -> FlatRecord. Only the ids are known upfront,
+    records are read with `hydrate(flat_id)` when first accessed"""
+
+    def __init__(self, hydrate):
+        self.hydrate = hydrate
+        self.records = dict()  # flat_id -> FlatRecord or None
+
+    def add_ids(self, ids):
+        self.records.update(dict.fromkeys(ids))
+
+    def __getitem__(self, flat_id):
+        flat = self.records[flat_id]
+        if flat is None:
+            flat = self.records[flat_id] = self.hydrate(flat_id)
+        return flat
+
+    def __setitem__(self, flat_id, flat):
+        self.records[flat_id] = flat
+
+    def __delitem__(self, flat_id):
+        del self.records[flat_id]
+
+    def __contains__(self, flat_id):
+        return flat_id in self.records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
 
 
 class CianBot:
-    def __init__(self):
-        self.flatlist = dict()
-        self.flat_details = dict()
-        self.viewed = collections.defaultdict(set)  # chat_id -> set[int]
-        self.scheduled_messages = collections.deque()
+    def __init__(self,
+                 parse_workers=0,
+                 fetch_options=None,
+                 max_pages=1,
+                 store=None,
+                 send_workers=4,
+                 photo_dir='photos',
+                 photo_cache_bytes=512 * 2**20,
+                 scheduler=None,
+                 flat_ttl=None,
+                 admins=(),
+                 role='all',
+                 queue=None,
+                 detail_ttl=cian_details.TTL,
+                 detail_batch=cian_details.BATCH):
+        self.flatlist = LazyFlatList(self.load_flat)
+        self.flat_log = array.array('q')  # flat ids in the order we got them
+        self.cursors = dict()  # chat_id -> how much of flat_log it's seen
+        # chat_id -> cian_retention.ViewedSet, of the subscribed chats
+        self.viewed = dict()
+        self.last_seen = dict()  # flat_id -> when a crawl last saw it
+        self.flat_ttl = flat_ttl  # seconds, None means keep forever
+        self.fingerprints = cian_dedup.FingerprintIndex()
+        self.duplicates = dict()  # flat_id -> id of the flat it's a copy of
+        self.offer_hashes = dict()  # flat_id -> cian_changes.offer_hash
+        # Received from the fetcher but not routed yet, see consume_events;
+        # stored along with the flats
+        self.unrouted = set()
+        # Ids of evicted flats; chats may have got them, so they aren't
+        # routed again if they come back
+        self.evicted = cian_retention.ViewedSet()
+        # Held by whatever changes the flats, flat_log or the chats, so that
+        # no thread iterates them mid-change: crawled pages, evictions,
+        # queued events, commands and the sender's outcomes. Taken before
+        # a store transaction, never inside one; see locked() for what
+        # needs the indexes.
+        self.lock = threading.RLock()
+        # Whether viewed, fingerprints, offer_hashes, price_history and
+        # last_seen are in memory; load() leaves them to load_indexes
+        self.indexes_loaded = True
+        self.price_history = cian_changes.PriceHistory()
+        # Columns for /market, built by load_market: numpy and reading
+        # every stored flat would take a good part of the start
+        self.market = cian_market.NullSnapshot()
+        self.market_loaded = False
         self.observed_urls = list()
+        # url we fetch -> (queries.SearchQuery, ...) of the observed urls
+        # it stands for, see queries.coalesce
+        self.polls = dict()
+        self.fetch_cache = dict()  # url -> FetchCacheEntry
+        # Not forked: a child of this process, with its sender, store and
+        # logging threads, could inherit a lock one of them holds
+        self.parse_pool = (concurrent.futures.ProcessPoolExecutor(
+            parse_workers, mp_context=multiprocessing.get_context(
+                'forkserver' if 'forkserver' in
+                multiprocessing.get_all_start_methods() else 'spawn'))
+                           if parse_workers > 0 else None)
+        self.fetch_options = fetch_options  # None means one by one
+        self.max_pages = max_pages
+        self.scheduler = (scheduler if scheduler is not None else
+                          cian_scheduler.PollScheduler())
+        self.polled = False
+        self.store = store if store is not None else cian_store.NullStore()
+        # Paces the crawl and detail pages together, per host
+        self.limiter = aio.HostRateLimiter(
+            (fetch_options or aio.FetchOptions()).rps)
+        # Fetched for flats that passed somebody's filters, once started
+        self.flat_details = cian_details.DetailCache(
+            self.store,
+            fetch_options,
+            ttl=detail_ttl,
+            batch=detail_batch,
+            parse_pool=self.parse_pool,
+            limiter=self.limiter,
+            fetched=self.details_fetched)
+        self.filter_engine = cian_filters.FilterEngine()
+        self.photos = cian_photos.PhotoCache(photo_dir,
+                                             self.store,
+                                             max_bytes=photo_cache_bytes)
+        self.bot = None
+        self.sender = cian_sender.Sender(self.deliver,
+                                         self.delivered,
+                                         workers=send_workers,
+                                         on_dropped=self.dropped)
+        # ([outbox_id], chat_id, chat gone) from the sender's threads, see
+        # apply_send_outcomes
+        self.send_outcomes = collections.deque()
+        self.admins = frozenset(admins)  # chats allowed /stats and such
+        self.role = role
+        self.queue = queue  # cian_queue.DurableQueue, unless role is all
+        self.profiler = cian_metrics.SamplingProfiler()
+        METRICS.gauge('cian_outbox_depth', 'Deliveries waiting to be sent',
+                      lambda: self.sender.depth)
+        METRICS.gauge('cian_flats', 'Flats known', lambda: len(self.flatlist))
+        METRICS.gauge('cian_chats', 'Chats', lambda: len(self.viewed))
+        METRICS.gauge('cian_observed_urls', 'Observed urls',
+                      lambda: len(self.observed_urls))
+        if queue is not None:
+            METRICS.gauge('cian_queue_crawl_depth',
+                          'Crawl events the notifier has not acked',
+                          lambda: queue.depth(cian_queue.CRAWL))
 
-    @property
-    def filters(self):
-        return [filter_price_per_person, filter_metro, filter_monthly]
-
-    def save(self, basepath):
+    @staticmethod
+    def from_directory(basepath, **kwargs):
         if not osp.exists(basepath):
             os.makedirs(basepath)
-        with open(osp.join(basepath, 'state.json'), 'w') as f:
-            json.dump(
-                attr.asdict(
-                    CianStateSerializable(
-                        flatlist=self.flatlist,
-                        flat_details=self.flat_details,
-                        viewed=self.viewed,
-                        scheduled_messages=list(self.scheduled_messages),
-                        observed_urls=self.observed_urls)), f)
-
-    @staticmethod
-    def from_directory(basepath):
-        self = CianBot()
-        with open(osp.join(basepath, 'state.json'), 'r') as f:
-            state = json.load(f)
-        self.flatlist.update(state['flatlist'])
-        self.flat_details.update(state['flat_details'])
-        self.viewed.update({a: set(b) for a, b in state['viewed'].items()})
-        self.scheduled_messages.extend(state['scheduled_messages'])
-        self.observed_urls.extend(state['observed_urls'])
-        logger.info(f'from_directory: loaded {len(state["flatlist"])} flatlistitems, {len(state["scheduled_messages"])} scheduled messages, {len(state["observed_urls"])} observed urls')
+        db_path = osp.join(basepath, cian_store.DB_FILE)
+        json_path = osp.join(basepath, 'state.json')
+        migrate = not osp.exists(db_path) and osp.exists(json_path)
+        kwargs.setdefault('photo_dir', osp.join(basepath, 'photos'))
+        started = time.monotonic()
+        self = CianBot(store=cian_store.SqliteStore(db_path), **kwargs)
+        if migrate:
+            self.migrate_json(json_path)
+        else:
+            self.load()
+        logger.info(f'from_directory: loaded {len(self.flatlist)} flatlistitems, {self.n_scheduled_messages} scheduled messages, {len(self.observed_urls)} observed urls in {time.monotonic() - started:.2f}s')
         return self
 
+    def load(self):
+        """Loads what's needed to answer commands; the indexes wait for
+        load_indexes, flat records for their first access (load_flat)"""
+        self.flatlist.add_ids(self.store.flat_ids())
+        self.flat_log.extend(i for i in self.store.flat_log()
+                             if i in self.flatlist)
+        logged = set(self.flat_log)
+        for i in self.flatlist:
+            if i not in logged:
+                self.log_flat(i)
+        self.cursors.update(self.store.cursors())
+        self.flat_details.load(self.store.flat_details())
+        self.duplicates.update(self.store.duplicates())
+        self.evicted = cian_retention.ViewedSet(self.store.evicted_ids())
+        self.unrouted.update(i for i in self.store.unrouted()
+                             if i in self.flatlist)
+        # They grow with the history, and only routing, crawls and
+        # retention need them
+        self.indexes_loaded = False
+        for outbox_id, msg, chat_ids in self.store.outbox():
+            self.sender.submit(OutboxEntry(msg, chat_ids, outbox_id))
+        self.observed_urls.extend(self.store.observed_urls())
+        # Spread the first polls instead of fetching everything at once
+        self.update_polls(self.store.poll_schedules(),
+                          spread=self.scheduler.min_interval *
+                          self.scheduler.jitter)
+        self.fetch_cache.update((url, FetchCacheEntry(**e))
+                                for url, e in self.store.fetch_cache())
+        for chat_id, f in self.store.chat_filters():
+            self.filter_engine.set(chat_id, cian_filters.ChatFilter(**f))
+        self.photos.load()
+
+    def load_indexes(self, context=None):
+        """Reads in what load() left out, once. Whatever was written before
+        is in the store already, so the store's rows replace it."""
+        with self.lock:
+            if self.indexes_loaded:
+                return
+            started = time.monotonic()
+            self.viewed = {
+                chat_id: cian_retention.ViewedSet(ids)
+                for chat_id, ids in self.store.viewed().items()
+            }
+            self.fingerprints = cian_dedup.FingerprintIndex()
+            self.fingerprints.load(self.store.fingerprints())
+            self.offer_hashes = dict(self.store.offer_hashes())
+            self.price_history = cian_changes.PriceHistory()
+            self.price_history.load(self.store.price_changes())
+            self.last_seen = dict(self.store.last_seen())
+            with self.store.transaction():
+                # Stored before we kept track, give them a full ttl
+                self.touch_flats(
+                    [i for i in self.flatlist if i not in self.last_seen])
+            self.indexes_loaded = True
+        logger.info(f'load_indexes: loaded in '
+                    f'{time.monotonic() - started:.2f}s')
+
+    @contextmanager
+    def locked(self):
+        """self.lock, with the indexes loaded"""
+        with self.lock:
+            self.load_indexes()
+            yield
+
+    def load_flat(self, flat_id):
+        f = self.store.get_flat(flat_id)
+        if 'json' in f:
+            # Stored before FlatRecord, move the offer out of the row
+            item = cian_parser.FlatListItem(**f)
+            with self.store.transaction():
+                return self.store_flat(cian_parser.ParsedFlat.from_item(item))
+        return cian_parser.FlatRecord(**f)
+
+    def migrate_json(self, path):
+        logger.info(f'migrate_json: importing {path} into {self.store.path}')
+        with open(path, 'r') as f:
+            state = CianStateSerializable(**json.load(f))
+        with self.store.transaction():
+            self.import_state(state)
+        os.rename(path, path + '.migrated')
+
+    def import_state(self, state):
+        """Writes a CianStateSerializable through, as if it was crawled"""
+        for f in state.flatlist.values():
+            self.add_flat(
+                cian_parser.ParsedFlat.from_item(cian_parser.FlatListItem(**f),
+                                                 cian_changes.offer_hash))
+        for i, details in state.flat_details.items():
+            self.store.put_flat_details(int(i), details)
+        for chat_id, flat_ids in state.viewed.items():
+            self.add_chat(int(chat_id))
+            for i in flat_ids:
+                self.mark_viewed(int(chat_id), i)
+        for msg in state.scheduled_messages:
+            msg = dict(msg)
+            self.schedule(msg, [msg.pop('chat_id')])
+        for url in state.observed_urls:
+            self.add_observed_url(url)
+        for url, e in state.fetch_cache.items():
+            self.fetch_cache[url] = FetchCacheEntry(**e)
+            self.store.put_fetch_cache(url, e)
+
+    def add_flat(self, item):
+        is_new = item.id not in self.flatlist
+        if is_new:
+            self.log_flat(item.id)
+        flat = self.store_flat(item)
+        self.flatlist[flat.id] = flat
+        if is_new:
+            self.index_flat(flat, item.floor)
+            self.set_offer_hash(flat.id, item.offer_hash)
+            self.first_seen(flat)
+        return flat
+
+    def first_seen(self, flat):
+        at = time.time()
+        self.store.put_first_seen(flat.id, at)
+        if flat.id not in self.duplicates:
+            # A copy isn't another flat on the market
+            self.market.add(flat, at)
+
+    def set_offer_hash(self, flat_id, offer_hash):
+        self.offer_hashes[flat_id] = offer_hash
+        self.store.put_offer_hash(flat_id, offer_hash)
+
+    def update_flat(self, item):
+        """Stores a known flat again if its offer changed;
+        returns the changes"""
+        offer_hash = item.offer_hash
+        old_hash = self.offer_hashes.get(item.id)
+        if offer_hash == old_hash:
+            return []
+        self.set_offer_hash(item.id, offer_hash)
+        old = self.store.get_offer(item.id)
+        before = self.flatlist[item.id]
+        flat = self.flatlist[item.id] = self.store_flat(item)
+        self.market.update(flat)
+        if flat.price != before.price:
+            at = time.time()
+            self.price_history.record(flat.id, at, before.price, flat.price)
+            self.store.add_price_change(flat.id, at, before.price,
+                                        flat.price)
+        if old_hash is None or not old:
+            # Stored before offers were hashed, whatever changed might
+            # have changed long ago: store it, but don't tell the chats
+            return []
+        return cian_changes.diff_offers(old, item.offer())
+
+    def index_flat(self, flat, floor):
+        original = self.fingerprints.match(flat, floor)
+        if original is not None:
+            original = self.duplicates.get(original, original)
+            self.duplicates[flat.id] = original
+            self.store.put_duplicate(flat.id, original)
+            logger.debug('index_flat: %s is a copy of %s',
+                         flat.id,
+                         original,
+                         extra=dict(flat_id=flat.id, original_id=original))
+        self.store.put_fingerprints(self.fingerprints.add(flat, floor))
+
+    def store_flat(self, item):
+        flat = item.record
+        self.store.put_flat(flat.id, attr.asdict(flat))
+        self.store.put_offer(flat.id, item.offer())
+        return flat
+
+    def touch_flats(self, flat_ids):
+        now = int(time.time())
+        rows = [(i, now) for i in flat_ids]
+        self.last_seen.update(rows)
+        self.store.put_last_seen(rows)
+
+    def evict_stale(self):
+        """Forgets flats no crawl has seen for flat_ttl"""
+        if self.flat_ttl is None:
+            return
+        cutoff = time.time() - self.flat_ttl
+        with self.locked():
+            stale = [i for i, at in self.last_seen.items() if at < cutoff]
+            if stale:
+                self.evict_flats(stale)
+        if stale:
+            logger.info(f'evict_stale: evicted {len(stale)} flats, '
+                        f'{len(self.flatlist)} left')
+
+    def evict_flats(self, flat_ids):
+        with self.locked(), self.store.transaction():
+            self._evict_flats(set(flat_ids))
+
+    def _evict_flats(self, flat_ids):
+        for i in flat_ids:
+            self.evicted.add(i)
+            if i in self.flatlist:
+                del self.flatlist[i]  # pop() would read it in first
+            self.last_seen.pop(i, None)
+            self.offer_hashes.pop(i, None)
+            self.price_history.columns.pop(i, None)
+        self.unrouted -= flat_ids
+        self.duplicates = {
+            i: original
+            for i, original in self.duplicates.items()
+            if i not in flat_ids and original not in flat_ids
+        }
+        self.fingerprints.drop(flat_ids)
+        self.flat_details.discard(flat_ids)
+        self.market.drop(flat_ids)
+        for viewed in self.viewed.values():
+            viewed.discard_all(flat_ids)
+        # Compact the log, moving every cursor to the same flat as before
+        marks = sorted(set(self.cursors.values()))
+        moved = dict()
+        log = array.array('q')
+        for position, flat_id in enumerate(self.flat_log):
+            while len(moved) < len(marks) and marks[len(moved)] == position:
+                moved[position] = len(log)
+            if flat_id not in flat_ids:
+                log.append(flat_id)
+        for m in marks[len(moved):]:
+            moved[m] = len(log)
+        self.flat_log = log
+        # Verdicts are per position, which have just changed
+        self.filter_engine.verdicts.clear()
+        self.store.evict_flats(flat_ids)
+        self.set_cursors({u: moved[c] for u, c in self.cursors.items()})
+        if self.role == 'fetcher':
+            self.queue.put(cian_queue.CRAWL,
+                           [dict(kind='evict', ids=sorted(flat_ids))])
+
+    def retention_job(self, context):
+        # The notifier evicts what the fetcher tells it to
+        if self.role != 'notifier':
+            self.evict_stale()
+        n_expired = self.flat_details.expire()
+        if n_expired > 0:
+            logger.info(f'retention_job: {n_expired} flat details expired')
+        logger.info(f'retention_job: state is\n{self.state_report()}')
+
+    def state_report(self):
+        with self.sender.cond:
+            outbox = {u: list(q) for u, q in self.sender.queues.items()}
+        with self.photos.lock:
+            photos = (dict(self.photos.urls), dict(self.photos.blobs))
+        with self.flat_details.cond:
+            flat_details = dict(self.flat_details.entries)
+        components = {
+            'flatlist': self.flatlist.records,
+            'flat_log': self.flat_log,
+            'viewed': self.viewed,
+            'last_seen': self.last_seen,
+            'evicted': self.evicted,
+            'flat_details': flat_details,
+            'fingerprints': self.fingerprints.keys,
+            'duplicates': self.duplicates,
+            'offer_hashes': self.offer_hashes,
+            'price_history': self.price_history.columns,
+            'market': getattr(self.market, 'columns', None),
+            'filter_verdicts': self.filter_engine.verdicts,
+            'fetch_cache': self.fetch_cache,
+            'outbox': outbox,
+            'photos': photos,
+        }
+        with self.locked():
+            return cian_retention.state_report(components,
+                                               self.store.table_sizes())
+
+    def is_admin(self, update):
+        chat_id = update.message.chat_id
+        if chat_id in self.admins:
+            return True
+        logger.error(f'is_admin: {chat_id} is not an admin')
+        update.message.reply_text('Only for admins, see --admin')
+        return False
+
+    def report_state(self, update, context):
+        if self.is_admin(update):
+            update.message.reply_text(self.state_report())
+
+    def stats(self, update, context):
+        if self.is_admin(update):
+            update.message.reply_text(METRICS.summary())
+
+    def load_market(self, context=None):
+        """Builds the /market snapshot out of the stored flats, once. Under
+        the lock, so that no flat is crawled between reading the rows and
+        the snapshot taking over."""
+        with self.lock:
+            if self.market_loaded:
+                return
+            started = time.monotonic()
+            market = cian_market.snapshot()
+            market.load(row for row in self.store.market_rows()
+                        if row[0] not in self.duplicates)
+            self.market, self.market_loaded = market, True
+        logger.info(f'load_market: loaded in '
+                    f'{time.monotonic() - started:.2f}s')
+
+    def market_summary(self, update, context):
+        """/market [days]: prices of the flats first seen in the last
+        `days` days, of every flat we know without it"""
+        try:
+            days = float(context.args[0]) if context.args else None
+        except ValueError:
+            update.message.reply_text('Synopsis: /market [days]')
+            return
+        self.load_market()
+        update.message.reply_text(self.market.summary(days))
+
+    def profile(self, update, context):
+        """/profile on starts sampling stacks, /profile off stops it,
+        replies with the top functions and saves the collapsed stacks"""
+        if not self.is_admin(update):
+            return
+        arg = context.args[0] if context.args else ''
+        if arg == 'on':
+            started = self.profiler.start()
+            update.message.reply_text(
+                'Profiling' if started else 'Already profiling')
+        elif arg == 'off':
+            if not self.profiler.stop():
+                update.message.reply_text('Not profiling')
+                return
+            path = f'profile-{int(time.time())}.txt'
+            with open(path, 'w') as f:
+                f.write(self.profiler.collapsed())
+            update.message.reply_text(
+                f'{self.profiler.top()}\nStacks saved to {path}')
+        else:
+            update.message.reply_text('Synopsis: /profile on|off')
+
+    def log_flat(self, flat_id):
+        self.flat_log.append(flat_id)
+        self.store.log_flat(flat_id)
+
+    def add_chat(self, chat_id):
+        self.viewed[chat_id] = cian_retention.ViewedSet()
+        self.store.add_chat(chat_id)
+        self.set_cursors({chat_id: 0})
+
+    def set_cursors(self, cursors):
+        self.cursors.update(cursors)
+        self.store.put_cursors(cursors.items())
+
+    def remove_chat(self, chat_id):
+        """Unsubscribes a chat that blocked the bot or is gone; its filter
+        is kept for when it comes back with /start"""
+        logger.info(f'remove_chat: {chat_id} is gone, unsubscribing it')
+        self.viewed.pop(chat_id, None)
+        self.cursors.pop(chat_id, None)
+        self.store.remove_chat(chat_id)
+
+    def seen(self, chat_id, flat_id):
+        """Whether the chat got this flat or the one it's a copy of"""
+        viewed = self.viewed.get(chat_id, ())
+        original = self.duplicates.get(flat_id)
+        return flat_id in viewed or original is not None and original in viewed
+
+    def mark_viewed(self, chat_id, flat_id):
+        self.viewed[chat_id].add(flat_id)
+        self.store.add_viewed(chat_id, flat_id)
+
+    def schedule(self, msg, chat_ids, kind='flat'):
+        SCHEDULED.inc(kind=kind)
+        TARGETS.inc(len(chat_ids), kind=kind)
+        self.sender.submit(
+            OutboxEntry(msg, chat_ids, self.store.push_message(msg, chat_ids)))
+
+    @property
+    def n_scheduled_messages(self):
+        return self.sender.depth
+
+    def add_observed_url(self, url):
+        if url in self.observed_urls:
+            return
+        self.observed_urls = sorted(set(self.observed_urls + [url]))
+        self.store.add_observed_url(url)
+        self.update_polls()
+
+    def update_polls(self, schedules=(), spread=0.0):
+        """Coalesces observed urls into the urls to poll and (un)schedules
+        those that changed; `schedules` are what poll_schedules stored"""
+        # One page of a merged url has fewer flats of each search than a
+        # page of its own would
+        polls = queries.coalesce(self.observed_urls,
+                                 merge_queries=self.max_pages > 1)
+        for url in self.polls.keys() - polls.keys():
+            self.scheduler.remove(url)
+        schedules = dict(schedules)
+        for url in polls.keys() - self.polls.keys():
+            self.scheduler.add(url, random.uniform(0, spread),
+                               **schedules.get(url, {}))
+        self.polls = polls
+        logger.info(f'update_polls: {len(self.observed_urls)} observed urls '
+                    f'are polled as {len(polls)}')
+
+    def poll_url(self, url):
+        """The url we fetch to find what `url` finds"""
+        query = queries.SearchQuery.from_url(url)
+        return next((p for p, qs in self.polls.items() if query in qs),
+                    None)
+
     def start(self, update, context):
-        self.viewed[update.message.chat_id] = set()
+        with self.lock, self.store.transaction():
+            self.add_chat(update.message.chat_id)
         logger.info(f'{update.message.chat_id} connected')
 
     def flat_to_message(self, flat):
@@ -167,13 +679,13 @@ class CianBot:
                     if getattr(flat, k.lower())
                 ]),
                 f'{flat.bedrooms} rooms',
-                f'{flat.metros}',
+                f'{list(flat.metros)}',
                 f'{flat.address}',
-                ' '.join(cian_parser.js_offer_to_phones(flat.json)),
+                ' '.join(flat.phones),
             ])
-            msg = dict(text=text)
+            msg = dict(text=text, flat_id=flat.id)
             if len(flat.photos) > 0:
-                msg['photos'] = flat.photos
+                msg['photos'] = list(flat.photos)
                 msg['photo'] = flat.photos[0]
                 msg['document'] = flat.pdf_link
             return msg
@@ -181,135 +693,619 @@ class CianBot:
             logger.error(f'flat_to_msg: {e}')
             raise e
 
-    def flat_ok(self, flat):
-        for f in self.filters:
-            if not f(flat):
-                logger.debug(f'Flat {flat.id} couldn\'t pass {f.__name__}.')
-                return False
-        return True
+    def handle_new_flat(self, item: cian_parser.ParsedFlat):
+        self.handle_new_flats([item])
+
+    def handle_new_flats(self, items):
+        with HANDLE_SECONDS.time():
+            self._handle_new_flats(items)
 
-    def handle_new_flat(self, flat: cian_parser.FlatListItem):
-        if flat.id in self.flatlist:
+    def _handle_new_flats(self, items):
+        n_logged = len(self.flat_log)
+        self.touch_flats([item.id for item in items])
+        new_flats, changed = [], []
+        for item in items:
+            if item.id in self.flatlist:
+                changes = self.update_flat(item)
+                if changes:
+                    FLATS.inc(outcome='changed')
+                    changed.append((item.id, changes))
+                continue
+            new_flats.append(self.add_flat(item))
+        FLATS.inc(len(items) - len(new_flats), outcome='known')
+        FLATS.inc(len(new_flats), outcome='new')
+        if self.role == 'fetcher':
+            # add_flat has decoded the offers of new flats already
+            new_ids = {flat.id for flat in new_flats}
+            offers = {
+                item.id: item.offer()
+                for item in items if item.id in new_ids
+            }
+            self.publish(new_flats, offers, changed)
             return
+        for flat_id, changes in changed:
+            self.notify_changes(flat_id, changes)
+        self.route_flats(new_flats, n_logged)
+
+    def route_flats(self, new_flats, n_logged):
+        """Schedules new flats to the chats whose filters they pass;
+        `n_logged` is the length of flat_log before they were logged"""
+        n_copies = 0
+        routed = []
+        # Back after an eviction, which forgot who got them
+        new_flats = [f for f in new_flats if f.id not in self.evicted]
+        for flat, chats in self.filter_engine.route(new_flats,
+                                                    list(self.viewed)):
+            chats = [u for u in chats if not self.seen(u, flat.id)]
+            if len(chats) == 0:
+                n_copies += flat.id in self.duplicates
+                continue
+            if len(flat.photos) >= 2:
+                self.photos.prefetch(flat.photos[:N_PHOTOS_MAX])
+            routed.append(flat)
+            self.schedule(self.flat_to_message(flat), chats)
+            for u in chats:
+                self.mark_viewed(u, flat.id)
+        self.request_details(routed)
+        FLATS.inc(n_copies, outcome='copy')
+        if n_copies > 0:
+            logger.info(f'handle_new_flats: {n_copies} relisted or '
+                        'duplicate flats suppressed')
+        # Chats that were up to date have just been routed everything new
+        self.set_cursors({
+            u: len(self.flat_log)
+            for u in self.viewed if self.cursors.get(u, 0) == n_logged
+            and n_logged != len(self.flat_log)
+        })
+
+    def notify_changes(self, flat_id, changes):
+        """Tells the chats that got the flat and asked for changes"""
+        changes = [c for c in changes if c.meaningful]
+        if len(changes) == 0:
+            return
+        chats = [
+            u for u in self.viewed if self.filter_engine.get(u).changes
+            and self.seen(u, flat_id)
+        ]
+        logger.debug('notify_changes: %s %s for %d chats',
+                     flat_id,
+                     changes,
+                     len(chats),
+                     extra=dict(flat_id=flat_id))
+        if len(chats) == 0:
+            return
+        flat = self.flatlist[flat_id]
+        self.schedule(
+            dict(text='\n'.join([f'{flat.href} changed'] +
+                                 [c.describe() for c in changes])), chats,
+            kind='change')
+
+    def publish(self, new_flats, offers, changed):
+        """Queues what handle_new_flats found for the notifier; it is put
+        before the transaction commits, so a crash can only repeat events"""
+        events = [
+            dict(kind='flat',
+                 flat=attr.asdict(flat),
+                 offer=offers[flat.id],
+                 original=self.duplicates.get(flat.id)) for flat in new_flats
+        ]
+        for flat_id, changes in changed:
+            changes = [attr.astuple(c) for c in changes if c.meaningful]
+            if changes:
+                events.append(
+                    dict(kind='change',
+                         flat_id=flat_id,
+                         offer_hash=self.offer_hashes.get(flat_id),
+                         changes=changes))
+        self.queue.put(cian_queue.CRAWL, events)
+
+    def request_details(self, flats):
+        """Has the detail pages of `flats` fetched. The notifier asks the
+        fetcher, which publishes them back, so that only the fetcher
+        process talks to cian."""
+        if self.role != 'notifier':
+            self.flat_details.request(flats)
+            return
+        ids = [f.id for f in flats if self.flat_details.get(f.id) is None]
+        if self.flat_details.ttl > 0 and ids:
+            self.queue.put(cian_queue.COMMANDS, [dict(kind='details', ids=ids)])
+
+    def details_fetched(self, fetched):
+        """Publishes the details the notifier asked for"""
+        if self.role != 'fetcher':
+            return
+        self.queue.put(cian_queue.CRAWL, [
+            dict(kind='details', flat_id=flat_id, details=attr.asdict(entry))
+            for flat_id, entry in fetched
+        ])
+
+    def receive_flat(self, event):
+        """Stores a flat the fetcher published, as add_flat would"""
+        flat = cian_parser.FlatRecord(**event['flat'])
+        self.log_flat(flat.id)
+        self.store.put_flat(flat.id, event['flat'])
+        self.store.put_offer(flat.id, event['offer'])
         self.flatlist[flat.id] = flat
-        if not self.flat_ok(flat):
+        self.set_offer_hash(flat.id, cian_changes.offer_hash(event['offer']))
+        self.unrouted.add(flat.id)
+        self.store.put_unrouted([flat.id])
+        self.touch_flats([flat.id])
+        if event['original'] is not None:
+            self.duplicates[flat.id] = event['original']
+            self.store.put_duplicate(flat.id, event['original'])
+        self.first_seen(flat)
+        return flat
+
+    def route_received(self, new_flats, n_logged):
+        self.route_flats(new_flats, n_logged)
+        ids = [f.id for f in new_flats]
+        self.unrouted.difference_update(ids)
+        self.store.drop_unrouted(ids)
+
+    def receive_change(self, event):
+        """Notifies a change the fetcher published, once per offer hash"""
+        flat_id = event['flat_id']
+        if flat_id not in self.flatlist:
+            return
+        if (event['offer_hash'] is not None
+                and self.offer_hashes.get(flat_id) == event['offer_hash']):
+            # Notified already, the batch is delivered again
+            return
+        self.notify_changes(flat_id,
+                            [cian_changes.Change(*c) for c in event['changes']])
+        if event['offer_hash'] is not None:
+            self.set_offer_hash(flat_id, event['offer_hash'])
+
+    def consume_events(self, context):
+        """Handles a batch of what the fetcher published, in order, in one
+        transaction, and acks it once that's committed. Should the batch
+        come again, each of its flats has either been routed or is in the
+        stored unrouted set, so none is skipped unsent."""
+        batch = self.queue.lease(cian_queue.CRAWL, EVENT_BATCH)
+        if len(batch) == 0:
             return
-        msg = self.flat_to_message(flat)
-        for u in self.viewed:
-            if flat.id in self.viewed[u]:
+        with self.locked(), self.store.transaction():
+            self.handle_events(batch)
+        self.queue.ack([i for i, _ in batch])
+        logger.info(f'consume_events: handled {len(batch)} events')
+
+    def handle_events(self, batch):
+        """[(id, event)] leased from the CRAWL topic"""
+        n_logged = len(self.flat_log)
+        new_flats = []
+        for _, event in batch:
+            if event['kind'] == 'flat':
+                flat_id = event['flat']['id']
+                if flat_id not in self.flatlist:
+                    new_flats.append(self.receive_flat(event))
+                elif flat_id in self.unrouted:
+                    # Received, but routing the batch failed; route_flats
+                    # skips chats that have it already
+                    new_flats.append(self.flatlist[flat_id])
                 continue
-            msg = copy.deepcopy(msg)
-            msg['chat_id'] = u
-            self.scheduled_messages.append(msg)
-            self.viewed[u].add(flat.id)
-
-    def send_messages(self, context):
-        logger.info(
-            f'send_messages: about to send {len(self.scheduled_messages)} messages'
-        )
-        if len(self.scheduled_messages) == 0:
-            logger.info('send_messages: no messages scheduled')
+            # Flats published before this event go first
+            self.route_received(new_flats, n_logged)
+            n_logged, new_flats = len(self.flat_log), []
+            if event['kind'] == 'change':
+                self.receive_change(event)
+            elif event['kind'] == 'evict':
+                self.evict_flats(event['ids'])
+            elif event['kind'] == 'details':
+                self.flat_details.put(event['flat_id'],
+                                      cian_details.Details(**event['details']))
+        self.route_received(new_flats, n_logged)
+
+    def consume_commands(self):
+        """Observes the urls a notifier was asked to, and fetches the
+        detail pages it wants"""
+        batch = self.queue.lease(cian_queue.COMMANDS)
+        if len(batch) == 0:
             return
-        try:
-            msg = self.scheduled_messages.popleft()
-            logger.debug(
-                f'Notifying {msg["chat_id"]} about: {msg["text"]}')
-
-            sent_msg = None
-            # Aye, that's a ton of shitcode
-            if 'photo' in msg:
-                sent_msg = context.bot.send_photo(msg['chat_id'],
-                                                  msg['photo'],
-                                                  caption=msg['text'])
-            else:
-                sent_msg = context.bot.send_message(
-                    msg['chat_id'], msg['text'])
-        except KeyboardInterrupt:
-            logger.error(f'send_messages: keyboard interrupt, putting message back to queue and pushing Exception forward')
-            self.scheduled_messages.append(msg)
-            raise
-        except Exception as e:
-            logger.error(f'send_messages: {e}')
-            self.scheduled_messages.append(msg)
+        with self.store.transaction():
+            for _, command in batch:
+                if command.get('kind') == 'details':
+                    self.flat_details.request([
+                        self.flatlist[i] for i in command['ids']
+                        if i in self.flatlist
+                    ])
+                    continue
+                logger.info(f'consume_commands: observing {command["url"]}')
+                self.add_observed_url(command['url'])
+        self.queue.ack([i for i, _ in batch])
+
+    def run_fetcher(self):
+        """The loop of --role fetcher, which has no JobQueue"""
+        next_retention = time.monotonic() + 60
+        while True:
+            self.consume_commands()
+            self.fetch_cian(None)
+            if time.monotonic() >= next_retention:
+                self.retention_job(None)
+                next_retention = time.monotonic() + 6 * 60 * 60
+            due = self.scheduler.next_due()
+            time.sleep(FETCHER_TICK if due is None else min(
+                FETCHER_TICK, due))
+
+    def start_sending(self, bot):
+        self.bot = bot
+        self.sender.start()
+
+    def message_text(self, msg):
+        """The text with whatever the flat's detail page added,
+        if it's been fetched by now"""
+        offer_data = self.flat_details.get(msg.get('flat_id'))
+        if offer_data is None:
+            return msg['text']
+        details = cian_details.describe(offer_data)
+        return '.\n'.join([msg['text'], details]) if details else msg['text']
+
+    def deliver(self, chat_id, msg):
+        logger.debug('deliver: notifying %s about %r',
+                     chat_id,
+                     msg['text'],
+                     extra=dict(chat_id=chat_id))
+        text = self.message_text(msg)
+        # Aye, that's a ton of shitcode
+        if 'photo' in msg:
+            sent_msg = self.bot.send_photo(chat_id, msg['photo'], caption=text)
         else:
-            if 'document' in msg and sent_msg is not None:
+            sent_msg = self.bot.send_message(chat_id, text)
+        # The notification itself is out, don't retry it over the extras
+        try:
+            if 'document' in msg:
                 sent_msg.reply_text(msg['document'])
-            if 'photos' in msg and len(
-                    msg['photos']) >= 2 and sent_msg is not None:
-                with ExitStack() as stack:
-                    photos = msg['photos'][:N_PHOTOS_MAX]
-                    photos = [fetch_file(p) for p in photos]
-                    photos = [
-                        stack.enter_context(open(p, 'rb')) for p in photos
-                    ]
-                    context.bot.send_media_group(
-                        msg['chat_id'],
-                        [InputMediaPhoto(p) for p in photos],
-                        timeout=120 * len(photos),
-                        reply_to_message_id=sent_msg.message_id)
-            if sent_msg is None:
-                logger.error(
-                    f'Failed to send message to {msg["chat_id"]} with content {msg["text"]}'
-                )
-        if len(self.scheduled_messages) > 0:
-            context.job_queue.run_once(self.send_messages, 0.0, context)
+            if 'photos' in msg and len(msg['photos']) >= 2:
+                self.send_photos(chat_id, msg['photos'][:N_PHOTOS_MAX],
+                                 sent_msg.message_id)
+        except Exception as e:
+            logger.error(f'deliver: {chat_id}: failed sending extras: {e}')
+
+    def send_photos(self, chat_id, urls, reply_to):
+        """Sends a media group, reusing file_ids of photos uploaded before"""
+        with ExitStack() as stack:
+            sent_urls, media = [], []
+            for url in urls:
+                photo = self.photos.file_id(url)
+                if photo is None:
+                    path = self.photos.get(url)
+                    if path is None:
+                        continue
+                    photo = stack.enter_context(open(path, 'rb'))
+                sent_urls.append(url)
+                media.append(InputMediaPhoto(photo))
+            if len(media) == 0:
+                return
+            sent = self.bot.send_media_group(chat_id,
+                                             media,
+                                             timeout=120 * len(media),
+                                             reply_to_message_id=reply_to)
+        for url, m in zip(sent_urls, sent):
+            if m.photo:
+                self.photos.remember_file_id(url, m.photo[-1].file_id)
+
+    def delivered(self, entry, chat_id):
+        self.send_outcomes.append(([entry.outbox_id], chat_id, False))
+
+    def dropped(self, entries, chat_id, chat_gone):
+        self.send_outcomes.append(([e.outbox_id for e in entries], chat_id,
+                                   chat_gone))
+
+    def apply_send_outcomes(self, context):
+        """Takes what the sender is done with out of the outbox and
+        unsubscribes the chats that are gone. The sender's threads only
+        queue that, so they never change the state or commit."""
+        outcomes = []
+        while self.send_outcomes:
+            outcomes.append(self.send_outcomes.popleft())
+        if len(outcomes) == 0:
+            return
+        with self.locked(), self.store.transaction():
+            for outbox_ids, chat_id, chat_gone in outcomes:
+                for outbox_id in outbox_ids:
+                    self.store.drop_target(outbox_id, chat_id)
+                if chat_gone and chat_id in self.viewed:
+                    self.remove_chat(chat_id)
 
     def get_json(self, update, context):
         logger.info(f'get_json {context.args}')
         flatid = context.args[0]
         flatid = int(flatid)
-        if not flatid in self.flatlist:
-            logger.error(f'{flatid} not in flatlist')
-            pass  # TODO: schedule querying the flat page
-        flat = self.flatlist[flatid]
-        logger.debug(f'get_json {context.args}: flat found')
-        js = flat.json
-        logger.debug(f'get_json {context.args}: extracted json')
+        # The detail page has more, but only if it's been fetched already
+        js = self.flat_details.get(flatid)
+        if js is None:
+            js = self.store.get_offer(flatid)
+            if flatid in self.flatlist:
+                self.request_details([self.flatlist[flatid]])
+        if js is None:
+            logger.error(f'{flatid} not in the offer store')
+            update.message.reply_text(f'No json for {flatid}')
+            return
+        logger.debug('get_json %s: loaded json', context.args)
         js = json.dumps(js, ensure_ascii=False, sort_keys=True, indent=4).encode('utf8')
-        logger.debug(f'get_json {context.args}: encoded into bytes')
+        logger.debug('get_json %s: encoded into bytes', context.args)
         doc = io.BytesIO(js)
-        logger.debug(f'get_json {context.args}: created InputFile')
+        logger.debug('get_json %s: created InputFile', context.args)
         update.message.reply_document(document=doc, filename=f'{flatid}.json')
-        logger.debug(f'get_json {context.args}: send a reply')
+        logger.debug('get_json %s: send a reply', context.args)
 
     def fetch_messages(self, update, context):
-        logger.info(f'{update.message.chat_id} asks for messages')
-        for f in self.flatlist:
-            if f.id in self.viewed[update.message.chat_id]:
-                continue
-            if not self.flat_ok(flat):
-                continue
-            msg = self.flat_to_message(f)
-            msg['chat_id'] = update.message.chat_id
-            self.scheduled_messages.append(msg)
-        logger.info('Sending messages as requested')
-        context.job_queue.run_once(self.send_messages, 0.0, context)
-        logger.info('Messages sent')
-
-    def fetch_cian(self, context):
-        if len(self.observed_urls) == 0:
-            logger.info('fetch_cian: no URLs to fetch')
-            return
+        chat_id = update.message.chat_id
+        n_scheduled = 0
+        # An eviction would compact flat_log and move the cursor mid-loop
+        with self.locked(), self.store.transaction():
+            start = self.cursors.get(chat_id, 0)
+            logger.info(
+                f'{chat_id} asks for messages, {len(self.flat_log) - start} flats to check'
+            )
+            if chat_id not in self.viewed:
+                # Never sent /start, or gone since; asking subscribes it
+                self.add_chat(chat_id)
+            for position in range(start, len(self.flat_log)):
+                flat_id = self.flat_log[position]
+                if self.seen(chat_id, flat_id) or flat_id in self.evicted:
+                    continue
+                flat = self.flatlist[self.flat_log[position]]
+                if not self.filter_engine.accepts_at(chat_id, position, flat):
+                    continue
+                self.schedule(self.flat_to_message(flat), [chat_id],
+                              kind='fetch_messages')
+                self.mark_viewed(chat_id, flat.id)
+                n_scheduled += 1
+            self.set_cursors({chat_id: len(self.flat_log)})
+        logger.info(f'fetch_messages: scheduled {n_scheduled} messages for {chat_id}')
+
+    def conditional_headers(self, url):
+        if url not in self.fetch_cache:
+            return dict()
+        return self.fetch_cache[url].conditional_headers()
+
+    def download_pages(self, urls):
+        """Yields every page fetched, 304s included"""
+        if self.fetch_options is not None:
+            logger.info(
+                f'fetch_cian: fetching {len(urls)} urls with {self.fetch_options}'
+            )
+            pages = aio.fetch_all(
+                urls,
+                self.fetch_options,
+                headers={u: self.conditional_headers(u)
+                         for u in urls},
+                limiter=self.limiter)
+        else:
+            pages = self.download_pages_sync(urls)
+        for page in pages:
+            if page.elapsed is not None:
+                FETCH_SECONDS.observe(page.elapsed)
+            yield page
+
+    def download_pages_sync(self, urls):
+        import requests  # only needed without fetch options, and slow
+
         with requests.Session() as s:
-            for url in self.observed_urls:
+            for url in urls:
+                host = urlparse(url).netloc
+                self.limiter.wait_sync(host)
                 try:
-                    logger.info(f'fetch_cian: fetching {url}')
-                    res = s.get(url)
-                    logger.info(f'fetch_cian: status {res.status_code}')
-                    html = res.text
-                    flats = cian_parser.get_flatlist(html)
-                    logger.info(
-                        f'fetch_cian: fetched {len(flats)} flats from {url}')
-                    for f in flats:
-                        self.handle_new_flat(f)
-                    context.job_queue.run_once(self.send_messages, 0, context)
+                    logger.info('fetch_cian: fetching %s', url)
+                    started = time.monotonic()
+                    res = s.get(url, headers=self.conditional_headers(url))
+                    logger.info('fetch_cian: status %d',
+                                res.status_code,
+                                extra=dict(url=url, status=res.status_code))
+                    if res.status_code == 429:
+                        self.limiter.defer(
+                            host, aio.retry_delay(res, 0, aio.FetchOptions()))
+                    yield cian_parser.Page(
+                        url,
+                        res.status_code,
+                        res.text,
+                        etag=res.headers.get('ETag'),
+                        last_modified=res.headers.get('Last-Modified'),
+                        elapsed=time.monotonic() - started)
                 except Exception as e:
                     logger.fatal(
                         f'fetch_cian: failed fetching flats from {url}; error: {e}'
                     )
-        logger.info('Saving backup')
-        self.save('.cian-backup')
-        logger.info('Saved backup')
+
+    def known_digest(self, url):
+        entry = self.fetch_cache.get(url)
+        return None if entry is None else entry.digest
+
+    def page_unchanged(self, url):
+        """Counts a hit on `url` and keeps its flats alive"""
+        logger.info('fetch_cian: %s unchanged', url, extra=dict(url=url))
+        entry = self.fetch_cache.setdefault(url, FetchCacheEntry())
+        entry.hits += 1
+        with self.store.transaction():
+            self.store.put_fetch_cache(url, attr.asdict(entry))
+            self.touch_flats(entry.ids)
+
+    def page_handled(self, page, digest, flat_ids):
+        """Remembers what `page` had, once its flats are handled. Done
+        any earlier, a page that failed handling would look unchanged
+        on the next poll and never be handled."""
+        entry = self.fetch_cache.setdefault(page.url, FetchCacheEntry())
+        entry.etag = page.etag
+        entry.last_modified = page.last_modified
+        entry.digest = digest
+        entry.misses += 1
+        # Still seen when the page comes back unchanged; only the flats
+        # some observed url accepted, the others aren't kept
+        entry.ids = flat_ids
+        self.store.put_fetch_cache(page.url, attr.asdict(entry))
+
+    def parse_pages(self, pages):
+        """Yields (page, digest, flats) for every page parsed successfully;
+        flats is None if the offers are the same as last time, or the
+        server said so with a 304. With a parse_pool, pages are parsed,
+        and digested, in the worker processes while the rest are still
+        being downloaded"""
+        if self.parse_pool is None:
+            for page in pages:
+                if page.status == 304:
+                    yield page, None, None
+                    continue
+                try:
+                    with PARSE_SECONDS.time():
+                        digest, records = cian_parser.parse_search_page_records(
+                            page.text, self.known_digest(page.url),
+                            cian_changes.offer_hash)
+                except Exception as e:
+                    logger.fatal(
+                        f'fetch_cian: failed parsing flats from {page.url}; error: {e}'
+                    )
+                    continue
+                if records is None:
+                    yield page, digest, None
+                    continue
+                PAGE_OFFERS.observe(len(records))
+                yield page, digest, [
+                    cian_parser.ParsedFlat.from_record(r, page.text)
+                    for r in records
+                ]
+            return
+        futures = dict()
+        for page in pages:
+            if page.status == 304:
+                yield page, None, None
+                continue
+            futures[self.parse_pool.submit(
+                cian_parser.parse_search_page_records, page.text,
+                self.known_digest(page.url),
+                cian_changes.offer_hash)] = (page, time.perf_counter())
+        for fut in concurrent.futures.as_completed(futures):
+            page, submitted = futures[fut]
+            try:
+                digest, records = fut.result()
+            except Exception as e:
+                logger.fatal(
+                    f'fetch_cian: failed parsing flats from {page.url}; error: {e}'
+                )
+                continue
+            PARSE_SECONDS.observe(time.perf_counter() - submitted)
+            if records is None:
+                yield page, digest, None
+                continue
+            PAGE_OFFERS.observe(len(records))
+            yield page, digest, [
+                cian_parser.ParsedFlat.from_record(r, page.text)
+                for r in records
+            ]
+
+    def fetch_cian(self, context, urls=None):
+        """Polls `urls`, which must have been claimed from the scheduler,
+        or else the observed urls that are due"""
+        if urls is None:
+            urls = self.scheduler.pop_due()
+        if len(urls) == 0:
+            logger.debug('fetch_cian: no URLs to fetch')
+            return
+        n_new = dict.fromkeys(urls)
+        try:
+            n_new.update(self.crawl(urls))
+        finally:
+            with self.store.transaction():
+                for url in urls:
+                    entry = self.scheduler.done(url, n_new[url])
+                    if entry is None:
+                        continue
+                    self.store.put_poll_schedule(
+                        url, dict(interval=entry.interval, rate=entry.rate))
+        if not self.polled:
+            self.polled = True
+            logger.info(
+                f'fetch_cian: first poll done {time.monotonic() - STARTED_AT:.1f}s after start'
+            )
+
+    def crawl(self, urls):
+        """Fetches `urls` and the pages following them while there's
+        something new; returns {url: number of new flats}, None for urls
+        none of whose pages could be fetched and parsed"""
+        polls = self.polls
+        n_new = dict.fromkeys(urls)
+        origin = {
+            cian_parser.crawl_url(u) if self.max_pages > 1 else u: u
+            for u in urls
+        }
+        urls = list(origin)
+        for page_no in range(1, self.max_pages + 1):
+            next_urls = []
+            pages = self.parse_pages(self.download_pages(urls))
+            for page, digest, flats in pages:
+                url = page.url
+                n_new[origin[url]] = n_new[origin[url]] or 0
+                if flats is None:
+                    FETCH_PAGES.inc(status=page.status, outcome='unchanged')
+                    with self.locked():
+                        self.page_unchanged(url)
+                    continue
+                FETCH_PAGES.inc(status=page.status, outcome='changed')
+                logger.info('fetch_cian: fetched %d flats from %s',
+                            len(flats),
+                            url,
+                            extra=dict(url=url, n_flats=len(flats)))
+                subscriptions = polls.get(origin[url], ())
+                if any(q.url != origin[url] for q in subscriptions):
+                    # Coalesced, keep what the observed urls asked for
+                    flats = [
+                        f for f in flats
+                        if queries.accepts(subscriptions, f.record)
+                    ]
+                # Kept alive by the page, as long as it's unchanged
+                flat_ids = [f.id for f in flats]
+                # The page's flats and its fetch cache entry commit together
+                with self.locked(), self.store.transaction():
+                    n = sum(f.id not in self.flatlist
+                            and f.id not in self.evicted for f in flats)
+                    self.handle_new_flats(flats)
+                    self.page_handled(page, digest, flat_ids)
+                n_new[origin[url]] += n
+                if n > 0:
+                    next_url = cian_parser.next_page_url(url)
+                    origin[next_url] = origin[url]
+                    next_urls.append(next_url)
+                else:
+                    logger.info('fetch_cian: nothing new on page %d of %s',
+                                page_no,
+                                url,
+                                extra=dict(url=url, page=page_no))
+            urls = next_urls
+            if len(urls) == 0:
+                break
+        return n_new
+
+    def fetch_cian_async(self, context, urls=None):
+        """Runs fetch_cian in a dispatcher worker thread,
+        so that the JobQueue stays free for other jobs"""
+        if urls is None:
+            if not self.scheduler.has_due():
+                return
+            urls = self.scheduler.pop_due()
+        context.dispatcher.run_async(self.fetch_cian, context, urls)
+
+    @property
+    def fetch_job(self):
+        if self.parse_pool is None:
+            return self.fetch_cian
+        return self.fetch_cian_async
+
+    def set_filter(self, update, context):
+        chat_id = update.message.chat_id
+        try:
+            chat_filter = self.filter_engine.get(chat_id).with_args(
+                context.args)
+        except ValueError as e:
+            logger.error(f'set_filter: {chat_id} {context.args}: {e}')
+            update.message.reply_text(f'{e}\n{cian_filters.SYNOPSIS}')
+            return
+        if context.args:
+            self.filter_engine.set(chat_id, chat_filter)
+            with self.lock, self.store.transaction():
+                self.store.put_chat_filter(chat_id, attr.asdict(chat_filter))
+                # Flats it used to reject may pass now
+                self.set_cursors({chat_id: 0})
+            logger.info(f'set_filter: {chat_id} now uses {chat_filter}')
+        update.message.reply_text(chat_filter.describe())
 
     def observe_url(self, update, context):
         if len(context.args) != 1:
@@ -319,10 +1315,18 @@ class CianBot:
             )
             return
         url = context.args[0]
-        self.observed_urls = sorted(set(self.observed_urls + [url]))
+        if self.role == 'notifier':
+            self.queue.put(cian_queue.COMMANDS, [dict(url=url)])
+            update.message.reply_text(f'Observing {url}')
+            logger.info(f'observe_url: asked the fetcher to observe {url}')
+            return
+        self.add_observed_url(url)
         logger.info('observe_url: scheduled cian_fetch')
         due = 5
-        context.job_queue.run_once(self.fetch_cian,
+        # Just this url, the others are polled on their own schedule
+        urls = self.scheduler.claim([self.poll_url(url)])
+        context.job_queue.run_once(functools.partial(self.fetch_job,
+                                                     urls=urls),
                                    due,
                                    context=update.message.chat_id)
         update.message.reply(f'Observing {url}')
@@ -332,24 +1336,159 @@ class CianBot:
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('cian_bot')
     parser.add_argument('--token-file', default='.token')
-    parser.add_argument('--state-dir', default='cian')
+    parser.add_argument(
+        '--state-dir',
+        default='cian',
+        help='where the state is kept; with an empty one nothing is, and '
+        f'only the last {cian_store.MAX_OFFERS} raw offers are kept in '
+        'memory for /json and change notifications')
+    parser.add_argument('--parse-workers',
+                        type=int,
+                        default=0,
+                        help='parse pages in a pool of that many processes')
+    parser.add_argument(
+        '--max-pages',
+        type=int,
+        default=1,
+        help='follow results pages until one has no new flats, up to that many;'
+        ' above 1, searches differing only in rooms and price are polled as one'
+    )
+    parser.add_argument(
+        '--fetch-concurrency',
+        type=int,
+        default=0,
+        help='fetch up to that many pages at once (requires aiohttp)')
+    parser.add_argument('--fetch-rps',
+                        type=float,
+                        default=attr.fields(aio.FetchOptions).rps.default,
+                        help='max requests per second to the same host')
+    parser.add_argument('--fetch-retries',
+                        type=int,
+                        default=attr.fields(aio.FetchOptions).retries.default)
+    parser.add_argument('--send-workers',
+                        type=int,
+                        default=4,
+                        help='deliver to that many chats in parallel')
+    parser.add_argument('--photo-cache-mb',
+                        type=int,
+                        default=512,
+                        help='evict least recently used photos over that')
+    parser.add_argument('--fetch-timeout',
+                        type=float,
+                        default=attr.fields(aio.FetchOptions).timeout.default)
+    parser.add_argument(
+        '--poll-min-minutes',
+        type=float,
+        default=cian_scheduler.MIN_INTERVAL / 60,
+        help='poll urls that keep yielding new flats no more often than that')
+    parser.add_argument(
+        '--flat-ttl-days',
+        type=float,
+        default=0,
+        help='forget flats no crawl has seen for that long, but their ids; '
+        '0 keeps them all')
+    parser.add_argument('--poll-max-minutes',
+                        type=float,
+                        default=cian_scheduler.MAX_INTERVAL / 60,
+                        help='poll quiet urls at least that often')
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help='serve Prometheus metrics on localhost at that port')
+    parser.add_argument('--admin',
+                        type=int,
+                        action='append',
+                        default=[],
+                        help='chat id allowed /stats, /state and /profile')
+    parser.add_argument('--log-file', default='cian_bot.log')
+    parser.add_argument('--log-level',
+                        default='DEBUG',
+                        help='of the log file, which takes JSON lines')
+    parser.add_argument(
+        '--log-burst',
+        type=int,
+        default=cian_logging.BURST,
+        help='log that many debug lines of a kind a minute at most')
+    parser.add_argument(
+        '--role',
+        choices=ROLES,
+        default='all',
+        help='fetcher only crawls, notifier only talks to Telegram; '
+        'run one of each with their own --state-dir and the same --queue')
+    parser.add_argument('--queue',
+                        default=cian_queue.QUEUE_FILE,
+                        help='SQLite file the fetcher and notifier share')
+    parser.add_argument(
+        '--detail-ttl-hours',
+        type=float,
+        default=cian_details.TTL / 3600,
+        help='fetch detail pages of flats that pass filters and keep them '
+        'that long; 0 disables fetching them')
+    parser.add_argument('--detail-batch',
+                        type=int,
+                        default=cian_details.BATCH,
+                        help='fetch that many detail pages at once at most')
 
     args = parser.parse_args()
-    with open(args.token_file, 'r') as f:
-        token = f.readline().strip()
-
-    updater = Updater(token, use_context=True)
-    dp = updater.dispatcher
-    dp.use_context = True
-    if args.state_dir and osp.exists(args.state_dir):
-        state = CianBot.from_directory(args.state_dir)
+    log_listener = cian_logging.setup(args.log_file,
+                                      file_level=args.log_level,
+                                      burst=args.log_burst)
+    bot_options = dict(parse_workers=args.parse_workers,
+                       max_pages=args.max_pages,
+                       send_workers=args.send_workers,
+                       photo_cache_bytes=args.photo_cache_mb * 2**20,
+                       scheduler=cian_scheduler.PollScheduler(
+                           min_interval=args.poll_min_minutes * 60,
+                           max_interval=args.poll_max_minutes * 60),
+                       flat_ttl=(args.flat_ttl_days * 24 * 60 * 60
+                                 if args.flat_ttl_days > 0 else None),
+                       admins=args.admin,
+                       role=args.role,
+                       detail_ttl=args.detail_ttl_hours * 60 * 60,
+                       detail_batch=args.detail_batch)
+    if args.role != 'all':
+        bot_options['queue'] = cian_queue.DurableQueue(args.queue)
+    if args.fetch_concurrency > 0:
+        bot_options['fetch_options'] = aio.FetchOptions(
+            concurrency=args.fetch_concurrency,
+            rps=args.fetch_rps,
+            retries=args.fetch_retries,
+            timeout=args.fetch_timeout)
+    if args.state_dir:
+        state = CianBot.from_directory(args.state_dir, **bot_options)
     else:
-        state = CianBot()
+        state = CianBot(**bot_options)
+    if args.metrics_port > 0:
+        cian_metrics.serve(args.metrics_port)
 
     try:
+        if args.role == 'fetcher':
+            if args.detail_ttl_hours > 0:
+                state.flat_details.start()
+            state.run_fetcher()
+        with open(args.token_file, 'r') as f:
+            token = f.readline().strip()
+        updater = Updater(token, use_context=True)
+        dp = updater.dispatcher
+        dp.use_context = True
         job = updater.job_queue
-        job.run_repeating(state.fetch_cian, datetime.timedelta(minutes=180),
-                          10)
+        if args.role == 'all':
+            # Only checks which urls are due, see cian_scheduler
+            job.run_repeating(state.fetch_job, datetime.timedelta(minutes=1),
+                              10)
+        else:
+            job.run_repeating(state.consume_events,
+                              datetime.timedelta(seconds=FETCHER_TICK), 1)
+        job.run_repeating(state.apply_send_outcomes,
+                          datetime.timedelta(seconds=1), 1)
+        # Once polling has started, unless a crawl or a chat needs them first
+        job.run_once(state.load_indexes, 0)
+        # Unless /market asks for it before. Without a store there is
+        # nothing to read, and the flats crawled till then would be missing
+        job.run_once(state.load_market, 60 if args.state_dir else 0)
+        job.run_repeating(state.retention_job, datetime.timedelta(hours=6),
+                          60)
         dp.add_handler(CommandHandler('start', state.start))
         dp.add_handler(
             CommandHandler('observe',
@@ -358,16 +1497,34 @@ if __name__ == '__main__':
                            pass_job_queue=True,
                            pass_chat_data=True))
         dp.add_handler(CommandHandler('fetchMessages', state.fetch_messages))
+        dp.add_handler(
+            CommandHandler('filter', state.set_filter, pass_args=True))
+        dp.add_handler(CommandHandler('state', state.report_state))
+        dp.add_handler(CommandHandler('stats', state.stats))
+        dp.add_handler(
+            CommandHandler('market', state.market_summary, pass_args=True))
+        dp.add_handler(
+            CommandHandler('profile', state.profile, pass_args=True))
         dp.add_handler(
             CommandHandler('json',
                            state.get_json,
                            pass_args=True,
                            pass_job_queue=True,
                            pass_chat_data=True))
+        state.start_sending(updater.bot)
+        if args.detail_ttl_hours > 0 and args.role == 'all':
+            # The notifier has the fetcher fetch them
+            state.flat_details.start()
         updater.start_polling()
         updater.idle()
     finally:
-        if args.state_dir is not None:
-            if not osp.exists(args.state_dir):
-                os.makedirs(args.state_dir)
-            state.save(args.state_dir)
+        state.sender.stop()
+        state.apply_send_outcomes(None)
+        state.flat_details.stop()
+        state.photos.close()
+        if state.parse_pool is not None:
+            state.parse_pool.shutdown()
+        state.store.close()
+        if state.queue is not None:
+            state.queue.close()
+        log_listener.stop()
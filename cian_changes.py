@@ -0,0 +1,87 @@
+"""Changes of flats we already know.
+
+Every crawl hashes the parts of each offer we care about; only offers whose
+hash changed are diffed against the stored offer json, so a crawl costs
+as much as the changes it brings rather than the flats it sees. Price
+changes go to PriceHistory, an append-only pair of array columns per flat
+that changed price at least once."""
+import array
+import hashlib
+import json
+
+import attr
+
+TRACKED = ('bargainTerms', 'photos', 'description')
+# Changes worth notifying a chat about
+MEANINGFUL = frozenset(
+    ['priceRur', 'deposit', 'clientFee', 'agentBonus', 'paymentPeriod'])
+
+
+def offer_hash(offer):
+    """A signed 64-bit hash of the tracked parts of the offer"""
+    data = json.dumps([offer.get(k) for k in TRACKED],
+                      sort_keys=True,
+                      ensure_ascii=False)
+    digest = hashlib.blake2b(data.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+@attr.s(frozen=True)
+class Change:
+    field = attr.ib()
+    before = attr.ib()
+    after = attr.ib()
+
+    @property
+    def meaningful(self):
+        return self.field in MEANINGFUL
+
+    def describe(self):
+        if self.field == 'description':
+            return 'description changed'
+        return f'{self.field}: {self.before} -> {self.after}'
+
+
+def diff_offers(old, new):
+    changes = []
+    old_terms = old.get('bargainTerms') or {}
+    new_terms = new.get('bargainTerms') or {}
+    for k in sorted(old_terms.keys() | new_terms.keys()):
+        if old_terms.get(k) != new_terms.get(k):
+            changes.append(Change(k, old_terms.get(k), new_terms.get(k)))
+    old_photos = [p.get('fullUrl') for p in old.get('photos') or ()]
+    new_photos = [p.get('fullUrl') for p in new.get('photos') or ()]
+    if old_photos != new_photos:
+        changes.append(Change('photos', len(old_photos), len(new_photos)))
+    if old.get('description') != new.get('description'):
+        changes.append(Change('description', None, None))
+    return changes
+
+
+class PriceHistory:
+    def __init__(self):
+        # flat_id -> (times, prices); prices[0] is the price before the
+        # first change, prices[i + 1] the one set at times[i]
+        self.columns = dict()
+
+    def load(self, rows):
+        for flat_id, at, before, after in rows:
+            self.record(flat_id, at, before, after)
+
+    def record(self, flat_id, at, before, after):
+        if flat_id not in self.columns:
+            self.columns[flat_id] = (array.array('d'), array.array('d',
+                                                                   [before]))
+        times, prices = self.columns[flat_id]
+        times.append(at)
+        prices.append(after)
+
+    def get(self, flat_id):
+        """[(time or None for the original price, price)]"""
+        if flat_id not in self.columns:
+            return []
+        times, prices = self.columns[flat_id]
+        return list(zip([None] + list(times), prices))
+
+    def __len__(self):
+        return len(self.columns)
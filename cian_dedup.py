@@ -0,0 +1,84 @@
+"""Relisted and duplicate offers.
+
+The same flat is often posted again under a new id, or by several agents
+at once. FingerprintIndex maps a few 64-bit keys of every flat -- its
+address, floor and rooms within a price bucket, and each of its photo
+urls -- to the id of the first flat they were seen on, so a new flat is
+matched against everything we know with a handful of dict lookups."""
+import collections
+import hashlib
+import math
+import re
+
+# Width of a price bucket, relative: relists often come a bit cheaper
+PRICE_STEP = 0.05
+# Flats sharing that many photos are the same flat
+MIN_SHARED_PHOTOS = 2
+
+NON_WORD = re.compile(r'\W+')
+
+
+def key(*parts):
+    """A signed 64-bit hash, so that it fits an SQLite INTEGER"""
+    digest = hashlib.blake2b('\x1f'.join(map(str, parts)).encode('utf8'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def normalize_address(address):
+    """'Москва, ул. Трубная, 25С1' and 'москва ул трубная 25с1' match"""
+    return ' '.join(NON_WORD.sub(' ', address.lower().replace('ё',
+                                                              'е')).split())
+
+
+def price_bucket(price):
+    if not price or price <= 0:
+        return 0
+    return int(math.log(price) / math.log1p(PRICE_STEP))
+
+
+def address_key(flat, floor, bucket):
+    return key('address', normalize_address(flat.address), flat.rooms, floor,
+               bucket)
+
+
+def photo_keys(flat):
+    return [key('photo', url) for url in flat.photos]
+
+
+class FingerprintIndex:
+    def __init__(self):
+        self.keys = dict()  # key -> id of the first flat it was seen on
+
+    def load(self, rows):
+        self.keys.update(rows)
+
+    def match(self, flat, floor=None):
+        """Id of a flat we already know `flat` is a copy of, or None"""
+        if flat.address:
+            bucket = price_bucket(flat.price)
+            # Neighbouring buckets too, the price might have just crossed
+            for b in (bucket, bucket - 1, bucket + 1):
+                original = self.keys.get(address_key(flat, floor, b))
+                if original is not None and original != flat.id:
+                    return original
+        shared = collections.Counter(
+            self.keys[k] for k in photo_keys(flat) if k in self.keys)
+        shared.pop(flat.id, None)
+        if shared:
+            original, n = shared.most_common(1)[0]
+            if n >= min(MIN_SHARED_PHOTOS, len(flat.photos)):
+                return original
+        return None
+
+    def drop(self, flat_ids):
+        self.keys = {k: i for k, i in self.keys.items() if i not in flat_ids}
+
+    def add(self, flat, floor=None):
+        """Indexes `flat`; returns the new (key, flat_id) to be stored"""
+        keys = photo_keys(flat)
+        if flat.address:
+            keys.append(address_key(flat, floor, price_bucket(flat.price)))
+        added = [(k, flat.id) for k in keys if k not in self.keys]
+        self.keys.update(added)
+        return added
@@ -0,0 +1,243 @@
+"""Detail pages of flats that passed somebody's filters.
+
+DetailCache fetches the detail pages of the flats it's asked for in a
+background thread, at most `batch` at a time, concurrently when there are
+fetch options. Requests share the crawl's per-host rate limiter, and
+pages that got a 429 or no answer are fetched again later, up to
+ATTEMPTS times. It keeps the offerData parsed out of each page for `ttl`
+seconds, keyed by flat id. Readers only ever get what's cached and
+never wait for a fetch. Entries are written through to the store's
+flat_details table, so they survive restarts."""
+import collections
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import attr
+
+import cian_parser
+from cian_parser import aio
+
+logger = logging.getLogger('cian_bot.cian_details')
+
+TTL = 24 * 60 * 60
+BATCH = 8
+# Fetches of a page that got a 429 or no answer, before giving up on it
+ATTEMPTS = 3
+
+
+@attr.s(slots=True)
+class Details:
+    at = attr.ib(type=float)  # when it was fetched
+    offer_data = attr.ib(type=dict)
+
+
+def number(x):
+    """pyjsparser makes every number a float"""
+    return f'{x:g}' if isinstance(x, float) else f'{x}'
+
+
+def describe(offer_data):
+    """What the detail page adds to a notification, '' if nothing"""
+    offer = offer_data.get('offer') or {}
+    parts = []
+    if offer.get('totalArea'):
+        parts.append(f'{number(offer["totalArea"])} m²')
+    if offer.get('kitchenArea'):
+        parts.append(f'kitchen {number(offer["kitchenArea"])} m²')
+    floors = (offer.get('building') or {}).get('floorsCount')
+    if offer.get('floorNumber'):
+        parts.append(f'floor {number(offer["floorNumber"])}' +
+                     (f'/{number(floors)}' if floors else ''))
+    return ', '.join(parts)
+
+
+class DetailCache:
+    def __init__(self,
+                 store,
+                 fetch_options=None,
+                 ttl=TTL,
+                 batch=BATCH,
+                 parse_pool=None,
+                 limiter=None,
+                 fetched=None):
+        self.store = store
+        self.fetch_options = fetch_options  # None means one by one
+        self.ttl = ttl
+        self.batch = batch
+        self.parse_pool = parse_pool
+        self.limiter = (limiter if limiter is not None else
+                        aio.HostRateLimiter(aio.FetchOptions().rps))
+        self.fetched = fetched  # called with [(flat_id, Details)] fetched
+        self.cond = threading.Condition()
+        self.entries = dict()  # flat_id -> Details
+        self.wanted = collections.OrderedDict()  # flat_id -> href
+        self.attempts = dict()  # flat_id -> failed fetches
+        self.thread = None
+
+    def load(self, rows):
+        """Rows of the store's flat_details; those from before the cache
+        have no fetch time and are dropped"""
+        with self.cond:
+            for flat_id, data in rows:
+                if 'at' in data:
+                    self.entries[flat_id] = Details(**data)
+
+    def fresh(self, flat_id, now):
+        entry = self.entries.get(flat_id)
+        return entry is not None and now - entry.at < self.ttl
+
+    def get(self, flat_id):
+        """offerData of the flat if it's cached and fresh, else None"""
+        with self.cond:
+            if not self.fresh(flat_id, time.time()):
+                return None
+            return self.entries[flat_id].offer_data
+
+    def put(self, flat_id, entry):
+        with self.cond:
+            self.entries[flat_id] = entry
+        self.store.put_flat_details(flat_id, attr.asdict(entry))
+
+    def request(self, flats):
+        """Fetches the detail pages of `flats`, anything with an id and
+        an href, in the background unless they're cached; a no-op until
+        start()"""
+        now = time.time()
+        with self.cond:
+            if self.thread is None:
+                return
+            for flat in flats:
+                if flat.id not in self.wanted and not self.fresh(
+                        flat.id, now):
+                    self.wanted[flat.id] = flat.href
+            self.cond.notify()
+
+    def discard(self, flat_ids):
+        with self.cond:
+            for i in flat_ids:
+                self.entries.pop(i, None)
+                self.wanted.pop(i, None)
+                self.attempts.pop(i, None)
+
+    def expire(self):
+        """Forgets entries past their ttl; returns how many"""
+        cutoff = time.time() - self.ttl
+        with self.cond:
+            stale = [i for i, e in self.entries.items() if e.at < cutoff]
+            for i in stale:
+                del self.entries[i]
+        self.store.drop_flat_details(stale)
+        return len(stale)
+
+    def start(self):
+        with self.cond:
+            self.thread = threading.Thread(target=self.run,
+                                           name='cian_details',
+                                           daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            thread, self.thread = self.thread, None
+            self.cond.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.thread is not None and len(self.wanted) == 0:
+                    self.cond.wait()
+                if self.thread is None:
+                    return
+                batch = [
+                    self.wanted.popitem(last=False)
+                    for _ in range(min(self.batch, len(self.wanted)))
+                ]
+            try:
+                self.fetch(batch)
+            except Exception as e:
+                logger.error(f'run: failed fetching {len(batch)} pages: {e!r}')
+
+    def download(self, urls):
+        if self.fetch_options is not None:
+            return aio.fetch_all(urls, self.fetch_options, limiter=self.limiter)
+        import requests  # only needed without fetch options, and slow
+
+        pages = []
+        with requests.Session() as s:
+            for url in urls:
+                host = urlparse(url).netloc
+                self.limiter.wait_sync(host)
+                try:
+                    res = s.get(url, timeout=60)
+                except Exception as e:
+                    logger.error(f'download: {url}: {e!r}')
+                    continue
+                if res.status_code == 429:
+                    self.limiter.defer(
+                        host, aio.retry_delay(res, 0, aio.FetchOptions()))
+                pages.append(cian_parser.Page(url, res.status_code, res.text))
+        return pages
+
+    def retry(self, batch):
+        """Puts [(flat_id, href)] back at the end of the queue, but those
+        that have failed ATTEMPTS times"""
+        with self.cond:
+            for flat_id, href in batch:
+                n = self.attempts.get(flat_id, 0) + 1
+                if n >= ATTEMPTS:
+                    logger.error(f'retry: giving up on {href} after {n} '
+                                 'attempts')
+                    self.attempts.pop(flat_id, None)
+                    continue
+                self.attempts[flat_id] = n
+                self.wanted.setdefault(flat_id, href)
+
+    def parse(self, pages):
+        """Yields (url, offerData) of the pages that have it"""
+        if self.parse_pool is None:
+            for page in pages:
+                try:
+                    yield page.url, cian_parser.get_offer_data(page.text)
+                except Exception as e:
+                    logger.error(f'parse: {page.url}: {e!r}')
+            return
+        futures = [(p.url,
+                    self.parse_pool.submit(cian_parser.get_offer_data,
+                                           p.text)) for p in pages]
+        for url, fut in futures:
+            try:
+                yield url, fut.result()
+            except Exception as e:
+                logger.error(f'parse: {url}: {e!r}')
+
+    def fetch(self, batch):
+        ids = {href: flat_id for flat_id, href in batch}
+        pages = {p.url: p for p in self.download(list(ids))}
+        failed = []
+        for href, flat_id in ids.items():
+            page = pages.get(href)
+            if page is None or page.status in aio.RETRY_STATUSES:
+                failed.append((flat_id, href))
+            elif page.status != 200:
+                logger.error(f'fetch: {href} status {page.status}')
+        self.retry(failed)
+        fetched = []
+        for url, offer_data in self.parse(
+                p for p in pages.values() if p.status == 200):
+            if offer_data is None:
+                logger.error(f'fetch: no offerData on {url}')
+                continue
+            entry = Details(time.time(), offer_data)
+            self.put(ids[url], entry)
+            fetched.append((ids[url], entry))
+        with self.cond:
+            for flat_id, _ in fetched:
+                self.attempts.pop(flat_id, None)
+        if self.fetched is not None and fetched:
+            self.fetched(fetched)
+        logger.info(f'fetch: cached details of {len(fetched)} of {len(batch)} '
+                    f'flats, {len(failed)} to retry')
@@ -0,0 +1,186 @@
+"""Per-chat flat filters.
+
+Every chat has a ChatFilter. It's compiled once into a check over
+(flat, normalized metro names), which returns the first criterion the flat
+fails, or None. Chats sharing the same filter share the check, so a batch
+of new flats costs one evaluation per flat and per distinct filter rather
+than per chat."""
+import collections
+import logging
+
+import attr
+
+import cian_metrics
+
+logger = logging.getLogger('cian_bot.cian_filters')
+
+VERDICTS = cian_metrics.REGISTRY.counter(
+    'cian_filter_verdicts_total',
+    'Flats routed per distinct filter, by verdict and the criterion '
+    'that rejected them')
+
+METRO = (
+    'Достоевская',
+    'Проспект Мира',
+    'Сухаревская',
+    'Цветной бульвар',
+    'Трубная',
+    'Чеховская',
+    'Пушкинская',
+    'Кузнецкий мост',
+    'Лубянка',
+    'Чистые пруды',
+    'Красные Ворота',
+    'Тургеневская',
+    'Сретенский бульвар',
+    'Китай-город',
+    'Чкаловская',
+    'Маяковская',
+    'Белорусская',
+    'Менделеевская',
+    'Новослободская',
+)
+METRO_BLACKLIST = (
+    'Электрозаводская', 'Солнцево', 'Косино', 'Новогиреево', 'Выхино'
+)
+
+SYNOPSIS = ('Synopsis: /filter [price=35000] [metro=Трубная,Сухаревская] '
+            '[blacklist=Выхино] [period=monthly] [changes=on]\n'
+            'An empty value (e.g. metro=) lifts the restriction')
+
+
+def normalize_metro(name):
+    """'Китай-город', 'Китай Город' and 'китай-город ' are the same station"""
+    return ' '.join(name.lower().replace('ё', 'е').replace('-', ' ').split())
+
+
+def normalize_metros(names):
+    return frozenset(normalize_metro(m) for m in names)
+
+
+@attr.s(frozen=True)
+class ChatFilter:
+    max_price_per_room = attr.ib(default=35000)  # None means any price
+    metros = attr.ib(default=METRO, converter=tuple)  # empty means anywhere
+    metro_blacklist = attr.ib(default=METRO_BLACKLIST, converter=tuple)
+    payment_periods = attr.ib(default=('monthly', ), converter=tuple)
+    # Notify about price and terms changes of flats the chat has got
+    changes = attr.ib(default=False)
+
+    def compile(self):
+        max_price = self.max_price_per_room
+        whitelist = normalize_metros(self.metros)
+        blacklist = normalize_metros(self.metro_blacklist)
+        periods = frozenset(self.payment_periods)
+
+        def check(flat, metros):
+            if max_price is not None and flat.price > max_price * flat.rooms:
+                return 'price'
+            if whitelist and metros.isdisjoint(whitelist):
+                return 'metro'
+            if not metros.isdisjoint(blacklist):
+                return 'blacklist'
+            if (periods and flat.payment_period is not None
+                    and flat.payment_period not in periods):
+                return 'period'
+            return None
+
+        return check
+
+    def with_args(self, args):
+        """A copy of the filter updated from /filter key=value arguments"""
+        changes = dict()
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if not sep:
+                raise ValueError(f'expected key=value, got {arg!r}')
+            values = [v.strip() for v in value.split(',') if v.strip()]
+            if key == 'price':
+                changes['max_price_per_room'] = (float(value)
+                                                 if value else None)
+            elif key == 'metro':
+                changes['metros'] = values
+            elif key == 'blacklist':
+                changes['metro_blacklist'] = values
+            elif key == 'period':
+                changes['payment_periods'] = values
+            elif key == 'changes':
+                if value not in ('on', 'off'):
+                    raise ValueError(f'changes={value!r}, expected on or off')
+                changes['changes'] = value == 'on'
+            else:
+                raise ValueError(f'unknown filter {key!r}')
+        return attr.evolve(self, **changes)
+
+    def describe(self):
+        return '\n'.join([
+            f'price per room <= {self.max_price_per_room or "any"}',
+            f'metro: {", ".join(self.metros) or "any"}',
+            f'blacklist: {", ".join(self.metro_blacklist) or "none"}',
+            f'payment period: {", ".join(self.payment_periods) or "any"}',
+            f'changes: {"on" if self.changes else "off"}',
+        ])
+
+
+class FilterEngine:
+    def __init__(self, default=None):
+        self.default = default or ChatFilter()
+        self.chat_filters = dict()  # chat_id -> ChatFilter
+        self.compiled = dict()  # ChatFilter -> ChatFilter.compile()
+        # ChatFilter -> verdict per CianBot.flat_log position:
+        # 0 not known yet, 1 accepted, 2 rejected
+        self.verdicts = dict()
+
+    def get(self, chat_id):
+        return self.chat_filters.get(chat_id, self.default)
+
+    def set(self, chat_id, chat_filter):
+        self.chat_filters[chat_id] = chat_filter
+
+    def check(self, chat_filter):
+        if chat_filter not in self.compiled:
+            self.compiled[chat_filter] = chat_filter.compile()
+        return self.compiled[chat_filter]
+
+    def accepts(self, chat_id, flat):
+        return self.check(self.get(chat_id))(
+            flat, normalize_metros(flat.metros)) is None
+
+    def accepts_at(self, chat_id, position, flat):
+        """accepts(), memoized for the flat at `position` in the flat log"""
+        chat_filter = self.get(chat_id)
+        verdicts = self.verdicts.setdefault(chat_filter, bytearray())
+        if len(verdicts) <= position:
+            verdicts.extend(bytes(position + 1 - len(verdicts)))
+        if verdicts[position] == 0:
+            verdicts[position] = 1 if self.accepts(chat_id, flat) else 2
+        return verdicts[position] == 1
+
+    def route(self, flats, chat_ids):
+        """Yields (flat, [chat_id]) for every flat accepted by some chat"""
+        groups = collections.defaultdict(list)
+        for chat_id in chat_ids:
+            groups[self.get(chat_id)].append(chat_id)
+        groups = [(self.check(f), chats) for f, chats in groups.items()]
+        # criterion -> evaluations it failed, None for those that passed
+        verdicts = collections.Counter()
+        rejected = 0
+        for flat in flats:
+            metros = normalize_metros(flat.metros)
+            chats = []
+            for check, group in groups:
+                criterion = check(flat, metros)
+                verdicts[criterion] += 1
+                if criterion is None:
+                    chats.extend(group)
+            if chats:
+                yield flat, chats
+            else:
+                rejected += 1
+        for criterion, n in verdicts.items():
+            if criterion is None:
+                VERDICTS.inc(n, verdict='pass')
+            else:
+                VERDICTS.inc(n, verdict='reject', criterion=criterion)
+        if rejected > 0:
+            logger.debug('route: %d flats rejected by every chat', rejected)
@@ -0,0 +1,116 @@
+"""Logging off the hot path.
+
+Records are put on a queue by QueueHandler and written by a QueueListener
+thread, so the JobQueue thread never waits on a disk or a terminal. The
+queue keeps records as they are, and messages are only formatted by the
+listener. That only helps when calls pass %-style arguments instead of
+f-strings:
+
+    logger.debug('deliver: %s to %s', flat_id, chat_id,
+                 extra=dict(flat_id=flat_id, chat_id=chat_id))
+
+The log file is written as JSON lines, with `extra` fields as keys.
+RateLimitFilter lets only the first few records of the same debug message
+through per period, so per-flat debug lines don't swamp the log during a
+large crawl. It then reports how many were dropped."""
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+# Attributes every LogRecord has; the rest came from `extra`
+RESERVED = frozenset(
+    vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message'}
+
+# Debug records of the same message let through per period
+BURST = 20
+PERIOD = 60.0
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = dict(t=round(record.created, 3),
+                     level=record.levelname,
+                     logger=record.name,
+                     thread=record.threadName,
+                     msg=record.getMessage())
+        entry.update(
+            (k, v) for k, v in vars(record).items() if k not in RESERVED)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Unlike QueueHandler, doesn't format the message before queueing it.
+    Arguments are formatted later, by the listener thread, so they must
+    not be changed after they are logged."""
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most `burst` records with the same logger and message
+    template every `period` seconds, for levels up to `level`. The first
+    record let through after some were dropped has a `suppressed` count."""
+    def __init__(self, burst=BURST, period=PERIOD, level=logging.DEBUG):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.level = level
+        self.lock = threading.Lock()
+        self.windows = dict()  # (logger, template) -> [start, passed, dropped]
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.period:
+                if len(self.windows) > 10000:
+                    # Formatted messages logged as templates; forget them
+                    self.windows.clear()
+                self.windows[key] = [now, 1, 0]
+                if window is not None and window[2] > 0:
+                    record.suppressed = window[2]
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def setup(path=None,
+          file_level=logging.DEBUG,
+          stdout_level=logging.INFO,
+          burst=BURST,
+          period=PERIOD):
+    """Makes the `cian_bot` logger write JSON lines to `path`, unless it's
+    None, and messages to stderr, from a listener thread. Returns the
+    started QueueListener; stop() it to flush the queue on exit."""
+    handlers = []
+    if path is not None:
+        to_file = logging.FileHandler(path, encoding='utf8')
+        to_file.setLevel(file_level)
+        to_file.setFormatter(JsonFormatter())
+        handlers.append(to_file)
+    to_stdout = logging.StreamHandler()
+    to_stdout.setLevel(stdout_level)
+    handlers.append(to_stdout)
+
+    handler = LazyQueueHandler(queue.Queue())
+    handler.addFilter(RateLimitFilter(burst, period))
+    logger = logging.getLogger('cian_bot')
+    # Calls below every handler's level return before making a record
+    logger.setLevel(min(h.level for h in handlers))
+    logger.addHandler(handler)
+    listener = logging.handlers.QueueListener(handler.queue,
+                                              *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
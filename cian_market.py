@@ -0,0 +1,250 @@
+"""Market summary over every flat we know.
+
+MarketSnapshot keeps the price, rooms, deposit, fee, first metro and
+first-seen time of every flat in NumPy columns, one row per flat. Rows
+are appended as flats are crawled, updated when prices change, and
+tombstoned on eviction. Copies of a flat we already have get no row, and
+the terms of flats not paid monthly are left out of the prices, so that
+daily rents don't pass for bargains. That keeps aggregates over the full
+history to a few vectorized passes, which /market runs. NumPy is
+optional. Without it, NullSnapshot keeps nothing and /market says so."""
+import logging
+import threading
+import time
+
+import cian_filters
+
+np = None  # imported by snapshot(), it takes a while
+
+logger = logging.getLogger('cian_bot.cian_market')
+
+PERCENTILES = (10, 50, 90)
+WINDOWS = ((1, '1d'), (7, '7d'), (30, '30d'))  # days
+# Stations with fewer flats than that aren't worth a median
+MIN_COUNT = 3
+# Stations listed by /market at most, the busiest first
+N_METROS = 20
+# What cian calls the payment period of a monthly rent
+MONTHLY = 'monthly'
+
+COLUMNS = (
+    ('id', 'int64'),
+    ('at', 'float64'),  # first seen, NaN if unknown
+    ('price', 'float64'),
+    ('rooms', 'int16'),
+    ('deposit', 'float64'),
+    ('fee', 'float64'),
+    ('metro', 'int32'),  # index in `metros`, -1 if none
+    ('monthly', 'bool'),  # False if paid otherwise, its terms are NaN
+    ('alive', 'bool'),
+)
+
+
+def number(x):
+    """None and junk become NaN"""
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class NullSnapshot:
+    def load(self, rows):
+        pass
+
+    def add(self, flat, at):
+        pass
+
+    def update(self, flat):
+        pass
+
+    def drop(self, flat_ids):
+        pass
+
+    def summary(self, days=None):
+        return 'Needs numpy, pip install cian_bot[market]'
+
+
+class MarketSnapshot(NullSnapshot):
+    def __init__(self, capacity=1024):
+        self.lock = threading.Lock()
+        self.columns = {
+            name: np.zeros(capacity, dtype)
+            for name, dtype in COLUMNS
+        }
+        self.n = 0  # rows in use, alive or not
+        self.n_dead = 0
+        self.rows = dict()  # flat_id -> row
+        self.metros = []  # metro code -> station name
+        self.codes = dict()  # normalized station name -> metro code
+
+    def metro_code(self, name):
+        if not name:
+            return -1
+        key = cian_filters.normalize_metro(name)
+        if key not in self.codes:
+            self.codes[key] = len(self.metros)
+            self.metros.append(name)
+        return self.codes[key]
+
+    def reserve(self, n):
+        capacity = len(self.columns['id'])
+        if self.n + n <= capacity:
+            return
+        capacity = max(capacity * 2, self.n + n)
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, column.dtype)
+            grown[:self.n] = column[:self.n]
+            self.columns[name] = grown
+
+    def load(self, rows):
+        """rows: (flat_id, price, rooms, deposit, fee, payment period,
+        metro name, first seen), as SqliteStore.market_rows"""
+        rows = list(rows)
+        with self.lock:
+            self.reserve(len(rows))
+            for row in rows:
+                self.append(*row)
+
+    def add(self, flat, at):
+        with self.lock:
+            if flat.id in self.rows:
+                return
+            self.reserve(1)
+            self.append(flat.id, flat.price, flat.rooms, flat.deposit,
+                        flat.fee, flat.payment_period,
+                        flat.metros[0] if flat.metros else None, at)
+
+    def append(self, flat_id, price, rooms, deposit, fee, period, metro, at):
+        i = self.n
+        c = self.columns
+        c['id'][i] = flat_id
+        c['at'][i] = number(at)
+        c['metro'][i] = self.metro_code(metro)
+        c['alive'][i] = True
+        self.set_terms(i, price, rooms, deposit, fee, period)
+        self.rows[flat_id] = i
+        self.n += 1
+
+    def set_terms(self, i, price, rooms, deposit, fee, period):
+        """Offers from before payment periods were parsed have None,
+        and are taken for monthly"""
+        c = self.columns
+        monthly = period is None or period == MONTHLY
+        c['monthly'][i] = monthly
+        c['price'][i] = number(price) if monthly else float('nan')
+        c['rooms'][i] = int(rooms or 1)
+        c['deposit'][i] = number(deposit) if monthly else float('nan')
+        c['fee'][i] = number(fee) if monthly else float('nan')
+
+    def update(self, flat):
+        with self.lock:
+            i = self.rows.get(flat.id)
+            if i is not None:
+                self.set_terms(i, flat.price, flat.rooms, flat.deposit,
+                               flat.fee, flat.payment_period)
+
+    def drop(self, flat_ids):
+        with self.lock:
+            for flat_id in flat_ids:
+                i = self.rows.pop(flat_id, None)
+                if i is not None:
+                    self.columns['alive'][i] = False
+                    self.n_dead += 1
+            if self.n_dead > self.n // 2:
+                self.compact()
+
+    def compact(self):
+        alive = self.columns['alive'][:self.n].copy()
+        for name, column in self.columns.items():
+            kept = column[:self.n][alive]
+            column[:len(kept)] = kept
+        self.n = int(alive.sum())
+        self.n_dead = 0
+        self.rows = {
+            int(flat_id): i
+            for i, flat_id in enumerate(self.columns['id'][:self.n])
+        }
+
+    def view(self, days=None, now=None):
+        """Copies of the columns of alive rows first seen in the last
+        `days` days, all of them if None"""
+        with self.lock:
+            c = {name: column[:self.n] for name, column in self.columns.items()}
+            mask = c['alive'].copy()
+            if days is not None:
+                now = time.time() if now is None else now
+                mask &= c['at'] >= now - days * 24 * 60 * 60
+            view = {name: column[mask] for name, column in c.items()}
+            view['all_at'] = c['at'][c['alive']]
+            return view, list(self.metros)
+
+    @staticmethod
+    def metro_medians(metro, per_room):
+        """[(metro code, median, count)] by count, descending"""
+        known = (metro >= 0) & np.isfinite(per_room)
+        metro, per_room = metro[known], per_room[known]
+        if len(metro) == 0:
+            return []
+        # One sort of both columns folded into a key, several times faster
+        # than lexsort; the rounding is well under a rouble
+        base = per_room.min()
+        span = per_room.max() - base + 1
+        key = np.sort(metro * span + (per_room - base))
+        counts = np.bincount(metro)
+        codes = np.flatnonzero(counts)
+        counts = counts[codes]
+        starts = np.cumsum(counts) - counts
+        medians = (key[starts + (counts - 1) // 2] +
+                   key[starts + counts // 2]) / 2 - codes * span + base
+        by_count = np.argsort(-counts, kind='stable')
+        return [(int(codes[i]), float(medians[i]), int(counts[i]))
+                for i in by_count]
+
+    def summary(self, days=None, now=None):
+        started = time.perf_counter()
+        now = time.time() if now is None else now
+        v, metros = self.view(days, now)
+        lines = [
+            f'{len(v["id"])} flats' +
+            (f' first seen in {days:g} days' if days is not None else '')
+        ]
+        lines.append('new: ' + ', '.join(
+            f'{np.count_nonzero(v["all_at"] >= now - d * 24 * 60 * 60)} in '
+            f'{label}' for d, label in WINDOWS))
+        n_other = np.count_nonzero(~v['monthly'])
+        if n_other > 0:
+            lines.append(f'{n_other} not paid monthly, left out of prices')
+        price = v['price'][np.isfinite(v['price'])]
+        if len(price) > 0:
+            per_room = v['price'] / np.maximum(v['rooms'], 1)
+            for name, values in (('price', price),
+                                 ('per room', per_room[np.isfinite(per_room)])):
+                ps = np.percentile(values, PERCENTILES)
+                lines.append(f'{name}: ' + ' '.join(
+                    f'p{q} {p:.0f}' for q, p in zip(PERCENTILES, ps)))
+            for name in ('deposit', 'fee'):
+                values = v[name][np.isfinite(v[name])]
+                if len(values) > 0:
+                    lines.append(f'{name}: median {np.median(values):.0f}')
+            medians = [(code, median, count)
+                       for code, median, count in self.metro_medians(
+                           v['metro'], per_room) if count >= MIN_COUNT]
+            if medians:
+                lines.append('median per room by metro:')
+                lines.extend(f'  {metros[code]}: {median:.0f} ({count})'
+                             for code, median, count in medians[:N_METROS])
+        lines.append(f'in {(time.perf_counter() - started) * 1000:.1f}ms')
+        return '\n'.join(lines)
+
+
+def snapshot():
+    """A MarketSnapshot if numpy is there"""
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:
+            logger.error('snapshot: no numpy, /market is off')
+            return NullSnapshot()
+    return MarketSnapshot()
@@ -0,0 +1,272 @@
+"""Counters and timers of the fetch -> parse -> filter -> send pipeline.
+
+Metrics live in a process-wide REGISTRY and are rendered in the Prometheus
+text format, served by `serve` on a local port and summarized by the
+/stats command. SamplingProfiler periodically records the stacks of all
+threads while it's on, so a slow bot can be profiled without a restart;
+its output is in the collapsed format flamegraph.pl reads."""
+import bisect
+import collections
+import http.server
+import logging
+import socketserver
+import sys
+import threading
+import time
+
+logger = logging.getLogger('cian_bot.cian_metrics')
+
+# Seconds; Prometheus' default buckets
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                10.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = dict()  # sorted label items -> value
+
+    def header(self):
+        return [
+            f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'
+        ]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + [
+            f'{self.name}{format_labels(k)} {v}' for k, v in sorted(values)
+        ]
+
+    def summary(self):
+        with self.lock:
+            return [(f'{self.name}{format_labels(k)}', f'{v}')
+                    for k, v in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    """Its value is read from `read()` when rendered"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, read):
+        super().__init__(name, help)
+        self.read = read
+
+    def value(self):
+        try:
+            return self.read()
+        except Exception as e:
+            logger.error(f'Gauge: {self.name}: {e}')
+            return float('nan')
+
+    def render(self):
+        return self.header() + [f'{self.name} {self.value()}']
+
+    def summary(self):
+        return [(self.name, f'{self.value()}')]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                # [count per bucket..., +Inf], sum, max
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0.0]
+            counts, total, top = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key][1:] = [total + value, max(top, value)]
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            values = [(k, list(c), t) for k, (c, t, _) in self.values.items()]
+        for key, counts, total in sorted(values):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += n
+                labels = format_labels(key + (('le', bound), ))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(key)} {cumulative}')
+        return lines
+
+    def summary(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        for key, (counts, total, top) in values:
+            n = sum(counts)
+            lines.append((f'{self.name}{format_labels(key)}',
+                          f'n={n} avg={total / n:.3g} max={top:.3g}'))
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started,
+                               **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = collections.OrderedDict()
+
+    def add(self, metric):
+        """Registers `metric`, replacing one of the same name"""
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, read):
+        return self.add(Gauge(name, help, read))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for m in metrics for line in m.render()) + '\n'
+
+    def summary(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(f'{name}: {value}' for m in metrics
+                         for name, value in m.summary())
+
+
+REGISTRY = Registry()
+
+
+def serve(port, registry=REGISTRY, host='127.0.0.1'):
+    """Serves registry.render() at http://host:port/metrics
+    from a daemon thread; returns the server"""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever,
+                     name='cian_metrics',
+                     daemon=True).start()
+    logger.info(f'serve: metrics at http://{host}:{port}/metrics')
+    return server
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}'
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = collections.Counter()  # 'outer;...;inner' -> samples
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return False
+        self.stacks.clear()
+        self.samples = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       name='cian_profiler',
+                                       daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self.running = False
+        self.thread.join()
+        return True
+
+    def run(self):
+        me = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return '\n'.join(f'{s} {n}' for s, n in self.stacks.most_common())
+
+    def top(self, n=15):
+        """Functions by samples they were on the stack in, and on top of"""
+        total, own = collections.Counter(), collections.Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for f in set(frames):
+                total[f] += count
+        lines = [f'{self.samples} samples every {self.interval}s']
+        lines.extend(f'{total[f]} {own[f]} {f}'
+                     for f, _ in total.most_common(n))
+        return '\n'.join(lines)
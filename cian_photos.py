@@ -0,0 +1,203 @@
+"""Photos attached to notifications.
+
+PhotoCache downloads photos in the background as soon as a flat passes
+somebody's filters, keeps them on disk named by the sha256 of their
+content, and evicts the least recently used ones once the directory grows
+over `max_bytes`. It also remembers the Telegram file_id of every photo
+we've uploaded, so the next chat gets the same photo without an upload.
+The index lives in the store, so it survives restarts. It's written once
+the lock is released, since a crawl holds the store's transaction while it
+prefetches."""
+import collections
+import concurrent.futures
+import hashlib
+import logging
+import os
+import os.path as osp
+import tempfile
+import threading
+import time
+
+import attr
+
+logger = logging.getLogger('cian_bot.cian_photos')
+
+N_ATTEMPTS = 5
+
+
+@attr.s(slots=True)
+class Blob:
+    size = attr.ib(type=int)
+    file_id = attr.ib(default=None)
+    urls = attr.ib(factory=set)
+
+
+class PhotoCache:
+    def __init__(self, basedir, store, max_bytes=512 * 2**20, workers=4):
+        self.basedir = basedir
+        self.store = store
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.urls = dict()  # url -> digest
+        self.blobs = collections.OrderedDict()  # digest -> Blob, LRU first
+        self.total_bytes = 0
+        self.pending = dict()  # url -> Future
+        self.workers = workers
+        self.session = None  # made by http(), importing requests is slow
+        self.session_lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    def load(self):
+        for digest, size, file_id in self.store.photo_blobs():
+            if osp.exists(self.path(digest)):
+                self.blobs[digest] = Blob(size, file_id)
+                self.total_bytes += size
+            elif file_id is not None:
+                self.blobs[digest] = Blob(0, file_id)
+        for url, digest in self.store.photos():
+            if digest in self.blobs:
+                self.urls[url] = digest
+                self.blobs[digest].urls.add(url)
+
+    def path(self, digest):
+        return osp.join(self.basedir, digest)
+
+    def prefetch(self, urls):
+        with self.lock:
+            for url in urls:
+                if url in self.urls or url in self.pending:
+                    continue
+                self.pending[url] = self.pool.submit(self.download, url)
+
+    def get(self, url):
+        """Path to the photo, downloading it if needed; None on failure"""
+        with self.lock:
+            digest = self.urls.get(url)
+            if digest is not None and self.blobs[digest].size > 0:
+                row = self.touch(digest)
+            else:
+                row = None
+                future = self.pending.get(url)
+                if future is None:
+                    future = self.pending[url] = self.pool.submit(
+                        self.download, url)
+        if row is None:
+            return future.result()
+        self.store.put_photo_blob(*row)
+        return self.path(digest)
+
+    def file_id(self, url):
+        with self.lock:
+            digest = self.urls.get(url)
+            if digest is None or self.blobs[digest].file_id is None:
+                return None
+            row = self.touch(digest)
+        self.store.put_photo_blob(*row)
+        return row[2]
+
+    def remember_file_id(self, url, file_id):
+        with self.lock:
+            digest = self.urls.get(url)
+            if digest is None or self.blobs[digest].file_id == file_id:
+                return
+            self.blobs[digest].file_id = file_id
+            row = digest, self.blobs[digest].size, file_id, time.time()
+        self.store.put_photo_blob(*row)
+
+    def touch(self, digest):
+        """Moves the blob to the end of the LRU; returns its photo_blobs
+        row, to store once the lock is released"""
+        self.blobs.move_to_end(digest)
+        blob = self.blobs[digest]
+        return digest, blob.size, blob.file_id, time.time()
+
+    def download(self, url):
+        try:
+            for attempt in range(N_ATTEMPTS):
+                try:
+                    return self.download_once(url)
+                except Exception as e:
+                    logger.error(f'download: url={url} attempt={attempt} e={e}')
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(url, None)
+
+    def http(self):
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self.session = requests.Session()
+                for prefix in ('https://', 'http://'):
+                    self.session.mount(prefix,
+                                       HTTPAdapter(pool_maxsize=self.workers))
+            return self.session
+
+    def download_once(self, url):
+        if not osp.exists(self.basedir):
+            os.makedirs(self.basedir, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+        with self.http().get(url, stream=True, timeout=60) as res:
+            res.raise_for_status()
+            fd, tmp = tempfile.mkstemp(dir=self.basedir, prefix='.part-')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    for chunk in res.iter_content(chunk_size=64 * 1024):
+                        sha.update(chunk)
+                        size += len(chunk)
+                        out.write(chunk)
+                digest = sha.hexdigest()
+                os.replace(tmp, self.path(digest))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        with self.lock:
+            blob = self.blobs.setdefault(digest, Blob(0))
+            if blob.size == 0:
+                blob.size = size
+                self.total_bytes += size
+            blob.urls.add(url)
+            self.urls[url] = digest
+            rows = [self.touch(digest)]
+            dropped = self.evict(rows)
+        with self.store.transaction():
+            self.store.put_photo(url, digest)
+            for row in rows:
+                self.store.put_photo_blob(*row)
+            for d in dropped:
+                self.store.drop_photo_blob(d)
+        return self.path(digest)
+
+    def evict(self, rows):
+        """Drops the least recently used files; a photo that has a file_id
+        stays in the index, since we never need its bytes again. Appends
+        the photo_blobs rows that changed to `rows` and returns the
+        digests to drop from the store."""
+        dropped = []
+        for digest, blob in list(self.blobs.items()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if blob.size == 0:
+                continue
+            self.total_bytes -= blob.size
+            blob.size = 0
+            try:
+                os.unlink(self.path(digest))
+            except OSError as e:
+                logger.error(f'evict: {digest}: {e}')
+            if blob.file_id is not None:
+                rows.append((digest, 0, blob.file_id, time.time()))
+                continue
+            del self.blobs[digest]
+            for url in blob.urls:
+                del self.urls[url]
+            dropped.append(digest)
+        return dropped
+
+    def close(self):
+        self.pool.shutdown()
+        if self.session is not None:
+            self.session.close()
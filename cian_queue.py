@@ -0,0 +1,99 @@
+"""A crash-safe queue between processes, in a shared SQLite file.
+
+With --role fetcher and --role notifier the crawler and the Telegram side
+run as separate processes. The fetcher publishes what it found on the
+CRAWL topic, and the notifier forwards /observe on the COMMANDS topic.
+A consumer leases a batch and acks it only after it has committed what it
+did with it. A consumer that dies before acking gets the batch again once
+the lease runs out, so delivery is at least once and consumers must
+tolerate repeats."""
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('cian_bot.cian_queue')
+
+QUEUE_FILE = 'queue.sqlite'
+
+# fetcher -> notifier: new flats, changes of known ones, evictions
+CRAWL = 'crawl'
+# notifier -> fetcher: urls to observe
+COMMANDS = 'commands'
+
+# Seconds a leased batch is hidden from other leases
+LEASE = 60.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    data TEXT NOT NULL,
+    leased_until REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_topic ON messages (topic, id);
+'''
+
+
+class DurableQueue:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Autocommit; transactions are explicit. The timeout waits out
+        # the other process holding the write lock.
+        self.db = sqlite3.connect(path,
+                                  timeout=30,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def put(self, topic, events):
+        """Appends `events`, json-serializable, durably and in order"""
+        rows = [(topic, json.dumps(e, ensure_ascii=False)) for e in events]
+        if len(rows) == 0:
+            return
+        with self.transaction() as db:
+            db.executemany('INSERT INTO messages (topic, data) VALUES (?, ?)',
+                           rows)
+
+    def lease(self, topic, limit=100, lease=LEASE):
+        """Returns up to `limit` of the oldest [(id, event)] nobody holds,
+        and hides them for `lease` seconds"""
+        now = time.time()
+        with self.transaction() as db:
+            rows = db.execute(
+                'SELECT id, data FROM messages WHERE topic = ? '
+                'AND leased_until < ? ORDER BY id LIMIT ?',
+                (topic, now, limit)).fetchall()
+            db.executemany('UPDATE messages SET leased_until = ? WHERE id = ?',
+                           [(now + lease, i) for i, _ in rows])
+        return [(i, json.loads(data)) for i, data in rows]
+
+    def ack(self, ids):
+        with self.transaction() as db:
+            db.executemany('DELETE FROM messages WHERE id = ?',
+                           [(i, ) for i in ids])
+
+    def depth(self, topic):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COUNT(*) FROM messages WHERE topic = ?',
+                (topic, )).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,107 @@
+"""Keeping the state bounded.
+
+CianBot evicts flats that no crawl has seen for a while, together with
+everything kept about them but their ids, so that one coming back isn't
+sent to every chat again. ViewedSet holds the ids a chat has got in a
+sorted array('q'), 8 bytes per id rather than a set's ~40, plus a small
+set of the latest ones that's merged into the array once it grows.
+state_report() tells how much memory and database space every part of
+the state takes."""
+import array
+import bisect
+import collections
+import heapq
+import sys
+import types
+
+# Ids added since the last merge into the sorted array
+MERGE_AT = 64
+
+
+class ViewedSet:
+    __slots__ = ('ids', 'recent')
+
+    def __init__(self, ids=()):
+        self.ids = array.array('q', sorted(set(ids)))
+        self.recent = set()
+
+    def __contains__(self, flat_id):
+        if flat_id in self.recent:
+            return True
+        i = bisect.bisect_left(self.ids, flat_id)
+        return i < len(self.ids) and self.ids[i] == flat_id
+
+    def add(self, flat_id):
+        if flat_id in self:
+            return
+        self.recent.add(flat_id)
+        if len(self.recent) >= MERGE_AT:
+            self.merge()
+
+    def merge(self):
+        if self.recent:
+            self.ids = array.array(
+                'q', heapq.merge(self.ids, sorted(self.recent)))
+            self.recent.clear()
+
+    def discard_all(self, flat_ids):
+        self.merge()
+        self.ids = array.array('q',
+                               (i for i in self.ids if i not in flat_ids))
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
+
+    def __iter__(self):
+        self.merge()
+        return iter(self.ids)
+
+
+def sizeof(obj, seen=None):
+    """Approximate deep size in bytes of containers, attrs classes and the
+    scalars in them; functions and modules aren't followed"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(
+            obj, (types.FunctionType, types.MethodType, types.ModuleType,
+                  type)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(sizeof(x, seen) for x in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(
+            sizeof(getattr(obj, s), seen) for s in obj.__slots__
+            if hasattr(obj, s))
+    elif hasattr(obj, '__dict__'):
+        size += sizeof(vars(obj), seen)
+    return size
+
+
+def format_bytes(n):
+    for unit in ('B', 'KiB', 'MiB'):
+        if n < 1024:
+            return f'{n:.0f}{unit}'
+        n /= 1024
+    return f'{n:.1f}GiB'
+
+
+def state_report(components, tables):
+    """components: {name: object}, tables: as SqliteStore.table_sizes"""
+    lines = ['memory:']
+    total = 0
+    for name, obj in components.items():
+        size = sizeof(obj)
+        total += size
+        lines.append(f'  {name}: {format_bytes(size)}')
+    lines.append(f'  total: {format_bytes(total)}')
+    lines.append('database:')
+    for table, rows, size in tables:
+        parts = [] if rows is None else [f'{rows} rows']
+        if size is not None:
+            parts.append(format_bytes(size))
+        lines.append(f'  {table}: {", ".join(parts)}')
+    return '\n'.join(lines)
@@ -0,0 +1,149 @@
+"""When to poll each observed url.
+
+PollScheduler keeps a heap of observed urls ordered by the time they're due.
+Every url has its own interval, adapted to the rate it produces new offers
+at: a search that keeps yielding new flats is polled more often, down to
+`min_interval`, and one that has gone quiet is polled less often, up to
+`max_interval`. Due times are jittered so urls don't end up polled in
+bursts."""
+import heapq
+import logging
+import random
+import threading
+import time
+
+import attr
+
+logger = logging.getLogger('cian_bot.cian_scheduler')
+
+MIN_INTERVAL = 10 * 60.0
+MAX_INTERVAL = 6 * 60 * 60.0
+JITTER = 0.1
+# Aim for that many new offers per poll: well within one results page,
+# so that nothing slips past the first page between two polls
+TARGET_NEW = 5.0
+# Weight of the latest poll in the new offers rate
+SMOOTHING = 0.3
+
+
+@attr.s(slots=True)
+class UrlSchedule:
+    interval = attr.ib(type=float)
+    rate = attr.ib(default=None)  # new offers per second, None until known
+    due = attr.ib(default=0.0)
+    polled = attr.ib(default=None)  # time.monotonic() of the last poll
+    in_flight = attr.ib(default=False)
+
+
+class PollScheduler:
+    def __init__(self,
+                 min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL,
+                 jitter=JITTER):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.urls = dict()  # url -> UrlSchedule
+        self.heap = []  # (due, url), stale when it doesn't match UrlSchedule
+
+    def clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def add(self, url, delay=0.0, interval=None, rate=None):
+        """Starts polling `url` in `delay` seconds; interval and rate are
+        what was learnt about it before a restart"""
+        with self.lock:
+            if url in self.urls:
+                return False
+            if interval is None:
+                # Poll a new url often until we learn how busy it is
+                interval = self.min_interval
+            entry = self.urls[url] = UrlSchedule(self.clamp(interval), rate)
+            self.push(url, entry, time.monotonic() + delay)
+            return True
+
+    def remove(self, url):
+        with self.lock:
+            self.urls.pop(url, None)
+
+    def push(self, url, entry, due):
+        entry.due = due
+        heapq.heappush(self.heap, (due, url))
+
+    def claim(self, urls):
+        """Takes `urls` off the schedule to poll them right away;
+        returns those not being polled already"""
+        claimed = []
+        with self.lock:
+            for url in urls:
+                entry = self.urls.get(url)
+                if entry is not None and not entry.in_flight:
+                    entry.in_flight = True
+                    claimed.append(url)
+        return claimed
+
+    def has_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.drop_stale()
+            return len(self.heap) > 0 and self.heap[0][0] <= now
+
+    def pop_due(self, now=None):
+        """Urls due by `now`; they're off the schedule until done()"""
+        now = time.monotonic() if now is None else now
+        due = []
+        with self.lock:
+            while True:
+                self.drop_stale()
+                if len(self.heap) == 0 or self.heap[0][0] > now:
+                    break
+                _, url = heapq.heappop(self.heap)
+                self.urls[url].in_flight = True
+                due.append(url)
+        return due
+
+    def drop_stale(self):
+        while len(self.heap) > 0:
+            due, url = self.heap[0]
+            entry = self.urls.get(url)
+            if entry is not None and not entry.in_flight and entry.due == due:
+                return
+            heapq.heappop(self.heap)
+
+    def done(self, url, n_new, now=None):
+        """Reschedules `url` after a poll that found `n_new` new offers;
+        n_new is None when the poll failed and tells nothing.
+        Returns None if `url` was removed meanwhile"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.urls.get(url)
+            if entry is None:
+                return None
+            if n_new is not None and entry.polled is not None:
+                rate = n_new / max(now - entry.polled, 1.0)
+                entry.rate = (rate if entry.rate is None else SMOOTHING * rate
+                              + (1 - SMOOTHING) * entry.rate)
+                target = (TARGET_NEW /
+                          entry.rate if entry.rate > 0 else self.max_interval)
+                # Back off gradually, a single quiet poll means little
+                entry.interval = self.clamp(min(target, entry.interval * 2))
+            if n_new is not None:
+                entry.polled = now
+            entry.in_flight = False
+            jitter = random.uniform(1 - self.jitter, 1 + self.jitter)
+            self.push(url, entry, now + entry.interval * jitter)
+            logger.debug('done: %s n_new=%s next in %.0fs',
+                         url,
+                         n_new,
+                         entry.interval * jitter,
+                         extra=dict(url=url))
+            return entry
+
+    def next_due(self):
+        """Seconds until the next url is due, None if nothing's scheduled"""
+        with self.lock:
+            self.drop_stale()
+            if len(self.heap) == 0:
+                return None
+            return max(0.0, self.heap[0][0] - time.monotonic())
@@ -0,0 +1,250 @@
+"""Delivery of scheduled messages within Telegram's rate limits.
+
+Sender keeps a queue per chat and a heap of chats ordered by the time
+they're next allowed to receive something. A scheduler thread pops due
+chats, takes tokens from a global bucket and hands the deliveries to a
+pool of workers, so different chats are served in parallel while every
+single chat gets its messages in order and no faster than its limit.
+Telegram's RetryAfter postpones just the chat it was raised for. Errors
+that retrying won't fix, BadRequest and Unauthorized, drop the message
+instead, and every message queued for a chat that blocked the bot or is
+gone."""
+import collections
+import concurrent.futures
+import heapq
+import logging
+import threading
+import time
+
+import attr
+from telegram.error import BadRequest, RetryAfter, Unauthorized
+
+import cian_metrics
+
+logger = logging.getLogger('cian_bot.cian_sender')
+
+SEND_SECONDS = cian_metrics.REGISTRY.histogram(
+    'cian_send_seconds', 'Time to deliver a message to a chat')
+SEND_RESULTS = cian_metrics.REGISTRY.counter(
+    'cian_send_results_total', 'Deliveries by result')
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30.0  # API calls per second
+CHAT_INTERVAL = 1.0  # seconds between calls to the same private chat
+GROUP_INTERVAL = 3.0  # 20 per minute in groups
+MAX_BACKOFF = 300.0
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now, n=1):
+        """Seconds until `n` tokens are available"""
+        self.refill(now)
+        return max(0.0, (min(n, self.capacity) - self.tokens) / self.rate)
+
+    def take(self, now, n=1):
+        self.refill(now)
+        self.tokens -= n
+
+
+@attr.s
+class SenderStats:
+    sent = attr.ib(default=0)
+    failed = attr.ib(default=0)
+    retry_after = attr.ib(default=0)
+    dropped = attr.ib(default=0)
+    latency_total = attr.ib(default=0.0)
+    latency_max = attr.ib(default=0.0)
+
+    @property
+    def latency_avg(self):
+        return self.latency_total / self.sent if self.sent else 0.0
+
+
+def api_calls(msg):
+    """How many Bot API calls delivering `msg` takes"""
+    return (1 + ('document' in msg) + (len(msg.get('photos', ())) >= 2))
+
+
+def chat_interval(chat_id):
+    return GROUP_INTERVAL if chat_id < 0 else CHAT_INTERVAL
+
+
+def chat_gone(error):
+    """Whether no message will ever get to the chat: the bot was blocked
+    or kicked, the user deactivated, the chat deleted"""
+    return isinstance(error, Unauthorized) or (
+        isinstance(error, BadRequest) and 'chat not found' in str(error).lower())
+
+
+class Sender:
+    def __init__(self,
+                 deliver,
+                 on_delivered,
+                 workers=4,
+                 rate=GLOBAL_RATE,
+                 on_dropped=None):
+        """deliver(chat_id, msg) does the API calls and raises on failure;
+        on_delivered(entry, chat_id) is called once it succeeded, and
+        on_dropped([entry], chat_id, chat_gone) once they failed for good"""
+        self.deliver = deliver
+        self.on_delivered = on_delivered
+        self.on_dropped = on_dropped
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.queues = collections.defaultdict(collections.deque)
+        self.due = []  # heap of (time, chat_id) for chats with messages
+        self.busy = set()  # chats in self.due or being delivered to
+        self.failures = collections.Counter()  # chat_id -> in a row
+        self.in_flight = 0
+        self.depth = 0
+        self.stats = SenderStats()
+        self.cond = threading.Condition()
+        self.running = False
+        self.pool = None
+        self.thread = None
+
+    def submit(self, entry):
+        now = time.monotonic()
+        with self.cond:
+            for chat_id in entry.chat_ids:
+                self.queues[chat_id].append(entry)
+                self.depth += 1
+                if chat_id not in self.busy:
+                    self.busy.add(chat_id)
+                    heapq.heappush(self.due, (now, chat_id))
+            self.cond.notify()
+
+    def start(self):
+        self.running = True
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self.thread = threading.Thread(target=self.run,
+                                       name='cian_sender',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.pool.shutdown()
+
+    def next_delivery(self):
+        with self.cond:
+            while self.running:
+                if len(self.due) == 0 or self.in_flight >= self.workers:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                due, chat_id = self.due[0]
+                cost = api_calls(self.queues[chat_id][0].msg)
+                delay = max(due - now, self.bucket.delay(now, cost))
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                heapq.heappop(self.due)
+                self.bucket.take(now, cost)
+                self.in_flight += 1
+                return chat_id, self.queues[chat_id].popleft()
+        return None
+
+    def run(self):
+        while True:
+            delivery = self.next_delivery()
+            if delivery is None:
+                return
+            self.pool.submit(self.send, *delivery)
+
+    def send(self, chat_id, entry):
+        started = time.monotonic()
+        retry_after = None
+        try:
+            self.deliver(chat_id, entry.msg)
+        except RetryAfter as e:
+            logger.error(f'send: {chat_id} asked to retry after {e.retry_after}')
+            retry_after = float(e.retry_after)
+        except (BadRequest, Unauthorized) as e:
+            logger.error(f'send: dropping a message to {chat_id}: {e}')
+            self.drop(chat_id, entry, e)
+            return
+        except Exception as e:
+            logger.error(f'send: failed sending to {chat_id}: {e}')
+        else:
+            latency = time.monotonic() - started
+            try:
+                self.on_delivered(entry, chat_id)
+            except Exception as e:
+                logger.error(f'send: on_delivered {chat_id}: {e}')
+            self.done(chat_id, entry, latency)
+            return
+        self.retry(chat_id, entry, retry_after)
+
+    def done(self, chat_id, entry, latency):
+        now = time.monotonic()
+        SEND_SECONDS.observe(latency)
+        SEND_RESULTS.inc(result='sent')
+        with self.cond:
+            self.stats.sent += 1
+            self.stats.latency_total += latency
+            self.stats.latency_max = max(self.stats.latency_max, latency)
+            self.failures.pop(chat_id, None)
+            self.depth -= 1
+            self.reschedule(
+                chat_id, now + chat_interval(chat_id) * api_calls(entry.msg))
+
+    def retry(self, chat_id, entry, retry_after):
+        now = time.monotonic()
+        with self.cond:
+            SEND_RESULTS.inc(
+                result='failed' if retry_after is None else 'retry_after')
+            if retry_after is None:
+                self.stats.failed += 1
+                self.failures[chat_id] += 1
+                retry_after = min(MAX_BACKOFF, 2**self.failures[chat_id])
+            else:
+                self.stats.retry_after += 1
+            self.queues[chat_id].appendleft(entry)
+            self.reschedule(chat_id, now + retry_after)
+
+    def drop(self, chat_id, entry, error):
+        """Gives up on `entry`, and on the rest of the chat's queue if the
+        chat is gone"""
+        gone = chat_gone(error)
+        now = time.monotonic()
+        with self.cond:
+            dropped = [entry]
+            if gone:
+                dropped.extend(self.queues[chat_id])
+                self.queues[chat_id].clear()
+            SEND_RESULTS.inc(len(dropped), result='dropped')
+            self.stats.dropped += len(dropped)
+            self.failures.pop(chat_id, None)
+            self.depth -= len(dropped)
+            self.reschedule(chat_id, now + chat_interval(chat_id))
+        if self.on_dropped is None:
+            return
+        try:
+            self.on_dropped(dropped, chat_id, gone)
+        except Exception as e:
+            logger.error(f'drop: on_dropped {chat_id}: {e}')
+
+    def reschedule(self, chat_id, due):
+        self.in_flight -= 1
+        if len(self.queues[chat_id]) > 0:
+            heapq.heappush(self.due, (due, chat_id))
+        else:
+            del self.queues[chat_id]
+            self.busy.discard(chat_id)
+        self.cond.notify()
@@ -0,0 +1,659 @@
+"""Persistent state of the bot.
+
+SqliteStore keeps flats, per-chat viewed ids, observed urls and the outbox
+in a WAL-mode SQLite database. Every mutation of CianBot state is written
+through as a single-row statement. The statements of one logical operation,
+a crawled page or a batch of queued events, are grouped by `transaction`,
+which commits them together; other writes commit on their own. Raw offer
+json is kept zlib-compressed in a table of its own and is only read back
+on demand. NullStore is used when there's no state dir. It keeps nothing
+but the last MAX_OFFERS raw offers, in memory, so that /json and change
+notifications still work for recent flats."""
+import collections
+import contextlib
+import json
+import logging
+import os.path as osp
+import sqlite3
+import threading
+import zlib
+
+logger = logging.getLogger('cian_bot.cian_store')
+
+DB_FILE = 'state.sqlite'
+# Raw offers NullStore keeps, a few kB each
+MAX_OFFERS = 5000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS flats (
+    id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS offers (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS flat_details (
+    id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS flat_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    flat_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_cursors (
+    chat_id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_filters (
+    chat_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS viewed (
+    chat_id INTEGER NOT NULL,
+    flat_id INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, flat_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS viewed_flat_id ON viewed (flat_id);
+CREATE TABLE IF NOT EXISTS observed_urls (
+    url TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox_targets (
+    outbox_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    PRIMARY KEY (outbox_id, chat_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS photos (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS photos_digest ON photos (digest);
+CREATE TABLE IF NOT EXISTS photo_blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    file_id TEXT,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fetch_cache (
+    url TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    key INTEGER PRIMARY KEY,
+    flat_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS duplicates (
+    flat_id INTEGER PRIMARY KEY,
+    original_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS offer_hashes (
+    flat_id INTEGER PRIMARY KEY,
+    hash INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS price_changes (
+    flat_id INTEGER NOT NULL,
+    at REAL NOT NULL,
+    before REAL NOT NULL,
+    after REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS last_seen (
+    flat_id INTEGER PRIMARY KEY,
+    at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS first_seen (
+    flat_id INTEGER PRIMARY KEY,
+    at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS evicted_ids (
+    flat_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS unrouted (
+    flat_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS poll_schedules (
+    url TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+'''
+
+# Tables with a column of flat ids to evict from
+FLAT_TABLES = (
+    ('flats', 'id'),
+    ('offers', 'id'),
+    ('flat_details', 'id'),
+    ('flat_log', 'flat_id'),
+    ('viewed', 'flat_id'),
+    ('fingerprints', 'flat_id'),
+    ('duplicates', 'flat_id'),
+    ('duplicates', 'original_id'),
+    ('offer_hashes', 'flat_id'),
+    ('price_changes', 'flat_id'),
+    ('last_seen', 'flat_id'),
+    ('first_seen', 'flat_id'),
+    ('unrouted', 'flat_id'),
+)
+
+
+def dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+class NullStore:
+    def __init__(self, max_offers=MAX_OFFERS):
+        # flat_id -> offer json, for /json; least recently used first
+        self.offers = collections.OrderedDict()
+        self.max_offers = max_offers
+
+    def flat_ids(self):
+        return iter(())
+
+    def get_flat(self, flat_id):
+        raise KeyError(flat_id)
+
+    def flat_details(self):
+        return iter(())
+
+    def viewed(self):
+        return dict()
+
+    def fingerprints(self):
+        return iter(())
+
+    def duplicates(self):
+        return iter(())
+
+    def offer_hashes(self):
+        return iter(())
+
+    def last_seen(self):
+        return iter(())
+
+    def market_rows(self):
+        return iter(())
+
+    def evicted_ids(self):
+        return iter(())
+
+    def unrouted(self):
+        return iter(())
+
+    def table_sizes(self):
+        return []
+
+    def price_changes(self):
+        return iter(())
+
+    def observed_urls(self):
+        return list()
+
+    def outbox(self):
+        return iter(())
+
+    def fetch_cache(self):
+        return iter(())
+
+    def poll_schedules(self):
+        return iter(())
+
+    def chat_filters(self):
+        return iter(())
+
+    def flat_log(self):
+        return iter(())
+
+    def cursors(self):
+        return iter(())
+
+    def photos(self):
+        return iter(())
+
+    def photo_blobs(self):
+        return iter(())
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield
+
+    def put_flat(self, flat_id, data):
+        pass
+
+    def get_offer(self, flat_id):
+        if flat_id not in self.offers:
+            return None
+        self.offers.move_to_end(flat_id)
+        return self.offers[flat_id]
+
+    def put_offer(self, flat_id, offer):
+        self.offers[flat_id] = offer
+        self.offers.move_to_end(flat_id)
+        while len(self.offers) > self.max_offers:
+            self.offers.popitem(last=False)
+
+    def put_flat_details(self, flat_id, data):
+        pass
+
+    def drop_flat_details(self, flat_ids):
+        pass
+
+    def add_chat(self, chat_id):
+        pass
+
+    def remove_chat(self, chat_id):
+        pass
+
+    def add_viewed(self, chat_id, flat_id):
+        pass
+
+    def put_fingerprints(self, rows):
+        pass
+
+    def put_duplicate(self, flat_id, original_id):
+        pass
+
+    def put_offer_hash(self, flat_id, offer_hash):
+        pass
+
+    def add_price_change(self, flat_id, at, before, after):
+        pass
+
+    def put_last_seen(self, rows):
+        pass
+
+    def put_first_seen(self, flat_id, at):
+        pass
+
+    def put_unrouted(self, flat_ids):
+        pass
+
+    def drop_unrouted(self, flat_ids):
+        pass
+
+    def evict_flats(self, flat_ids):
+        for i in flat_ids:
+            self.offers.pop(i, None)
+
+    def put_chat_filter(self, chat_id, data):
+        pass
+
+    def log_flat(self, flat_id):
+        pass
+
+    def put_cursors(self, cursors):
+        pass
+
+    def add_observed_url(self, url):
+        pass
+
+    def push_message(self, msg, chat_ids):
+        return None
+
+    def drop_target(self, outbox_id, chat_id):
+        pass
+
+    def put_fetch_cache(self, url, data):
+        pass
+
+    def put_poll_schedule(self, url, data):
+        pass
+
+    def put_photo(self, url, digest):
+        pass
+
+    def put_photo_blob(self, digest, size, file_id, last_used):
+        pass
+
+    def drop_photo_blob(self, digest):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteStore(NullStore):
+    def __init__(self, path):
+        self.path = path
+        # Called from the JobQueue, the dispatcher's workers, run_async and
+        # the photo and detail threads. A transaction holds it from BEGIN
+        # to COMMIT.
+        self.lock = threading.RLock()
+        self.depth = 0  # transaction() nesting in the thread holding it
+        # Autocommit; transactions are explicit
+        self.db = sqlite3.connect(path,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Commits the writes of one logical operation together. No other
+        thread writes in between, let alone commits them half done; nested
+        transactions are part of the outer one. An exception commits what
+        was written before it, as the in-memory state the store mirrors
+        isn't rolled back either, so only a crash loses a transaction."""
+        with self.lock:
+            if self.depth == 0:
+                self.db.execute('BEGIN IMMEDIATE')
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.db.execute('COMMIT')
+
+    def query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def execute(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args)
+
+    def flat_ids(self):
+        return [i for i, in self.query('SELECT id FROM flats')]
+
+    def get_flat(self, flat_id):
+        rows = self.query('SELECT data FROM flats WHERE id = ?', flat_id)
+        if len(rows) == 0:
+            raise KeyError(flat_id)
+        return json.loads(rows[0][0])
+
+    def flat_details(self):
+        for flat_id, data in self.query('SELECT id, data FROM flat_details'):
+            yield flat_id, json.loads(data)
+
+    def viewed(self):
+        viewed = {c: set() for c, in self.query('SELECT chat_id FROM chats')}
+        for chat_id, flat_id in self.query(
+                'SELECT chat_id, flat_id FROM viewed'):
+            viewed.setdefault(chat_id, set()).add(flat_id)
+        return viewed
+
+    def fingerprints(self):
+        return self.query('SELECT key, flat_id FROM fingerprints')
+
+    def duplicates(self):
+        return self.query('SELECT flat_id, original_id FROM duplicates')
+
+    def offer_hashes(self):
+        return self.query('SELECT flat_id, hash FROM offer_hashes')
+
+    def price_changes(self):
+        """(flat_id, at, before, after) in the order they were added"""
+        return self.query(
+            'SELECT flat_id, at, before, after FROM price_changes '
+            'ORDER BY rowid')
+
+    def last_seen(self):
+        return self.query('SELECT flat_id, at FROM last_seen')
+
+    def evicted_ids(self):
+        return [i for i, in self.query('SELECT flat_id FROM evicted_ids')]
+
+    def unrouted(self):
+        return [i for i, in self.query('SELECT flat_id FROM unrouted')]
+
+    def market_rows(self):
+        """(flat_id, price, rooms, deposit, fee, payment period, first
+        metro, first seen) of every flat, read without decoding the json
+        in Python. Flats from before first_seen count as first seen when
+        last seen."""
+        return self.query(
+            "SELECT f.id, json_extract(f.data, '$.price'), "
+            "json_extract(f.data, '$.rooms'), "
+            "json_extract(f.data, '$.deposit'), "
+            "json_extract(f.data, '$.fee'), "
+            "json_extract(f.data, '$.payment_period'), "
+            "json_extract(f.data, '$.metros[0]'), "
+            'COALESCE(s.at, l.at) FROM flats f '
+            'LEFT JOIN first_seen s ON s.flat_id = f.id '
+            'LEFT JOIN last_seen l ON l.flat_id = f.id')
+
+    def table_sizes(self):
+        """[(table, rows, bytes)]; bytes are None without the dbstat
+        virtual table, and for the files as a whole rows are None"""
+        with self.lock:
+            tables = [
+                t for t, in self.db.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name NOT LIKE 'sqlite_%' ORDER BY name")
+            ]
+            try:
+                sizes = dict(
+                    self.db.execute('SELECT name, SUM(pgsize) FROM dbstat '
+                                    'GROUP BY name'))
+            except sqlite3.OperationalError:
+                sizes = dict()
+            sizes = [(t, self.db.execute(f'SELECT COUNT(*) FROM {t}').
+                      fetchone()[0], sizes.get(t)) for t in tables]
+        for suffix in ('', '-wal'):
+            if osp.exists(self.path + suffix):
+                sizes.append((osp.basename(self.path + suffix), None,
+                              osp.getsize(self.path + suffix)))
+        return sizes
+
+    def observed_urls(self):
+        return [
+            u for u, in self.query('SELECT url FROM observed_urls ORDER BY url')
+        ]
+
+    def outbox(self):
+        """Yields (outbox_id, message, chat_ids)"""
+        targets = collections.defaultdict(list)
+        for outbox_id, chat_id in self.query(
+                'SELECT outbox_id, chat_id FROM outbox_targets'):
+            targets[outbox_id].append(chat_id)
+        for outbox_id, msg in self.query(
+                'SELECT id, message FROM outbox ORDER BY id'):
+            msg = json.loads(msg)
+            if outbox_id in targets:
+                yield outbox_id, msg, targets[outbox_id]
+            elif 'chat_id' in msg:
+                # Written before messages were shared between chats
+                yield outbox_id, msg, [msg.pop('chat_id')]
+
+    def fetch_cache(self):
+        for url, data in self.query('SELECT url, data FROM fetch_cache'):
+            yield url, json.loads(data)
+
+    def poll_schedules(self):
+        for url, data in self.query('SELECT url, data FROM poll_schedules'):
+            yield url, json.loads(data)
+
+    def chat_filters(self):
+        for chat_id, data in self.query(
+                'SELECT chat_id, data FROM chat_filters'):
+            yield chat_id, json.loads(data)
+
+    def flat_log(self):
+        return [
+            i for i, in self.query('SELECT flat_id FROM flat_log ORDER BY seq')
+        ]
+
+    def cursors(self):
+        return self.query('SELECT chat_id, position FROM chat_cursors')
+
+    def photos(self):
+        return self.query('SELECT url, digest FROM photos')
+
+    def photo_blobs(self):
+        """(digest, size, file_id), least recently used first"""
+        return self.query('SELECT digest, size, file_id FROM photo_blobs '
+                          'ORDER BY last_used')
+
+    def put_flat(self, flat_id, data):
+        self.execute('INSERT OR REPLACE INTO flats (id, data) VALUES (?, ?)',
+                     flat_id, dumps(data))
+
+    def get_offer(self, flat_id):
+        rows = self.query('SELECT data FROM offers WHERE id = ?', flat_id)
+        if len(rows) == 0:
+            return None
+        return json.loads(zlib.decompress(rows[0][0]).decode('utf8'))
+
+    def put_offer(self, flat_id, offer):
+        self.execute('INSERT OR REPLACE INTO offers (id, data) VALUES (?, ?)',
+                     flat_id, zlib.compress(dumps(offer).encode('utf8')))
+
+    def put_flat_details(self, flat_id, data):
+        self.execute(
+            'INSERT OR REPLACE INTO flat_details (id, data) VALUES (?, ?)',
+            flat_id, dumps(data))
+
+    def drop_flat_details(self, flat_ids):
+        with self.lock:
+            self.db.executemany('DELETE FROM flat_details WHERE id = ?',
+                                [(i, ) for i in flat_ids])
+
+    def add_chat(self, chat_id):
+        with self.transaction():
+            self.execute('INSERT OR IGNORE INTO chats (chat_id) VALUES (?)',
+                         chat_id)
+            self.execute('DELETE FROM viewed WHERE chat_id = ?', chat_id)
+
+    def remove_chat(self, chat_id):
+        """Everything about the chat but its filter, which /start reuses"""
+        with self.transaction():
+            for table in ('chats', 'chat_cursors', 'viewed', 'outbox_targets'):
+                self.execute(f'DELETE FROM {table} WHERE chat_id = ?', chat_id)
+            self.execute('DELETE FROM outbox WHERE id NOT IN '
+                         '(SELECT outbox_id FROM outbox_targets)')
+
+    def add_viewed(self, chat_id, flat_id):
+        self.execute(
+            'INSERT OR IGNORE INTO viewed (chat_id, flat_id) VALUES (?, ?)',
+            chat_id, flat_id)
+
+    def put_fingerprints(self, rows):
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO fingerprints (key, flat_id) '
+                'VALUES (?, ?)', rows)
+
+    def put_duplicate(self, flat_id, original_id):
+        self.execute(
+            'INSERT OR REPLACE INTO duplicates (flat_id, original_id) '
+            'VALUES (?, ?)', flat_id, original_id)
+
+    def put_offer_hash(self, flat_id, offer_hash):
+        self.execute(
+            'INSERT OR REPLACE INTO offer_hashes (flat_id, hash) VALUES (?, ?)',
+            flat_id, offer_hash)
+
+    def add_price_change(self, flat_id, at, before, after):
+        self.execute(
+            'INSERT INTO price_changes (flat_id, at, before, after) '
+            'VALUES (?, ?, ?, ?)', flat_id, at, before, after)
+
+    def put_first_seen(self, flat_id, at):
+        self.execute(
+            'INSERT OR IGNORE INTO first_seen (flat_id, at) VALUES (?, ?)',
+            flat_id, at)
+
+    def put_unrouted(self, flat_ids):
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO unrouted (flat_id) VALUES (?)',
+                [(i, ) for i in flat_ids])
+
+    def drop_unrouted(self, flat_ids):
+        with self.lock:
+            self.db.executemany('DELETE FROM unrouted WHERE flat_id = ?',
+                                [(i, ) for i in flat_ids])
+
+    def put_last_seen(self, rows):
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO last_seen (flat_id, at) VALUES (?, ?)',
+                rows)
+
+    def evict_flats(self, flat_ids):
+        with self.transaction():
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS evicted '
+                            '(id INTEGER PRIMARY KEY)')
+            self.db.execute('DELETE FROM evicted')
+            self.db.executemany('INSERT OR IGNORE INTO evicted VALUES (?)',
+                                [(i, ) for i in flat_ids])
+            for table, column in FLAT_TABLES:
+                self.db.execute(
+                    f'DELETE FROM {table} WHERE {column} IN evicted')
+            self.db.execute('INSERT OR IGNORE INTO evicted_ids '
+                            'SELECT id FROM evicted')
+
+    def put_chat_filter(self, chat_id, data):
+        self.execute(
+            'INSERT OR REPLACE INTO chat_filters (chat_id, data) VALUES (?, ?)',
+            chat_id, dumps(data))
+
+    def log_flat(self, flat_id):
+        self.execute('INSERT INTO flat_log (flat_id) VALUES (?)', flat_id)
+
+    def put_cursors(self, cursors):
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO chat_cursors (chat_id, position) '
+                'VALUES (?, ?)', cursors)
+
+    def add_observed_url(self, url):
+        self.execute('INSERT OR IGNORE INTO observed_urls (url) VALUES (?)',
+                     url)
+
+    def push_message(self, msg, chat_ids):
+        with self.transaction():
+            outbox_id = self.execute(
+                'INSERT INTO outbox (message) VALUES (?)',
+                dumps(msg)).lastrowid
+            self.db.executemany(
+                'INSERT OR IGNORE INTO outbox_targets (outbox_id, chat_id) '
+                'VALUES (?, ?)', [(outbox_id, c) for c in chat_ids])
+            return outbox_id
+
+    def drop_target(self, outbox_id, chat_id):
+        if outbox_id is None:
+            return
+        with self.transaction():
+            self.execute(
+                'DELETE FROM outbox_targets WHERE outbox_id = ? AND chat_id = ?',
+                outbox_id, chat_id)
+            self.execute(
+                'DELETE FROM outbox WHERE id = ? AND NOT EXISTS '
+                '(SELECT 1 FROM outbox_targets WHERE outbox_id = ?)',
+                outbox_id, outbox_id)
+
+    def put_fetch_cache(self, url, data):
+        self.execute(
+            'INSERT OR REPLACE INTO fetch_cache (url, data) VALUES (?, ?)',
+            url, dumps(data))
+
+    def put_poll_schedule(self, url, data):
+        self.execute(
+            'INSERT OR REPLACE INTO poll_schedules (url, data) VALUES (?, ?)',
+            url, dumps(data))
+
+    def put_photo(self, url, digest):
+        self.execute(
+            'INSERT OR REPLACE INTO photos (url, digest) VALUES (?, ?)', url,
+            digest)
+
+    def put_photo_blob(self, digest, size, file_id, last_used):
+        self.execute(
+            'INSERT OR REPLACE INTO photo_blobs (digest, size, file_id, last_used) '
+            'VALUES (?, ?, ?, ?)', digest, size, file_id, last_used)
+
+    def drop_photo_blob(self, digest):
+        with self.transaction():
+            self.execute('DELETE FROM photos WHERE digest = ?', digest)
+            self.execute('DELETE FROM photo_blobs WHERE digest = ?', digest)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
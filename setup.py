@@ -5,4 +5,8 @@ setup(name='cian_bot',
       author='galinova@sports.ru',
       packages=['cian_parser'],
       package_dir={'': 'src'},
-      install_requires=['requests', 'pyjsparser', 'beautifulsoup4', 'lxml'])
+      install_requires=['requests', 'pyjsparser', 'beautifulsoup4', 'lxml'],
+      extras_require={
+          'aio': ['aiohttp>=3.3'],
+          'market': ['numpy']
+      })
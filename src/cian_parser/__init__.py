@@ -1,23 +1,28 @@
 import collections
 import copy
+import hashlib
 import itertools
 import json
-import pprint
 import re
 import logging
-from urllib.parse import urljoin, urlparse
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse
 
 import attr
-import requests
 
-import pyjsparser
-from bs4 import BeautifulSoup
+# bs4, lxml and pyjsparser take long to import and are only needed when the
+# fast path fails or for detail pages, so they're imported where they're used
 
 logger = logging.getLogger('cian_bot.cian_parser')
 
 OFFER_ID_PATTERN = re.compile(r'\bID (?P<id>[a-zA-Z0-9]+)\b')
 EXAMPLE_URL = 'https://www.cian.ru/cat.php?deal_type=rent&maxprice={maxprice}&engine_version=2&foot_min=45&metro%5B0%5D=54&metro%5B10%5D=132&metro%5B11%5D=145&metro%5B12%5D=148&metro%5B13%5D=149&metro%5B14%5D=237&metro%5B1%5D=58&metro%5B2%5D=68&metro%5B3%5D=71&metro%5B4%5D=78&metro%5B5%5D=103&metro%5B6%5D=105&metro%5B7%5D=119&metro%5B8%5D=121&metro%5B9%5D=130&offer_type=flat&only_foot=2&room1=1&room2=1&room3=1&room4=1&room5=1&room6=1&type=4&p={page}'
 BASE_URL = 'https://www.cian.ru/cat.php'
+CRAWL_SORT = 'creation_date_desc'  # newest first, so that we can stop early
+SCRIPT_PATTERN = re.compile(r'<script\b[^>]*>(.*?)</script>',
+                            re.DOTALL | re.IGNORECASE)
+OFFERS_PATTERN = re.compile(r'"offers"\s*:\s*\[')
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_DECODER = json.JSONDecoder()
 
 URL_DEFAULTS = dict(
     deal_type='rent',
@@ -126,6 +131,16 @@ def offer_container_to_metro(offer_soup):
     return divs
 
 
+@attr.s
+class Page:
+    url = attr.ib()
+    status = attr.ib(type=int)
+    text = attr.ib()
+    etag = attr.ib(default=None)
+    last_modified = attr.ib(default=None)
+    elapsed = attr.ib(default=None)  # seconds the request took
+
+
 @attr.s
 class FlatListItem:
     id = attr.ib(type=int)
@@ -144,48 +159,265 @@ class FlatListItem:
     json = attr.ib()
 
 
+@attr.s(slots=True)
+class FlatRecord:
+    """The part of a FlatListItem worth keeping in memory:
+    what the filters and the notification text need. No raw offer json"""
+    id = attr.ib(type=int)
+    href = attr.ib()
+    price = attr.ib(type=float)
+    deposit = attr.ib(type=float)
+    fee = attr.ib(type=float)
+    bonus = attr.ib()
+    metros = attr.ib(type=tuple, converter=tuple)
+    rooms = attr.ib(type=int)
+    bedrooms = attr.ib(type=int)
+    address = attr.ib()
+    photos = attr.ib(type=tuple, converter=tuple)
+    phones = attr.ib(type=tuple, converter=tuple)
+    payment_period = attr.ib(default=None)
+
+    @property
+    def pdf_link(self):
+        return urljoin('https://cian.ru/export/pdf/',
+                       urlparse(self.href).path[1:])
+
+    @staticmethod
+    def from_item(flat):
+        return FlatRecord(
+            flat.id, flat.href, flat.price, flat.deposit, flat.fee,
+            flat.bonus, flat.metros, flat.rooms, flat.bedrooms, flat.address,
+            flat.photos, js_offer_to_phones(flat.json),
+            (flat.json.get('bargainTerms') or {}).get('paymentPeriod'))
+
+
+@attr.s(slots=True)
+class ParsedFlat:
+    """A flat off a search page: its FlatRecord and what the store indexes
+    it by. The raw offer is only decoded, out of the page source, by
+    `offer()`, for the flats whose offer gets stored"""
+    record = attr.ib(type=FlatRecord)
+    floor = attr.ib()
+    offer_hash = attr.ib()
+    source = attr.ib(repr=False)  # the offer, or its (start, end) in html
+    html = attr.ib(default=None, repr=False)
+
+    @property
+    def id(self):
+        return self.record.id
+
+    def offer(self):
+        if not isinstance(self.source, dict):
+            start, end = self.source
+            self.source = json.loads(self.html[start:end])
+            self.html = None
+        return self.source
+
+    @staticmethod
+    def from_record(record, html=None):
+        flat, floor, offer_hash, source = record
+        return ParsedFlat(FlatRecord(*flat), floor, offer_hash, source, html)
+
+    @staticmethod
+    def from_item(item, hasher=None):
+        return ParsedFlat(FlatRecord.from_item(item),
+                          item.json.get('floorNumber'),
+                          None if hasher is None else hasher(item.json),
+                          item.json)
+
+
 def get_params(**params):
     pp = copy.deepcopy(URL_DEFAULTS)
-    pp = pp.update(params)
+    pp.update(params)
     return pp
 
 
+def with_params(url, **params):
+    u = urlparse(url)
+    query = dict(parse_qsl(u.query, keep_blank_values=True))
+    query.update(params)
+    return u._replace(query=urlencode(query)).geturl()
+
+
+def crawl_url(url):
+    """Newest offers first, unless the search says otherwise"""
+    if 'sort' in dict(parse_qsl(urlparse(url).query)):
+        return url
+    return with_params(url, sort=CRAWL_SORT)
+
+
+def next_page_url(url):
+    page = dict(parse_qsl(urlparse(url).query)).get('p', '1')
+    return with_params(url, p=int(page) + 1)
+
+
 def get_flatlist_html(req, page, maxprice):
     res = req.get(BASE_URL, params=get_params(p=page, maxprice=maxprice))
-    logger.debug(f'Finished querying {res.url}. Status {res.status_code}')
+    logger.debug('Finished querying %s. Status %d', res.url, res.status_code)
     res = res.text
     return res
 
 
-def get_flatlist(html):
+def offer_to_flatlistitem(o):
+    return FlatListItem(
+        int(o['id']), o['fullUrl'],
+        urljoin('https://cian.ru/export/pdf/',
+                urlparse(o['fullUrl']).path[1:]),
+        (o['bargainTerms']['priceRur'] if o['bargainTerms']['priceRur'] >
+         5000 else o['bargainTerms']['priceRur'] * 65),
+        o['bargainTerms']['deposit'], o['bargainTerms']['clientFee'],
+        (o['bargainTerms'].get('agentBonus', 0) or 0),
+        [ug['name'] for ug in o['geo']['undergrounds']],
+        int(o['roomsCount'] or 1),
+        int(o['bedroomsCount']
+            or max(1,
+                   int(o['roomsCount'] or 0) - 1)),
+        o['description'],
+        o['geo']['userInput'],
+        [p['fullUrl'] for p in o['photos']],
+        o)
+
+
+def decode_array(text, start):
+    """Decodes the JSON array at text[start] one element at a time.
+
+    Returns (elements, [(start, end)] of each element in `text`, end)"""
+    elements, spans = [], []
+    pos = WHITESPACE.match(text, start + 1).end()
+    if text.startswith(']', pos):
+        return elements, spans, pos + 1
+    while True:
+        element, end = JSON_DECODER.raw_decode(text, pos)
+        elements.append(element)
+        spans.append((pos, end))
+        pos = WHITESPACE.match(text, end).end()
+        if text.startswith(']', pos):
+            return elements, spans, pos + 1
+        if not text.startswith(',', pos):
+            raise ValueError(f'decode_array: expected , or ] at {pos}')
+        pos = WHITESPACE.match(text, pos + 1).end()
+
+
+def find_offers(html):
+    """Find the `offers` array right in the page source and decode it as JSON,
+    skipping both BeautifulSoup and the pyjsparser AST.
+
+    Returns (offers, [(start, end)] of each offer in `html`, source text of
+    the array), or None if the page doesn't look the way we expect"""
+    empty = None
+    for script in SCRIPT_PATTERN.finditer(html):
+        for m in OFFERS_PATTERN.finditer(html, script.start(1),
+                                         script.end(1)):
+            try:
+                offers, spans, end = decode_array(html, m.end() - 1)
+            except ValueError:
+                continue
+            if not offers:
+                # Some other "offers":[] may come before the results; only
+                # a page without any is a page without offers
+                if empty is None:
+                    empty = [], [], html[m.end() - 1:end]
+                continue
+            if all(
+                    isinstance(o, dict) and 'bargainTerms' in o
+                    for o in offers):
+                return offers, spans, html[m.end() - 1:end]
+    return empty
+
+
+def get_offers_fast(html):
+    found = find_offers(html)
+    return None if found is None else found[0]
+
+
+def offers_digest(html):
+    """Hash of the offers on a search page, ignoring the rest of the markup
+    (csrf tokens, banners, etc.) which changes on every request"""
+    found = find_offers(html)
+    payload = html if found is None else found[2]
+    return hashlib.sha1(payload.encode('utf8')).hexdigest()
+
+
+def get_offers_slow(html):
+    import pyjsparser
+    from bs4 import BeautifulSoup
+
     res = BeautifulSoup(html, 'lxml')
     js = pyjsparser.parse(
         next(s for s in res.find_all('script') if '"priceRur"' in s.text).text)
     offers = next(o['value'] for t, o in js_traverse(js)
                   if t == 'Property' and o['key']['value'] == 'offers')
-    offers = [js_parse_object_expression(o) for o in offers['elements']]
-    return [
-        FlatListItem(
-            int(o['id']), o['fullUrl'],
-            urljoin('https://cian.ru/export/pdf/',
-                    urlparse(o['fullUrl']).path[1:]),
-            (o['bargainTerms']['priceRur'] if o['bargainTerms']['priceRur'] >
-             5000 else o['bargainTerms']['priceRur'] * 65),
-            o['bargainTerms']['deposit'], o['bargainTerms']['clientFee'],
-            (o['bargainTerms'].get('agentBonus', 0) or 0),
-            [ug['name'] for ug in o['geo']['undergrounds']],
-            int(o['roomsCount'] or 1),
-            int(o['bedroomsCount']
-                or max(1,
-                       int(o['roomsCount'] or 0) - 1)),
-            o['description'],
-            o['geo']['userInput'],
-            [p['fullUrl'] for p in o['photos']],
-            o)
-        for o in offers
+    return [js_parse_object_expression(o) for o in offers['elements']]
+
+
+def get_flatlist(html, fast=True):
+    offers = get_offers_fast(html) if fast else None
+    if offers is None:
+        if fast:
+            logger.debug('get_flatlist: fast path failed, parsing the AST')
+        offers = get_offers_slow(html)
+    return [offer_to_flatlistitem(o) for o in offers]
+
+
+def get_flatlist_records(html, hasher=None):
+    """get_flatlist as offer_to_record's records, which are much cheaper to
+    send across processes. Use `ParsedFlat.from_record(record, html)` to get
+    the flats back"""
+    return parse_search_page_records(html, hasher=hasher)[1]
+
+
+def search_page_offers(html, known_digest=None):
+    """Returns (digest, offers, spans): the offers are None if the digest is
+    `known_digest`, the spans of the offers in `html` are None if they had
+    to be parsed out of the AST"""
+    found = find_offers(html)
+    if found is None:
+        offers = spans = None
+        digest = hashlib.sha1(html.encode('utf8')).hexdigest()
+    else:
+        offers, spans, source = found
+        digest = hashlib.sha1(source.encode('utf8')).hexdigest()
+    if digest == known_digest:
+        return digest, None, None
+    if offers is None:
+        logger.debug('parse_search_page: fast path failed, parsing the AST')
+        offers = get_offers_slow(html)
+    return digest, offers, spans
+
+
+def parse_search_page(html, known_digest=None):
+    """offers_digest and get_flatlist in one decode of the offers.
+
+    Returns (digest, flats), where flats is None if the digest is
+    `known_digest`, so an unchanged page costs no FlatListItems"""
+    digest, offers, _ = search_page_offers(html, known_digest)
+    if offers is None:
+        return digest, None
+    return digest, [offer_to_flatlistitem(o) for o in offers]
+
+
+def parse_search_page_records(html, known_digest=None, hasher=None):
+    """parse_search_page with offer_to_record's records instead of
+    FlatListItems, for parsing in another process"""
+    digest, offers, spans = search_page_offers(html, known_digest)
+    if offers is None:
+        return digest, None
+    if spans is None:
+        spans = offers  # no spans off the AST, the offers go instead
+    return digest, [
+        offer_to_record(o, span, hasher) for o, span in zip(offers, spans)
     ]
 
 
+def offer_to_record(offer, source, hasher=None):
+    """(FlatRecord tuple, floor, offer hash, source), all the crawl needs of
+    an offer but the raw json itself: `source` is where the offer is in the
+    page, or the offer. The hash is None without a `hasher`"""
+    flat = FlatRecord.from_item(offer_to_flatlistitem(offer))
+    return (attr.astuple(flat, recurse=False), offer.get('floorNumber'),
+            None if hasher is None else hasher(offer), source)
+
+
 @attr.s
 class Flat:
     offer_id = attr.ib()
@@ -202,7 +434,12 @@ def js_offer_to_phones(js):
     try:
         return [f'+{o["countryCode"]}{o["number"]}' for o in js['phones']]
     except Exception as e:
-        logger.error("js_offer_to_phones: error {e} while extracting phones from: {}".format(pprint.pformat(js)))
+        flat_id = js.get('id') if isinstance(js, dict) else None
+        logger.error('js_offer_to_phones: %r while extracting phones from %s',
+                     e,
+                     flat_id,
+                     extra=dict(flat_id=flat_id))
+        logger.debug('js_offer_to_phones: offer %r', js)
         return list()
 
 
@@ -246,7 +483,7 @@ def js_parse_object_expression(expr):
 
 
 def js_findall_offer_data(js):
-    for t, r in traverse(js):
+    for t, r in js_traverse(js):
         if t != 'Property': continue
         if r['key']['type'] != 'Literal': continue
         if r['key']['value'] != 'offerData': continue
@@ -256,12 +493,23 @@ def js_findall_offer_data(js):
 
 
 def get_flats(html):
+    import pyjsparser
+    from bs4 import BeautifulSoup
+
     page = BeautifulSoup(html, 'lxml')
-    js = next(s for s in page.find_all('script') if '"offerId"' in s.text).text
+    js = next((s.text for s in page.find_all('script') if '"offerId"' in s.text),
+              None)
+    if js is None:
+        return
     js = pyjsparser.parse(js)
     yield from js_findall_offer_data(js)
 
 
+def get_offer_data(html):
+    """offerData of a flat's detail page, None if it has none"""
+    return next(get_flats(html), None)
+
+
 def _get_flats(url, save_file):
     result = []
     new_flats = _get_new(url, save_file)
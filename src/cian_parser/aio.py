@@ -0,0 +1,146 @@
+"""Concurrent fetching of search pages over a pooled aiohttp session"""
+import asyncio
+import collections
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+import attr
+
+from cian_parser import Page
+
+aiohttp = None  # imported by fetch_all, it takes a while
+
+logger = logging.getLogger('cian_bot.cian_parser.aio')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+@attr.s
+class FetchOptions:
+    concurrency = attr.ib(type=int, default=8)
+    rps = attr.ib(type=float, default=2.0)  # per host
+    retries = attr.ib(type=int, default=3)
+    backoff = attr.ib(type=float, default=1.0)
+    timeout = attr.ib(type=float, default=30.0)
+
+
+class HostRateLimiter:
+    """Spaces requests to the same host at least 1/rps seconds apart.
+    It's thread-safe, so one limiter can pace every fetch of the process,
+    from any thread and event loop, async or not"""
+
+    def __init__(self, rps):
+        self.interval = 1.0 / rps if rps > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = collections.defaultdict(float)  # time.monotonic()
+
+    def reserve(self, host):
+        """Takes the next slot for `host`; returns the seconds until it"""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot[host])
+            self.next_slot[host] = slot + self.interval
+        return slot - now
+
+    def defer(self, host, delay):
+        """Holds back requests to `host` for `delay` seconds, after a 429"""
+        with self.lock:
+            self.next_slot[host] = max(self.next_slot[host],
+                                       time.monotonic() + delay)
+
+    async def wait(self, host):
+        delay = self.reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def wait_sync(self, host):
+        delay = self.reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def retry_delay(res, attempt, options):
+    retry_after = res.headers.get('Retry-After', '') if res is not None else ''
+    if retry_after.isdigit():
+        return float(retry_after)
+    return options.backoff * 2**attempt * (1 + random.random())
+
+
+async def fetch_one(session, limiter, semaphore, url, headers, options):
+    host = urlparse(url).netloc
+    for attempt in range(options.retries + 1):
+        res = None
+        try:
+            async with semaphore:
+                await limiter.wait(host)
+                started = time.monotonic()
+                async with session.get(url, headers=headers) as res:
+                    logger.info('fetch_one: %s status %d',
+                                url,
+                                res.status,
+                                extra=dict(url=url, status=res.status))
+                    if res.status not in RETRY_STATUSES:
+                        return Page(url,
+                                    res.status,
+                                    await res.text(errors='replace'),
+                                    etag=res.headers.get('ETag'),
+                                    last_modified=res.headers.get(
+                                        'Last-Modified'),
+                                    elapsed=time.monotonic() - started)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f'fetch_one: {url} attempt {attempt} error: {e!r}')
+            if attempt == options.retries:
+                raise
+        delay = retry_delay(res, attempt, options)
+        if res is not None and res.status == 429:
+            # Every request to the host waits, this one included
+            limiter.defer(host, delay)
+        elif attempt < options.retries:
+            await asyncio.sleep(delay)
+    raise IOError(f'{url}: giving up after {options.retries + 1} attempts')
+
+
+async def fetch_all_async(urls, headers, options, limiter):
+    semaphore = asyncio.Semaphore(options.concurrency)
+    timeout = aiohttp.ClientTimeout(total=options.timeout)
+    connector = aiohttp.TCPConnector(limit=options.concurrency)
+    async with aiohttp.ClientSession(timeout=timeout,
+                                     connector=connector) as session:
+        return await asyncio.gather(
+            *[
+                fetch_one(session, limiter, semaphore, url,
+                          headers.get(url), options) for url in urls
+            ],
+            return_exceptions=True)
+
+
+def fetch_all(urls, options=None, headers=None, limiter=None):
+    """Fetches `urls` concurrently, returns a Page for each one that
+    succeeded; failures are logged. `headers` maps urls to extra request
+    headers. Pass the same `limiter` to every call to keep their requests
+    to a host, together, under options.rps"""
+    global aiohttp
+    if aiohttp is None:
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError('cian_parser.aio requires aiohttp')
+    options = options or FetchOptions()
+    if limiter is None:
+        limiter = HostRateLimiter(options.rps)
+    loop = asyncio.new_event_loop()
+    try:
+        results = loop.run_until_complete(
+            fetch_all_async(urls, headers or {}, options, limiter))
+    finally:
+        loop.close()
+    pages = []
+    for url, r in zip(urls, results):
+        if isinstance(r, BaseException):
+            logger.error(f'fetch_all: failed fetching {url}; error: {r!r}')
+        else:
+            pages.append(r)
+    return pages
@@ -0,0 +1,134 @@
+"""Observed search urls as queries.
+
+cian's cat.php takes the whole search as url parameters: metro[i] for the
+stations, room1..room6 for the number of rooms, minprice and maxprice for
+the price range and a few others. SearchQuery is the normalized form of
+such a url, so that urls that only differ in the order of parameters are
+the same search. The page number, p, is kept: a url pinned to p=2 is
+still polled from its second page.
+
+coalesce() merges searches that differ in nothing but rooms and price
+range into one url that finds all of them; SearchQuery.accepts tells which
+of the flats found by the merged url each of them asked for. A merged url
+finds more flats than any of its searches, so it only keeps up with them
+when more than its first page is crawled."""
+import collections
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import attr
+
+# room6 is "6 or more"; room7 (free layout) and room9 (studio) can't be
+# told apart from the offers we parse, so searches for them aren't merged
+ROOMS = {'room1': 1, 'room2': 2, 'room3': 3, 'room4': 4, 'room5': 5}
+ROOMS_OR_MORE = {'room6': 6}
+
+
+def metro_order(metro_id):
+    return (0, int(metro_id)) if metro_id.isdigit() else (1, metro_id)
+
+
+def parse_price(value):
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+@attr.s(frozen=True)
+class SearchQuery:
+    base = attr.ib()  # scheme://host/path
+    params = attr.ib(converter=tuple)  # sorted (key, value) of the rest
+    metros = attr.ib(converter=frozenset)  # station ids, empty means any
+    rooms = attr.ib(converter=frozenset)  # e.g. {'room2'}, empty means any
+    minprice = attr.ib(default=None)
+    maxprice = attr.ib(default=None)
+
+    @staticmethod
+    def from_url(url):
+        u = urlparse(url)
+        params, metros, rooms = [], set(), set()
+        minprice = maxprice = None
+        for key, value in parse_qsl(u.query, keep_blank_values=True):
+            if key.startswith('metro['):
+                metros.add(value)
+            elif key.startswith('room') and key[4:].isdigit():
+                if value == '1':
+                    rooms.add(key)
+            elif key == 'minprice':
+                minprice = parse_price(value)
+            elif key == 'maxprice':
+                maxprice = parse_price(value)
+            else:
+                params.append((key, value))
+        return SearchQuery(u._replace(query='', fragment='').geturl(),
+                           sorted(set(params)), metros, rooms, minprice,
+                           maxprice)
+
+    @property
+    def url(self):
+        """The canonical url of the search"""
+        params = list(self.params)
+        for i, m in enumerate(sorted(self.metros, key=metro_order)):
+            params.append((f'metro[{i}]', m))
+        params.extend((r, '1') for r in sorted(self.rooms))
+        if self.minprice is not None:
+            params.append(('minprice', self.minprice))
+        if self.maxprice is not None:
+            params.append(('maxprice', self.maxprice))
+        return f'{self.base}?{urlencode(params)}'
+
+    @property
+    def mergeable(self):
+        return self.rooms <= ROOMS.keys() | ROOMS_OR_MORE.keys()
+
+    def merge_key(self):
+        """Searches with the same key only differ in rooms and price"""
+        if not self.mergeable:
+            return self
+        return (self.base, self.params, self.metros)
+
+    def accepts(self, flat):
+        if self.minprice is not None and flat.price < self.minprice:
+            return False
+        if self.maxprice is not None and flat.price > self.maxprice:
+            return False
+        if self.rooms and not any(
+                ROOMS.get(r) == flat.rooms
+                or r in ROOMS_OR_MORE and flat.rooms >= ROOMS_OR_MORE[r]
+                for r in self.rooms):
+            return False
+        return True
+
+
+def merge(queries):
+    """The narrowest search finding everything `queries` find"""
+    first = queries[0]
+    if any(not q.rooms for q in queries):
+        rooms = ()
+    else:
+        rooms = frozenset.union(*(q.rooms for q in queries))
+    minprices = [q.minprice for q in queries]
+    maxprices = [q.maxprice for q in queries]
+    return attr.evolve(
+        first,
+        rooms=rooms,
+        minprice=None if None in minprices else min(minprices),
+        maxprice=None if None in maxprices else max(maxprices))
+
+
+def coalesce(urls, merge_queries=True):
+    """{url to fetch: (SearchQuery it stands for, ...)}; without
+    `merge_queries` every search is fetched by its own url"""
+    groups = collections.defaultdict(set)
+    for url in urls:
+        q = SearchQuery.from_url(url)
+        groups[q.merge_key() if merge_queries else q].add(q)
+    polls = dict()
+    for queries in groups.values():
+        queries = tuple(sorted(queries, key=lambda q: q.url))
+        polls[merge(queries).url] = queries
+    return polls
+
+
+def accepts(queries, flat):
+    return any(q.accepts(flat) for q in queries)
@@ -0,0 +1,140 @@
+"""fetch_all against a local server: retries, Retry-After and the per-host
+rate limit.
+
+    python -m unittest discover tests"""
+import collections
+import http.server
+import threading
+import time
+import types
+import unittest
+
+from cian_parser import aio
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """Answers each path with the statuses scripted for it, then 200s;
+    records when every request came"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.lock = threading.Lock()
+        # path -> [(status, headers)] of its next requests
+        self.scripts = collections.defaultdict(list)
+        self.requests = []  # (time.monotonic(), path)
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.05, ),
+                                       daemon=True)
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_address[1]}{path}'
+
+    def times(self, path=None):
+        with self.lock:
+            return [t for t, p in self.requests if path in (None, p)]
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((time.monotonic(), self.path))
+            script = self.server.scripts[self.path]
+            status, headers = script.pop(0) if script else (200, {})
+        body = f'{self.path} {status}'.encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def gaps(times):
+    return [b - a for a, b in zip(times, times[1:])]
+
+
+class FetchAllTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.server.thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def fetch(self, paths, **options):
+        options = aio.FetchOptions(**dict(dict(rps=0, backoff=0.05),
+                                          **options))
+        return aio.fetch_all([self.server.url(p) for p in paths], options)
+
+    def test_retries_with_backoff(self):
+        self.server.scripts['/a'] = [(503, {}), (502, {})]
+        [page] = self.fetch(['/a'], retries=3)
+        self.assertEqual((page.status, page.text), (200, '/a 200'))
+        times = self.server.times('/a')
+        self.assertEqual(len(times), 3)
+        # backoff * 2**attempt, and up to twice that
+        for gap, least in zip(gaps(times), (0.05, 0.1)):
+            self.assertGreaterEqual(gap, least * 0.9)
+
+    def test_gives_up_after_the_retries(self):
+        self.server.scripts['/a'] = [(500, {})] * 5
+        self.server.scripts['/b'] = [(404, {})]
+        pages = self.fetch(['/a', '/b'], retries=2)
+        self.assertEqual([(p.url, p.status) for p in pages],
+                         [(self.server.url('/b'), 404)])
+        self.assertEqual(len(self.server.times('/a')), 3)
+        self.assertEqual(len(self.server.times('/b')), 1)
+
+    def test_retry_after_holds_back_the_host(self):
+        self.server.scripts['/a'] = [(429, {'Retry-After': '1'})]
+        pages = self.fetch(['/a', '/b', '/c'], concurrency=1, backoff=10)
+        self.assertEqual([p.status for p in pages], [200, 200, 200])
+        first, *rest = self.server.times()
+        self.assertEqual(len(rest), 3)
+        # The 429 asked for a second, of every request to the host
+        for t in rest:
+            self.assertGreaterEqual(t - first, 0.9)
+
+    def test_paces_requests_to_a_host(self):
+        pages = self.fetch([f'/{i}' for i in range(5)], rps=10, concurrency=5)
+        self.assertEqual(len(pages), 5)
+        times = sorted(self.server.times())
+        self.assertGreaterEqual(times[-1] - times[0], 0.4 * 0.9)
+        for gap in gaps(times):
+            self.assertGreaterEqual(gap, 0.1 * 0.8)
+
+
+class HostRateLimiterTest(unittest.TestCase):
+    def test_hosts_are_paced_apart(self):
+        limiter = aio.HostRateLimiter(rps=2)
+        self.assertEqual(limiter.reserve('a'), 0)
+        self.assertAlmostEqual(limiter.reserve('a'), 0.5, places=2)
+        self.assertEqual(limiter.reserve('b'), 0)
+
+    def test_defer(self):
+        limiter = aio.HostRateLimiter(rps=0)
+        limiter.defer('a', 2)
+        self.assertAlmostEqual(limiter.reserve('a'), 2, places=2)
+        self.assertEqual(limiter.reserve('b'), 0)
+
+
+class RetryDelayTest(unittest.TestCase):
+    def test_retry_after_seconds(self):
+        res = types.SimpleNamespace(headers={'Retry-After': '7'})
+        self.assertEqual(aio.retry_delay(res, 0, aio.FetchOptions()), 7)
+
+    def test_backoff_otherwise(self):
+        options = aio.FetchOptions(backoff=1.0)
+        res = types.SimpleNamespace(
+            headers={'Retry-After': 'Wed, 21 Oct 2026 07:28:00 GMT'})
+        for attempt, res in enumerate([res, None, None]):
+            delay = aio.retry_delay(res, attempt, options)
+            self.assertGreaterEqual(delay, 2**attempt)
+            self.assertLess(delay, 2**(attempt + 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""CianBot.update_flat: crawled again, with a changed offer.
+
+    python -m unittest discover tests"""
+import tempfile
+import unittest
+
+import bot
+import cian_changes
+import cian_parser
+
+
+def parsed_flat(flat_id, price):
+    flat = cian_parser.FlatRecord(flat_id,
+                                  f'https://www.cian.ru/rent/flat/{flat_id}/',
+                                  price, price, 0.0, None, ['Трубная'], 2, 2,
+                                  'Москва, Трубная, 25', [], [])
+    offer = dict(id=flat_id, bargainTerms=dict(priceRur=price))
+    return cian_parser.ParsedFlat(flat, 3, cian_changes.offer_hash(offer),
+                                  offer)
+
+
+class UpdateFlatTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.bot = bot.CianBot.from_directory(tmp.name)
+        self.addCleanup(self.bot.store.close)
+
+    def test_a_new_price_is_stored_and_told(self):
+        self.bot.add_flat(parsed_flat(1, 50000.0))
+        changes = self.bot.update_flat(parsed_flat(1, 45000.0))
+        self.assertEqual([c.field for c in changes], ['priceRur'])
+        self.assertEqual(self.bot.flatlist[1].price, 45000.0)
+        self.assertEqual([p for _, p in self.bot.price_history.get(1)],
+                         [50000.0, 45000.0])
+
+    def test_the_same_offer_changes_nothing(self):
+        self.bot.add_flat(parsed_flat(1, 50000.0))
+        self.assertEqual(self.bot.update_flat(parsed_flat(1, 50000.0)), [])
+        self.assertEqual(self.bot.price_history.get(1), [])
+
+    def test_an_offer_stored_before_hashes_is_stored_silently(self):
+        self.bot.add_flat(parsed_flat(1, 50000.0))
+        del self.bot.offer_hashes[1]
+        item = parsed_flat(1, 45000.0)
+        self.assertEqual(self.bot.update_flat(item), [])
+        self.assertEqual(self.bot.offer_hashes[1], item.offer_hash)
+        self.assertEqual(self.bot.store.get_offer(1), item.offer())
+        self.assertEqual(self.bot.store.get_flat(1)['price'], 45000.0)
+        self.assertEqual(self.bot.flatlist[1].price, 45000.0)
+        self.assertEqual([p for _, p in self.bot.price_history.get(1)],
+                         [50000.0, 45000.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Relisted and duplicate offers: matching them, and who gets the copies.
+
+    python -m unittest discover tests"""
+import unittest
+
+import bot
+import cian_dedup
+import cian_filters
+import cian_parser
+
+ADDRESS = 'Москва, ул. Трубная, 25С1'
+
+
+def record(flat_id, address=ADDRESS, price=50000.0, rooms=2, photos=()):
+    return cian_parser.FlatRecord(flat_id,
+                                  f'https://www.cian.ru/rent/flat/{flat_id}/',
+                                  price, price, 0.0, None, ['Трубная'],
+                                  rooms, rooms, address, photos, [])
+
+
+def photos(*names):
+    return [f'https://images.cdn-cian.ru/images/{n}.jpg' for n in names]
+
+
+class FingerprintIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = cian_dedup.FingerprintIndex()
+        self.index.add(record(1), floor=3)
+
+    def test_same_address_written_differently(self):
+        copy = record(2, address='москва ул трубная 25с1')
+        self.assertEqual(self.index.match(copy, floor=3), 1)
+
+    def test_a_bit_cheaper_is_the_same_flat(self):
+        self.assertEqual(self.index.match(record(2, price=48000.0), 3), 1)
+
+    def test_other_floor_rooms_or_price_is_another_flat(self):
+        self.assertIsNone(self.index.match(record(2), floor=4))
+        self.assertIsNone(self.index.match(record(2, rooms=3), floor=3))
+        self.assertIsNone(self.index.match(record(2, price=70000.0), 3))
+        self.assertIsNone(
+            self.index.match(record(2, address='Москва, ул. Трубная, 27'),
+                             3))
+
+    def test_not_a_copy_of_itself(self):
+        self.assertIsNone(self.index.match(record(1), floor=3))
+
+    def test_shared_photos(self):
+        self.index.add(record(3, address='', photos=photos('a', 'b', 'c')))
+        copy = record(4, address='', photos=photos('c', 'b', 'x'))
+        self.assertEqual(self.index.match(copy), 3)
+        self.assertIsNone(
+            self.index.match(record(5, address='', photos=photos('a', 'x'))))
+        # A flat with one photo only needs that one
+        self.assertEqual(
+            self.index.match(record(6, address='', photos=photos('a'))), 3)
+
+    def test_dropped_flats_match_nothing(self):
+        self.index.drop({1})
+        self.assertIsNone(self.index.match(record(2), floor=3))
+
+
+class CopyRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = bot.CianBot()
+        self.bot.filter_engine.default = cian_filters.ChatFilter(
+            max_price_per_room=None, metros=(), metro_blacklist=())
+        self.scheduled = []  # (flat_id, chat_ids)
+        self.bot.schedule = self.schedule
+
+    def schedule(self, msg, chat_ids, kind='flat'):
+        self.scheduled.append((msg['flat_id'], chat_ids))
+
+    def crawl(self, *records):
+        self.bot.handle_new_flats([
+            cian_parser.ParsedFlat(r, 3, r.id, dict(id=r.id))
+            for r in records
+        ])
+
+    def test_copy_goes_only_to_chats_without_the_original(self):
+        self.bot.add_chat(1)
+        self.crawl(record(1))
+        self.bot.add_chat(2)
+        self.bot.set_cursors({2: len(self.bot.flat_log)})
+        self.crawl(record(2, price=49000.0))
+        self.assertEqual(self.bot.duplicates, {2: 1})
+        self.assertEqual(self.scheduled, [(1, [1]), (2, [2])])
+
+    def test_copy_of_a_copy_points_at_the_original(self):
+        self.bot.add_chat(1)
+        self.crawl(record(1))
+        self.crawl(record(2, price=49000.0))
+        self.crawl(record(3, price=48000.0))
+        self.assertEqual(self.bot.duplicates, {2: 1, 3: 1})
+        self.assertEqual(self.scheduled, [(1, [1])])
+
+
+if __name__ == '__main__':
+    unittest.main()
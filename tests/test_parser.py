@@ -0,0 +1,73 @@
+"""Search page parsing: the raw_decode fast path against the AST.
+
+    python -m unittest discover tests"""
+import json
+import os.path as osp
+import unittest
+
+import cian_parser
+
+SEARCH_FIXTURE = osp.join(osp.dirname(__file__), '..', 'benchmarks',
+                          'fixtures', 'search.html')
+
+
+class SearchPageTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(SEARCH_FIXTURE, 'r', encoding='utf8') as f:
+            cls.html = f.read()
+
+    def test_fast_path_matches_the_ast(self):
+        offers, spans, source = cian_parser.find_offers(self.html)
+        self.assertGreater(len(offers), 0)
+        self.assertEqual(offers, cian_parser.get_offers_slow(self.html))
+        self.assertEqual(json.loads(source), offers)
+        self.assertEqual([json.loads(self.html[a:b]) for a, b in spans],
+                         offers)
+        self.assertEqual(cian_parser.get_flatlist(self.html),
+                         cian_parser.get_flatlist(self.html, fast=False))
+
+    def test_records_match_the_ast(self):
+        digest, records = cian_parser.parse_search_page_records(self.html)
+        fast = [
+            cian_parser.ParsedFlat.from_record(r, self.html) for r in records
+        ]
+        self.assertEqual(digest, cian_parser.offers_digest(self.html))
+        self.assertEqual(
+            [(f.record, f.floor, f.offer()) for f in fast],
+            [(cian_parser.FlatRecord.from_item(i), i.json.get('floorNumber'),
+              i.json)
+             for i in cian_parser.get_flatlist(self.html, fast=False)])
+
+    def test_falls_back_to_the_ast(self):
+        # Valid JavaScript, but not JSON
+        html = self.html.replace('"priceRur"', "'priceRur'", 1)
+        self.assertIsNone(cian_parser.find_offers(html))
+        self.assertEqual(cian_parser.get_flatlist(html),
+                         cian_parser.get_flatlist(self.html, fast=False))
+        _, records = cian_parser.parse_search_page_records(html)
+        self.assertEqual([r[3] for r in records],
+                         cian_parser.get_offers_slow(self.html))
+
+    def test_unchanged_page_is_not_decoded(self):
+        digest = cian_parser.offers_digest(self.html)
+        self.assertEqual(
+            cian_parser.parse_search_page_records(self.html, digest),
+            (digest, None))
+
+    def test_page_without_offers(self):
+        _, _, source = cian_parser.find_offers(self.html)
+        html = self.html.replace(source, '[]')
+        self.assertEqual(cian_parser.find_offers(html), ([], [], '[]'))
+        self.assertEqual(cian_parser.get_flatlist(html), [])
+        self.assertEqual(cian_parser.parse_search_page_records(html)[1], [])
+
+    def test_empty_offers_before_the_results(self):
+        html = self.html.replace('<script>',
+                                 '<script>window.x={"offers":[]};', 1)
+        offers, _, _ = cian_parser.find_offers(html)
+        self.assertEqual(offers, cian_parser.get_offers_slow(self.html))
+
+
+if __name__ == '__main__':
+    unittest.main()
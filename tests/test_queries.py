@@ -0,0 +1,144 @@
+"""Coalescing observed urls, and crawling the merged ones.
+
+    python -m unittest discover tests"""
+import types
+import unittest
+
+import bot
+import cian_parser
+from cian_parser import queries
+
+BASE = 'https://www.cian.ru/cat.php?deal_type=rent&engine_version=2'
+
+
+def search(*params):
+    return '&'.join((BASE, ) + params)
+
+
+def record(flat_id, price, rooms):
+    return cian_parser.FlatRecord(flat_id,
+                                  f'https://www.cian.ru/rent/flat/{flat_id}/',
+                                  price, price, 0.0, None, ['Трубная'],
+                                  rooms, rooms, f'Москва, Трубная, {flat_id}',
+                                  [], [])
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_rooms_are_united(self):
+        polls = queries.coalesce([
+            search('metro[0]=1', 'room1=1'),
+            search('metro[0]=1', 'room2=1'),
+            search('metro[0]=1', 'room6=1')
+        ])
+        self.assertEqual(len(polls), 1)
+        [(url, subscriptions)] = polls.items()
+        self.assertEqual(
+            queries.SearchQuery.from_url(url).rooms, {'room1', 'room2',
+                                                      'room6'})
+        self.assertEqual(len(subscriptions), 3)
+        accepted = [
+            r.rooms for r in (record(i, 50000, i) for i in range(1, 8))
+            if queries.accepts(subscriptions, r)
+        ]
+        self.assertEqual(accepted, [1, 2, 6, 7])
+
+    def test_any_rooms_wins(self):
+        polls = queries.coalesce([search('room1=1'), search('minprice=1')])
+        [url] = polls
+        self.assertEqual(queries.SearchQuery.from_url(url).rooms, set())
+
+    def test_price_range_covers_every_search(self):
+        merged = queries.merge([
+            queries.SearchQuery.from_url(search('minprice=30000',
+                                                'maxprice=50000')),
+            queries.SearchQuery.from_url(search('minprice=20000',
+                                                'maxprice=40000'))
+        ])
+        self.assertEqual((merged.minprice, merged.maxprice), (20000, 50000))
+
+    def test_mixed_price_bounds(self):
+        # One search has no lower bound, the other no upper one
+        polls = queries.coalesce([
+            search('room1=1', 'maxprice=40000'),
+            search('room2=1', 'minprice=60000')
+        ])
+        [(url, subscriptions)] = polls.items()
+        merged = queries.SearchQuery.from_url(url)
+        self.assertEqual((merged.minprice, merged.maxprice), (None, None))
+        self.assertTrue(queries.accepts(subscriptions, record(1, 30000, 1)))
+        self.assertFalse(queries.accepts(subscriptions, record(2, 50000, 1)))
+        self.assertFalse(queries.accepts(subscriptions, record(3, 50000, 2)))
+        self.assertTrue(queries.accepts(subscriptions, record(4, 70000, 2)))
+
+    def test_other_params_are_not_merged(self):
+        urls = [
+            search('metro[0]=1', 'room1=1'),
+            search('metro[0]=2', 'room2=1'),
+            search('offer_type=flat', 'room1=1'),
+            search('offer_type=suburban', 'room1=1'),
+            # Free layout and studios can't be told apart in the offers
+            search('room9=1'),
+            search('room7=1'),
+        ]
+        polls = queries.coalesce(urls)
+        self.assertEqual(len(polls), len(urls))
+        for url, subscriptions in polls.items():
+            self.assertEqual(len(subscriptions), 1)
+            self.assertEqual(subscriptions[0].url, url)
+
+    def test_same_search_in_any_order(self):
+        polls = queries.coalesce([
+            search('room1=1', 'metro[0]=2', 'metro[1]=1'),
+            search('metro[0]=1', 'metro[1]=2', 'room1=1')
+        ])
+        [(url, subscriptions)] = polls.items()
+        self.assertEqual(len(subscriptions), 1)
+
+    def test_without_merging(self):
+        urls = [search('room1=1'), search('room2=1')]
+        polls = queries.coalesce(urls, merge_queries=False)
+        self.assertEqual(len(polls), 2)
+
+
+class CoalescedCrawlTest(unittest.TestCase):
+    """A merged url finds flats none of its searches asked for"""
+
+    def setUp(self):
+        self.bot = bot.CianBot(max_pages=2)
+        self.bot.add_observed_url(search('room1=1', 'maxprice=40000'))
+        self.bot.add_observed_url(search('room2=1', 'maxprice=60000'))
+        [self.url] = self.bot.polls
+        self.pages = dict()  # url -> the flats on it, None if unchanged
+        self.bot.download_pages = lambda urls: urls
+        self.bot.parse_pages = self.parse_pages
+
+    def parse_pages(self, urls):
+        for url in urls:
+            page = types.SimpleNamespace(url=url,
+                                         status=200,
+                                         etag=None,
+                                         last_modified=None)
+            yield page, 'digest', self.pages.get(url)
+
+    def test_keeps_alive_only_what_was_asked_for(self):
+        first_page = cian_parser.crawl_url(self.url)
+        self.pages[first_page] = [
+            cian_parser.ParsedFlat(r, 3, i, dict(id=r.id))
+            for i, r in enumerate([
+                record(1, 30000, 1),
+                record(2, 50000, 2),
+                record(3, 50000, 1),  # too expensive for one room
+                record(4, 30000, 3),
+            ])
+        ]
+        self.assertEqual(self.bot.crawl([self.url]), {self.url: 2})
+        self.assertEqual(set(self.bot.flatlist), {1, 2})
+        self.assertEqual(self.bot.fetch_cache[first_page].ids, [1, 2])
+        self.bot.last_seen.clear()
+        self.pages[first_page] = None
+        self.bot.crawl([self.url])
+        self.assertEqual(set(self.bot.last_seen), {1, 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""DurableQueue leases, and a notifier consuming what it's delivered again.
+
+    python -m unittest discover tests"""
+import os.path as osp
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import attr
+
+import bot
+import cian_filters
+import cian_parser
+import cian_queue
+
+
+def flat_event(flat_id):
+    flat = cian_parser.FlatRecord(flat_id, f'https://www.cian.ru/rent/flat/'
+                                  f'{flat_id}/', 50000.0, 50000.0, 0.0, None,
+                                  ['Трубная'], 2, 2, 'Москва', [], [])
+    offer = dict(id=flat_id, bargainTerms=dict(priceRur=50000))
+    return dict(kind='flat', flat=attr.asdict(flat), offer=offer,
+                original=None)
+
+
+def lease_expired():
+    """Makes every lease taken so far look expired"""
+    return mock.patch.object(cian_queue.time,
+                             'time',
+                             return_value=time.time() + cian_queue.LEASE + 1)
+
+
+class DurableQueueTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = osp.join(tmp.name, cian_queue.QUEUE_FILE)
+        self.queue = cian_queue.DurableQueue(self.path)
+        self.addCleanup(self.queue.close)
+
+    def test_leases_in_order(self):
+        self.queue.put(cian_queue.CRAWL, [dict(n=i) for i in range(5)])
+        self.queue.put(cian_queue.COMMANDS, [dict(url='u')])
+        batch = self.queue.lease(cian_queue.CRAWL, limit=3)
+        self.assertEqual([e['n'] for _, e in batch], [0, 1, 2])
+        batch = self.queue.lease(cian_queue.CRAWL)
+        self.assertEqual([e['n'] for _, e in batch], [3, 4])
+        self.assertEqual(self.queue.lease(cian_queue.CRAWL), [])
+
+    def test_delivers_again_once_the_lease_runs_out(self):
+        self.queue.put(cian_queue.CRAWL, [dict(n=0), dict(n=1)])
+        first = self.queue.lease(cian_queue.CRAWL)
+        self.assertEqual(self.queue.lease(cian_queue.CRAWL), [])
+        with lease_expired():
+            again = self.queue.lease(cian_queue.CRAWL)
+        self.assertEqual(again, first)
+
+    def test_acked_events_are_gone(self):
+        self.queue.put(cian_queue.CRAWL, [dict(n=0), dict(n=1)])
+        batch = self.queue.lease(cian_queue.CRAWL)
+        self.queue.ack([batch[0][0]])
+        self.assertEqual(self.queue.depth(cian_queue.CRAWL), 1)
+        with lease_expired():
+            again = self.queue.lease(cian_queue.CRAWL)
+        self.assertEqual([e['n'] for _, e in again], [1])
+
+    def test_survives_reopening(self):
+        self.queue.put(cian_queue.CRAWL, [dict(n=0)])
+        self.queue.lease(cian_queue.CRAWL)
+        self.queue.close()
+        self.queue = cian_queue.DurableQueue(self.path)
+        with lease_expired():
+            again = self.queue.lease(cian_queue.CRAWL)
+        self.assertEqual([e['n'] for _, e in again], [0])
+
+
+class RedeliveryTest(unittest.TestCase):
+    """A notifier that dies handling a batch, and the one that gets it
+    again after a restart"""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.state_dir = osp.join(tmp.name, 'notifier')
+        self.queue = cian_queue.DurableQueue(
+            osp.join(tmp.name, cian_queue.QUEUE_FILE))
+        self.addCleanup(self.queue.close)
+        self.queue.put(cian_queue.CRAWL, [flat_event(1), flat_event(2)])
+        self.notifier = self.restart(None)
+        self.notifier.add_chat(7)
+
+    def restart(self, notifier):
+        if notifier is not None:
+            notifier.store.close()
+        notifier = bot.CianBot.from_directory(self.state_dir,
+                                              role='notifier',
+                                              queue=self.queue)
+        self.addCleanup(notifier.store.close)
+        notifier.filter_engine.default = cian_filters.ChatFilter(
+            max_price_per_room=None, metros=(), metro_blacklist=())
+        return notifier
+
+    def outbox(self, notifier):
+        return [(msg['flat_id'], chat_ids)
+                for _, msg, chat_ids in notifier.store.outbox()]
+
+    def test_routes_flats_whose_routing_failed(self):
+        with mock.patch.object(self.notifier.filter_engine,
+                               'route',
+                               side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                self.notifier.consume_events(None)
+        notifier = self.restart(self.notifier)
+        self.assertEqual(notifier.unrouted, {1, 2})
+        with lease_expired():
+            notifier.consume_events(None)
+        self.assertEqual(self.outbox(notifier), [(1, [7]), (2, [7])])
+        self.assertEqual(notifier.unrouted, set())
+        self.assertEqual(notifier.store.unrouted(), [])
+        self.assertEqual(self.queue.depth(cian_queue.CRAWL), 0)
+
+    def test_does_not_route_twice_a_batch_that_was_not_acked(self):
+        with mock.patch.object(self.queue,
+                               'ack',
+                               side_effect=RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                self.notifier.consume_events(None)
+        notifier = self.restart(self.notifier)
+        with lease_expired():
+            notifier.consume_events(None)
+        self.assertEqual(self.outbox(notifier), [(1, [7]), (2, [7])])
+        self.assertEqual(notifier.sender.depth, 2)
+        self.assertEqual(self.queue.depth(cian_queue.CRAWL), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""Evicting flats from the middle of flat_log, and the chats reading it.
+
+    python -m unittest discover tests"""
+import tempfile
+import types
+import unittest
+
+import bot
+import cian_filters
+import cian_parser
+
+
+def parsed_flat(flat_id):
+    flat = cian_parser.FlatRecord(flat_id,
+                                  f'https://www.cian.ru/rent/flat/{flat_id}/',
+                                  50000.0, 50000.0, 0.0, None, ['Трубная'], 2,
+                                  2, f'Москва, Трубная, {flat_id}', [], [])
+    offer = dict(id=flat_id, bargainTerms=dict(priceRur=50000))
+    return cian_parser.ParsedFlat(flat, 3, f'hash{flat_id}', offer)
+
+
+def chat_update(chat_id):
+    return types.SimpleNamespace(message=types.SimpleNamespace(
+        chat_id=chat_id))
+
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.state_dir = tmp.name
+        self.bot = bot.CianBot.from_directory(self.state_dir)
+        self.addCleanup(self.bot.store.close)
+        self.bot.filter_engine.default = cian_filters.ChatFilter(
+            max_price_per_room=None, metros=(), metro_blacklist=())
+        self.scheduled = []  # (flat_id, chat_ids)
+        self.bot.schedule = self.schedule
+        for i in range(1, 7):
+            self.bot.add_flat(parsed_flat(i))
+        # Chat 1 got the first three, chat 2 everything
+        self.bot.add_chat(1)
+        for i in (1, 2, 3):
+            self.bot.mark_viewed(1, i)
+        self.bot.add_chat(2)
+        for i in range(1, 7):
+            self.bot.mark_viewed(2, i)
+        self.bot.set_cursors({1: 3, 2: 6})
+
+    def schedule(self, msg, chat_ids, kind='flat'):
+        self.scheduled.append((msg['flat_id'], chat_ids))
+
+    def test_fetch_messages_resumes_at_the_same_flat(self):
+        self.bot.evict_flats([2, 4])
+        self.assertEqual(list(self.bot.flat_log), [1, 3, 5, 6])
+        # Flat 4 was next for chat 1, now it's flat 5
+        self.assertEqual(self.bot.cursors, {1: 2, 2: 4})
+        self.bot.fetch_messages(chat_update(1), None)
+        self.assertEqual(self.scheduled, [(5, [1]), (6, [1])])
+        self.bot.fetch_messages(chat_update(2), None)
+        self.assertEqual(len(self.scheduled), 2)
+
+    def test_cursors_past_the_evicted_tail(self):
+        self.bot.evict_flats([5, 6])
+        self.assertEqual(self.bot.cursors, {1: 3, 2: 4})
+        self.bot.fetch_messages(chat_update(1), None)
+        self.assertEqual(self.scheduled, [(4, [1])])
+
+    def test_evicted_flats_are_not_sent_again(self):
+        self.bot.evict_flats([2, 4])
+        # Crawled again: chat 2 got them before, though nobody remembers
+        n_logged = len(self.bot.flat_log)
+        flats = [self.bot.add_flat(parsed_flat(i)) for i in (2, 4)]
+        self.bot.route_flats(flats, n_logged)
+        self.assertEqual(self.scheduled, [])
+        self.bot.fetch_messages(chat_update(1), None)
+        self.assertEqual(self.scheduled, [(5, [1]), (6, [1])])
+
+    def test_survives_a_restart(self):
+        self.bot.evict_flats([2, 4])
+        self.bot.store.close()
+        restarted = bot.CianBot.from_directory(self.state_dir)
+        self.addCleanup(restarted.store.close)
+        self.assertEqual(list(restarted.flat_log), [1, 3, 5, 6])
+        self.assertEqual(restarted.cursors, {1: 2, 2: 4})
+        self.assertEqual(set(restarted.evicted), {2, 4})
+        # What the chats got is read in once they're served
+        self.assertFalse(restarted.indexes_loaded)
+        restarted.schedule = self.schedule
+        restarted.fetch_messages(chat_update(1), None)
+        restarted.fetch_messages(chat_update(2), None)
+        self.assertEqual(self.scheduled, [(5, [1]), (6, [1])])
+        self.assertEqual(set(restarted.last_seen), {1, 3, 5, 6})
+        self.assertEqual(restarted.offer_hashes[5], 'hash5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+"""Sender driven by a fake bot, the way CianBot uses it.
+
+    python -m unittest discover tests"""
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+import bot
+import cian_sender
+import cian_store
+
+TIMEOUT = 10.0
+
+
+def entry(text, *chat_ids):
+    return types.SimpleNamespace(msg=dict(text=text),
+                                 chat_ids=list(chat_ids),
+                                 outbox_id=None)
+
+
+class FakeBot:
+    """Records what every chat got; `errors` maps a chat to the
+    exceptions its next calls raise, one per call"""
+
+    def __init__(self, errors=None):
+        self.lock = threading.Lock()
+        self.errors = {c: list(e) for c, e in (errors or {}).items()}
+        self.sent = []  # (chat_id, text)
+
+    def send_message(self, chat_id, text):
+        with self.lock:
+            if self.errors.get(chat_id):
+                raise self.errors[chat_id].pop(0)
+            self.sent.append((chat_id, text))
+        return types.SimpleNamespace(message_id=len(self.sent),
+                                     reply_text=lambda text: None)
+
+    def deliver(self, chat_id, msg):
+        self.send_message(chat_id, msg['text'])
+
+    def texts(self, chat_id):
+        with self.lock:
+            return [t for c, t in self.sent if c == chat_id]
+
+
+def wait_until(done):
+    deadline = time.monotonic() + TIMEOUT
+    while not done():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+class SenderTest(unittest.TestCase):
+    def setUp(self):
+        for name, value in (('CHAT_INTERVAL', 0.001), ('GROUP_INTERVAL',
+                                                       0.001),
+                            ('MAX_BACKOFF', 0.05)):
+            patcher = mock.patch.object(cian_sender, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.delivered = []
+        self.dropped = []
+
+    def start(self, fake):
+        sender = cian_sender.Sender(
+            fake.deliver,
+            lambda e, chat_id: self.delivered.append((chat_id, e.msg['text'])),
+            workers=4,
+            rate=1000,
+            on_dropped=lambda es, chat_id, gone: self.dropped.append(
+                (chat_id, [e.msg['text'] for e in es], gone)))
+        sender.start()
+        self.addCleanup(sender.stop)
+        return sender
+
+    def test_delivers_in_order(self):
+        fake = FakeBot()
+        sender = self.start(fake)
+        for i in range(5):
+            sender.submit(entry(f'm{i}', 1, 2))
+        wait_until(lambda: sender.depth == 0)
+        for chat_id in (1, 2):
+            self.assertEqual(fake.texts(chat_id), [f'm{i}' for i in range(5)])
+        self.assertEqual(sender.stats.sent, 10)
+        self.assertEqual(len(self.delivered), 10)
+
+    def test_retries_retry_after_and_network_errors(self):
+        fake = FakeBot({1: [RetryAfter(0.05), NetworkError('reset')]})
+        sender = self.start(fake)
+        sender.submit(entry('a', 1))
+        sender.submit(entry('b', 1))
+        wait_until(lambda: sender.depth == 0)
+        self.assertEqual(fake.texts(1), ['a', 'b'])
+        self.assertEqual(sender.stats.retry_after, 1)
+        self.assertEqual(sender.stats.failed, 1)
+        self.assertEqual(self.dropped, [])
+
+    def test_drops_a_bad_request(self):
+        fake = FakeBot({1: [BadRequest('Message is too long')]})
+        sender = self.start(fake)
+        sender.submit(entry('too long', 1))
+        sender.submit(entry('fine', 1))
+        wait_until(lambda: sender.depth == 0)
+        self.assertEqual(fake.texts(1), ['fine'])
+        self.assertEqual(self.dropped, [(1, ['too long'], False)])
+        self.assertEqual(sender.stats.dropped, 1)
+
+    def test_drops_everything_for_a_chat_that_blocked_the_bot(self):
+        fake = FakeBot({1: [Unauthorized('Forbidden: bot was blocked by '
+                                         'the user')]})
+        sender = self.start(fake)
+        with sender.cond:
+            # Queued before the first delivery fails
+            for text in ('a', 'b', 'c'):
+                sender.submit(entry(text, 1, 2))
+        wait_until(lambda: sender.depth == 0)
+        self.assertEqual(fake.texts(1), [])
+        self.assertEqual(fake.texts(2), ['a', 'b', 'c'])
+        self.assertEqual(self.dropped, [(1, ['a', 'b', 'c'], True)])
+        self.assertEqual(sender.stats.dropped, 3)
+
+    def test_chat_not_found_is_gone(self):
+        self.assertTrue(cian_sender.chat_gone(BadRequest('Chat not found')))
+        self.assertFalse(
+            cian_sender.chat_gone(BadRequest('Message is too long')))
+        self.assertTrue(cian_sender.chat_gone(Unauthorized('Forbidden')))
+        self.assertFalse(cian_sender.chat_gone(NetworkError('reset')))
+
+
+class CianBotSendTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(cian_sender, 'CHAT_INTERVAL', 0.001)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = cian_store.SqliteStore(':memory:')
+        self.state = bot.CianBot(store=self.store)
+        self.addCleanup(self.store.close)
+        for chat_id in (1, 2):
+            self.state.add_chat(chat_id)
+
+    def outbox_targets(self):
+        return sorted(
+            self.store.query('SELECT chat_id FROM outbox_targets'))
+
+    def test_unsubscribes_a_chat_that_blocked_the_bot(self):
+        fake = FakeBot({1: [Unauthorized('Forbidden: bot was blocked')]})
+        self.state.message_text = lambda msg: msg['text']
+        for text in ('a', 'b'):
+            self.state.schedule(dict(text=text), [1, 2])
+        self.state.start_sending(fake)
+        self.addCleanup(self.state.sender.stop)
+        wait_until(lambda: self.state.sender.depth == 0)
+        self.assertEqual(fake.texts(2), ['a', 'b'])
+        # The sender's threads leave the state alone
+        self.assertIn(1, self.state.viewed)
+        self.assertEqual(len(self.outbox_targets()), 4)
+        self.state.apply_send_outcomes(None)
+        self.assertEqual(self.outbox_targets(), [])
+        self.assertEqual(self.store.query('SELECT COUNT(*) FROM outbox'),
+                         [(0, )])
+        self.assertNotIn(1, self.state.viewed)
+        self.assertEqual(sorted(self.store.viewed()), [2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""SqliteStore transactions across threads, and what NullStore keeps.
+
+    python -m unittest discover tests"""
+import os.path as osp
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import cian_store
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = osp.join(tmp.name, cian_store.DB_FILE)
+        self.store = cian_store.SqliteStore(self.path)
+        self.addCleanup(self.store.close)
+
+    def committed(self, sql):
+        """What another process would see"""
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute(sql).fetchall()
+        finally:
+            db.close()
+
+    def test_commits_at_the_end_of_the_outermost_transaction(self):
+        with self.store.transaction():
+            self.store.add_observed_url('a')
+            with self.store.transaction():
+                self.store.add_observed_url('b')
+            self.assertEqual(self.committed('SELECT url FROM observed_urls'),
+                             [])
+        self.assertEqual(
+            self.committed('SELECT url FROM observed_urls ORDER BY url'),
+            [('a', ), ('b', )])
+
+    def test_writes_outside_a_transaction_commit_on_their_own(self):
+        self.store.add_observed_url('a')
+        self.assertEqual(self.committed('SELECT url FROM observed_urls'),
+                         [('a', )])
+
+    def test_other_threads_wait_for_the_transaction(self):
+        wrote = threading.Event()
+
+        def write():
+            self.store.add_chat(2)
+            wrote.set()
+
+        with self.store.transaction():
+            self.store.add_chat(1)
+            thread = threading.Thread(target=write)
+            thread.start()
+            # Neither written in between nor committed with our half
+            self.assertFalse(wrote.wait(0.2))
+            self.assertEqual(self.committed('SELECT chat_id FROM chats'), [])
+        thread.join()
+        self.assertEqual(
+            self.committed('SELECT chat_id FROM chats ORDER BY chat_id'),
+            [(1, ), (2, )])
+
+    def test_an_exception_commits_what_was_written(self):
+        with self.assertRaises(ValueError):
+            with self.store.transaction():
+                self.store.add_observed_url('a')
+                raise ValueError('routing failed')
+        self.assertEqual(self.committed('SELECT url FROM observed_urls'),
+                         [('a', )])
+
+
+class NullStoreTest(unittest.TestCase):
+    def test_keeps_the_most_recently_used_offers(self):
+        store = cian_store.NullStore(max_offers=2)
+        store.put_offer(1, dict(id=1))
+        store.put_offer(2, dict(id=2))
+        self.assertEqual(store.get_offer(1), dict(id=1))
+        store.put_offer(3, dict(id=3))
+        self.assertIsNone(store.get_offer(2))
+        self.assertEqual(store.get_offer(1), dict(id=1))
+        self.assertEqual(store.get_offer(3), dict(id=3))
+
+
+if __name__ == '__main__':
+    unittest.main()